@@ -1,13 +1,20 @@
 from ..station import Station, labware_loader, instrument_loader
 from ..geometry import LysisTube
+from ..liquids import LiquidClass
+from ..profiles import Profile
+from ..reagents import ReagentRequirement
 from ..utils import mix_bottom_top
 from itertools import chain, islice
+import numpy as np
 import math
 import logging
 from typing import Optional, Tuple
 
 
 class StationA(Station):    
+    _multi_plate = True
+    _passport_fields = ("positive_control_well",)
+    
     def __init__(
         self,
         air_gap_dest_multi: float = 5,
@@ -62,7 +69,7 @@ class StationA(Station):
         **kwargs
     ):
         """ Build a :py:class:`.StationA`.
-
+    
         :param air_gap_dest_multi: air gap for destination tube (multi) in uL
         :param air_gap_sample: air gap for sample transfer in uL
         :param dest_headroom_height: headroom always to keep from the bottom of the destination tube in mm
@@ -172,6 +179,8 @@ class StationA(Station):
         if self._tempdeck_temp is not None:
             self._tempdeck.set_temperature(self._tempdeck_temp)
     
+    _strips_content: str = "internal control"
+    
     @property
     def chilled_tubeblock_content(self) -> str:
         return self.get_msg_format("chilled tubeblock content", self.num_ic_strips, "{}")
@@ -250,13 +259,27 @@ class StationA(Station):
     
     @property
     def initlial_volume_lys(self) -> float:
-        return self._num_samples * self._lysis_volume * self._ic_lys_headroom
+        return self.plate_samples * self._lysis_volume * self._ic_lys_headroom
+    
+    def reagent_requirements(self):
+        return [
+            ReagentRequirement(
+                "lysis buffer", [self._lys_buff], [self._lysis_volume] * self.plate_samples,
+                headroom=self._ic_lys_headroom,
+                dead_volume=LysisTube(self._lys_buff.diameter / 2, self._lysis_cone_height).table.volume(self._lysis_headroom_height),
+            ),
+            ReagentRequirement(
+                self._strips_content, self._strips_block.rows()[0][:self.num_ic_strips], [self._iec_volume] * self.num_cols,
+                headroom=self._ic_lys_headroom, dead_volume=0, capacity=self._ic_capacity, tubes=self._m20.channels,
+            ),
+        ]
     
     def setup_samples(self):
-        self._sources = list(islice(chain.from_iterable(rack.wells() for rack in self._source_racks), self._num_samples))
-        self._dests_single = self._dest_plate.wells()[:self._num_samples]
+        self._sources = list(islice(chain.from_iterable(rack.wells() for rack in self._source_racks), self.plate_samples))
+        self._dests_single = self._dest_plate.wells()[:self.plate_samples]
         self._dests_multi = self._dest_plate.rows()[0][:self.num_cols]
         self.logger.debug("positive control in {} of destination rack".format(self._positive_control_well))
+        self._well_maps[self._plate_idx] = {d.well_name: "{}:{}".format(s.parent.parent, s.well_name) for s, d in self.non_control_positions()}
     
     def setup_lys_tube(self):
         self._lysis_tube = LysisTube(self._lys_buff.diameter / 2, self._lysis_cone_height)
@@ -264,43 +287,40 @@ class StationA(Station):
         self._lysis_tube.fill(self.initlial_volume_lys)
         self.logger.info(self.msg_format("lysis geometry", math.ceil(self._lysis_tube.volume), self._lysis_tube.height))
     
+    def lysis_heights(self, n: int) -> np.ndarray:
+        """Aspiration heights for the next n lysis buffer transfers, computed in one go from the tube lookup table"""
+        return np.maximum(self._lysis_tube.extraction_heights(np.full(n, self._lysis_volume)), self._lysis_headroom_height)
+    
     def transfer_sample(self, source, dest):
-        self.logger.debug("transferring from {} to {}".format(source, dest))
+        self.logger.debug("transferring from %s to %s", source, dest)
+        sample = self.liquids["sample VTM"]
         self.pick_up(self._p_main)
         
-        self._p_main.move_to(source.top(self._source_position_top))
-        self._ctx.max_speeds['A'] = self._max_speeds_a
-        
-        # Mix by aspirating and dispensing at different heights
-        mix_bottom_top(
-            self._p_main, self._mix_repeats, self._mix_volume,
-            source.bottom, self._source_headroom_height, self._source_top_height
-        )
-        self._p_main.aspirate(self._sample_volume, source.bottom(self._source_headroom_height))        
-        
-        # Wait to be sure the sample is aspirated
-        self._ctx.delay(1)
-        self._p_main.move_to(source.top(self._source_position_top))
-        self._ctx.max_speeds['A'] = None
-        self._p_main.air_gap(self._air_gap_sample)
+        with self.near_liquid(self._p_main, source, self._source_position_top):
+            # Mix by aspirating and dispensing at different heights
+            mix_bottom_top(
+                self._p_main, self._mix_repeats, self._mix_volume,
+                source.bottom, self._source_headroom_height, self._source_top_height
+            )
+            self._p_main.aspirate(self._sample_volume, source.bottom(self._source_headroom_height))
+            
+            # Wait to be sure the sample is aspirated
+            self.liquid_delay(sample.aspirate_delay)
+        self._p_main.air_gap(sample.air_gap)
         
-        self._p_main.dispense(self._air_gap_sample, dest.top(self._hover_height))
+        self._p_main.dispense(sample.air_gap, dest.top(self._hover_height))
         self._p_main.dispense(self._sample_volume, dest.bottom(self._dest_top_height))
+        self.liquid_delay(sample.dispense_delay)
         
         if self._lysis_first:
-            self._p_main.flow_rate.aspirate = self._lysis_rate_aspirate
-            self._p_main.flow_rate.dispense = self._lysis_rate_dispense
-            
             # Mix with lysis buffer
-            mix_bottom_top(
-                self._p_main, self._lys_mix_repeats, self._lys_mix_volume,
-                dest.bottom, self._dest_headroom_height, self._dest_top_height
-            )
-            
-            self._p_main.flow_rate.aspirate = self._sample_aspirate
-            self._p_main.flow_rate.dispense = self._sample_dispense
-            
-        self._p_main.air_gap(self._air_gap_sample)
+            with self.liquid(self._p_main, "lysis buffer"):
+                mix_bottom_top(
+                    self._p_main, self._lys_mix_repeats, self._lys_mix_volume,
+                    dest.bottom, self._dest_headroom_height, self._dest_top_height
+                )
+        
+        self._p_main.air_gap(sample.air_gap)
         self.drop(self._p_main)
     
     def is_positive_control_well(self, dest) -> bool:
@@ -314,52 +334,51 @@ class StationA(Station):
         return filter(lambda t: not self.is_positive_control_well(t[1]), zip(sources, dests))
     
     def transfer_samples(self):
-        self._p_main.flow_rate.aspirate = self._sample_aspirate
-        self._p_main.flow_rate.dispense = self._sample_dispense
-        
-        n = len(list(self.non_control_positions()))
-        for i, (s, d) in enumerate(self.non_control_positions()):
-            if self.run_stage("transfer sample {}/{}".format(i + 1, n)):
-                self.transfer_sample(s, d)
+        with self.liquid(self._p_main, "sample VTM"):
+            n = len(list(self.non_control_positions()))
+            for i, (s, d) in enumerate(self.non_control_positions()):
+                if self.run_stage("transfer sample {}/{}".format(i + 1, n)):
+                    self.transfer_sample(s, d)
+                    self.record("transfer_sample", [d.well_name])
     
     def transfer_lys(self):
-        self._p_main.flow_rate.aspirate = self._lysis_rate_aspirate
-        self._p_main.flow_rate.dispense = self._lysis_rate_dispense
-        
-        if self._lysis_first:
-            self.pick_up(self._p_main)
-        mix = {} if self._lysis_first else {'mix_after': (self._lys_mix_repeats, self._lys_mix_volume)}
-        n = len(list(self.non_control_positions()))
-        for i, (_, dest) in enumerate(self.non_control_positions()):
-            if self.run_stage("transfer lysis {}/{}".format(i + 1, n)):
-                if not self._lysis_first:
-                    self.pick_up(self._p_main)
-                self.logger.debug("transferring lysis to {}".format(dest))
-                h = max(self._lysis_tube.extract(self._lysis_volume), self._lysis_headroom_height)
-                self.logger.debug("going {} mm deep".format(h))
-                self._p_main.transfer(
-                    self._lysis_volume,
-                    self._lys_buff.bottom(h),
-                    dest.bottom(self._lysis_headroom_height),
-                    air_gap=self._air_gap_sample,
-                    new_tip='never',
-                    **mix
-                )
-                self._p_main.air_gap(self._air_gap_sample)
-                if self._lysis_first:
-                    self._p_main.dispense(self._air_gap_sample, self._lys_buff.top())
-                else:
-                    self.drop(self._p_main)
-        if self._lysis_first:
-            self.drop(self._p_main)
+        with self.liquid(self._p_main, "lysis buffer") as lysis:
+            if self._lysis_first:
+                self.pick_up(self._p_main)
+            mix = {} if self._lysis_first else {'mix_after': (self._lys_mix_repeats, self._lys_mix_volume)}
+            dests = [d for _, d in self.non_control_positions()]
+            n = len(dests)
+            heights = self.lysis_heights(n)
+            for i, dest in enumerate(dests):
+                if self.run_stage("transfer lysis {}/{}".format(i + 1, n)):
+                    if not self._lysis_first:
+                        self.pick_up(self._p_main)
+                    self.logger.debug("transferring lysis to %s", dest)
+                    h = float(heights[i])
+                    self.logger.debug("going %s mm deep", h)
+                    self._p_main.transfer(
+                        self._lysis_volume,
+                        self._lys_buff.bottom(h),
+                        dest.bottom(self._lysis_headroom_height),
+                        air_gap=lysis.air_gap,
+                        new_tip='never',
+                        **mix
+                    )
+                    self._p_main.air_gap(lysis.air_gap)
+                    if self._lysis_first:
+                        self._p_main.dispense(lysis.air_gap, self._lys_buff.top())
+                    else:
+                        self.drop(self._p_main)
+                    self.record("transfer_lys", [dest.well_name])
+            self._lysis_tube.extract(n * self._lysis_volume)
+            if self._lysis_first:
+                self.drop(self._p_main)
     
     def transfer_internal_control(self, idx: int, dest):
-        self._p_main.flow_rate.aspirate = self._lysis_rate_aspirate
-        self._p_main.flow_rate.dispense = self._lysis_rate_dispense
-        
-        strip_ind = idx // self.cols_per_strip
-        self.logger.debug("transferring internal control strip {}/{} to {}".format(strip_ind + 1, self.num_ic_strips, dest))
-        internal_control = self._strips_block.rows()[0][strip_ind]
+        plan = self.reagent_plan[self._strips_content]
+        strip_ind = plan.assignment[idx]
+        self.logger.debug("transferring internal control strip %d/%d to %s", strip_ind + 1, len(plan.wells), dest)
+        internal_control = plan.column_wells[idx]
         self.pick_up(self._m20)
         # no air gap to use 1 transfer only avoiding drop during multiple transfers
         self._m20.transfer(self._iec_volume, internal_control, dest.bottom(self._ic_headroom_bottom), new_tip='never')
@@ -379,9 +398,37 @@ class StationA(Station):
             "_tipracks20": "_m20",
         }
     
+    def profiles(self):
+        return dict(
+            super(StationA, self).profiles(),
+            **{
+                "near-liquid": Profile(z_speed=self._max_speeds_a),
+            }
+        )
+    
+    def liquid_classes(self):
+        return dict(
+            super(StationA, self).liquid_classes(),
+            **{
+                "sample VTM": LiquidClass(
+                    aspirate=self._sample_aspirate,
+                    dispense=self._sample_dispense,
+                    blow_out=self._sample_blow_out,
+                    air_gap=self._air_gap_sample,
+                    aspirate_delay=1,
+                ),
+                "lysis buffer": LiquidClass(
+                    aspirate=self._lysis_rate_aspirate,
+                    dispense=self._lysis_rate_dispense,
+                    air_gap=self._air_gap_sample,
+                ),
+            }
+        )
+    
     def body(self):
         self.setup_samples()
         self.setup_lys_tube()
+        self.log_load_sheet()
         self.msg = ""
         
         T = (self.transfer_lys, self.transfer_samples)
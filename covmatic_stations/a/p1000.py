@@ -44,17 +44,18 @@ class StationAP1000(StationA):
             super(StationAP1000, self)._load_source_racks()
 
     def transfer_sample(self, source, dest):
-        self.logger.debug("transferring from {} to {}".format(source, dest))
+        self.logger.debug("transferring from %s to %s", source, dest)
+        sample = self.liquids["sample VTM"]
         self.pick_up(self._p_main)
         self._p_main.mix(self._mix_repeats, self._mix_volume, source.bottom(self._source_headroom_height))
         self._p_main.transfer(
             self._sample_volume,
             source.bottom(self._source_headroom_height),
             dest.bottom(self._dest_headroom_height),
-            air_gap=self._air_gap_sample,
+            air_gap=sample.air_gap,
             new_tip='never'
         )
-        self._p_main.air_gap(self._air_gap_sample)
+        self._p_main.air_gap(sample.air_gap)
         self._p_main.drop_tip()
 
 
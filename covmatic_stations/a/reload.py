@@ -1,35 +1,121 @@
 from .a import StationA
 from ..station import StationMeta
+from itertools import chain
+from threading import Event
+from typing import Dict, List, Optional
 import math
 
 
 # Mixin allows for finer control over the mro
 class StationAReloadMixin(metaclass=StationMeta):
+    def __init__(self, *args, double_buffer: bool = False, **kwargs):
+        """
+        :param double_buffer: split the source positions in two buffers that are used alternately, so that the operator can refill one buffer while the robot works on the other one
+        :param kwargs: other keyword arguments. See: StationA
+        """
+        super(StationAReloadMixin, self).__init__(*args, **kwargs)
+        self._double_buffer = double_buffer
+        self._refilled = [Event(), Event()]
+        self._waiting_refill: Optional[int] = None
+        self.pending_refills: Dict[int, str] = {}
+    
     @property
     def max_samples_per_set(self) -> int:
         return len(self._sources)
     
     @property
     def sets_of_samples(self) -> int:
-        return math.ceil(self._num_samples/self.max_samples_per_set)
+        return math.ceil(self.plate_samples/self.max_samples_per_set)
     
     @property
     def remaining_samples(self) -> int:
-        return self._num_samples - self._done_samples 
+        return self.plate_samples - self._done_samples 
+    
+    @property
+    def source_buffers(self) -> List[list]:
+        """Source positions of the two buffers: the two halves of the source racks or, with a single rack, of its columns"""
+        groups = self._source_racks if len(self._source_racks) > 1 else self._source_racks[0].columns()
+        h = math.ceil(len(groups) / 2)
+        return [list(chain.from_iterable(g.wells() if len(self._source_racks) > 1 else g for g in half)) for half in (groups[:h], groups[h:])]
+    
+    def transfer_set(self, sources):
+        for s, d in self.non_control_positions(sources[:self.remaining_samples], self._dests_single[self._done_samples:]):
+            if self.run_stage("transfer sample {}/{}".format(self._done_samples + 1, self.plate_samples)):
+                self.transfer_sample(s, d)
+                self.record("transfer_sample", [d.well_name])
+            # the tubes of the racks are reused across refills
+            self._well_maps.setdefault(self._plate_idx, {})[d.well_name] = "{}:{}".format(s.parent.parent, s.well_name)
+            self._done_samples += 1
     
     def transfer_samples(self):
+        with self.liquid(self._p_main, "sample VTM"):
+            if self._double_buffer:
+                if all(self.source_buffers):
+                    return self.transfer_samples_double_buffer()
+                self.logger.warning(self.get_msg("no double buffer"))
+            self._done_samples = 0
+            refills = self.sets_of_samples - 1
+            
+            self.logger.info(self.msg_format("refills", self.max_samples_per_set, refills))
+            for set_idx in reversed(range(self.sets_of_samples)):
+                self.logger.debug("{} remaining samples".format(self.remaining_samples))
+                self.transfer_set(self._sources)
+                if set_idx and self.run_stage("refill {}/{}".format(self.sets_of_samples - set_idx, self.sets_of_samples - 1)):
+                    self.dual_pause(self.msg_format("refill", min(self.remaining_samples, self.max_samples_per_set)))
+    
+    def buffer_description(self, buffer: int) -> str:
+        sources = self.source_buffers[buffer]
+        return self.get_msg_format("buffer description", buffer + 1, sources[0], sources[-1])
+    
+    def transfer_samples_double_buffer(self):
         self._done_samples = 0
-        refills = self.sets_of_samples - 1
+        buffers = self.source_buffers
+        for e in self._refilled:
+            e.set()  # both buffers are loaded at the start
+        
+        sizes = []
+        while sum(sizes) < self.plate_samples:
+            sizes.append(len(buffers[len(sizes) % 2]))
+        self.logger.info(self.msg_format("buffer refills", len(buffers[0]), len(buffers[1]), len(sizes) - 2 if len(sizes) > 2 else 0))
         
-        self.logger.info(self.msg_format("refills", self.max_samples_per_set, refills))
-        for set_idx in reversed(range(self.sets_of_samples)):
+        for set_idx in range(len(sizes)):
+            b = set_idx % 2
             self.logger.debug("{} remaining samples".format(self.remaining_samples))
-            for s, d in self.non_control_positions(self._sources[:self.remaining_samples], self._dests_single[self._done_samples:]):
-                if self.run_stage("transfer sample {}/{}".format(self._done_samples + 1, self._num_samples)):
-                    self.transfer_sample(s, d)
-                self._done_samples += 1
-            if set_idx and self.run_stage("refill {}/{}".format(self.sets_of_samples - set_idx, self.sets_of_samples - 1)):
-                self.dual_pause(self.msg_format("refill", min(self.remaining_samples, self.max_samples_per_set)))
+            if set_idx >= 2 and self.run_stage("wait refill {}/{}".format(set_idx - 1, len(sizes) - 2)):
+                self.wait_refill(b)
+            self._refilled[b].clear()
+            self.transfer_set(buffers[b])
+            if set_idx + 2 < len(sizes):
+                self.request_refill(b, min(self.remaining_samples - len(buffers[1 - b]), len(buffers[b])))
+    
+    def request_refill(self, buffer: int, samples: int):
+        """Ask the operator to refill a buffer while the robot works on the other one"""
+        self.pending_refills[buffer + 1] = self.get_msg_format("refill buffer", samples, self.buffer_description(buffer))
+        self.logger.info(self.pending_refills[buffer + 1])
+    
+    def source_refilled(self, buffer: int) -> bool:
+        """Mark a buffer as refilled (e.g. from the REST server)
+        :param buffer: index of the buffer (starting from 1)
+        :returns: whether a refill was pending for the buffer"""
+        if self.pending_refills.pop(buffer, None) is None:
+            return False
+        self.logger.info(self.get_msg_format("buffer refilled", self.buffer_description(buffer - 1)))
+        self._refilled[buffer - 1].set()
+        if self._waiting_refill == buffer - 1:
+            self._ctx.resume()
+        return True
+    
+    def wait_refill(self, buffer: int):
+        self._waiting_refill = buffer
+        if self._refilled[buffer].is_set():
+            self._waiting_refill = None
+            return
+        # a refill confirmed while the robot is getting ready to pause resumes it as soon as it pauses
+        self.pause(self.get_msg_format("wait buffer", self.buffer_description(buffer)), interventions=False, reason="wait buffer", planned=False,
+                   resume_if=self._refilled[buffer].is_set)
+        self._waiting_refill = None
+        # Resuming from the app also confirms the refill
+        self.pending_refills.pop(buffer + 1, None)
 
 
 # Subclass is more straightforward
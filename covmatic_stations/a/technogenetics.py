@@ -2,6 +2,7 @@ from .p1000 import StationAP1000
 from .reload import StationAReloadMixin
 from .copan_24 import Copan24Specs
 from .copan_48 import copan_48_corrected_specs
+from ..reagents import ReagentRequirement
 from typing import Tuple, Optional
 
 
@@ -93,11 +94,18 @@ class StationATechnogenetics(StationAP1000):
     def _beads(self):
         return self._strips_block.rows()[0][-1]
     
+    def reagent_requirements(self):
+        return super(StationATechnogenetics, self).reagent_requirements() + [ReagentRequirement(
+            "beads", [self._beads], [self._beads_vol] * self.num_cols,
+            headroom=self._ic_lys_headroom, dead_volume=0, capacity=self._ic_capacity, tubes=self._m20.channels,
+        )]
+    
     def transfer_proteinase(self):
+        sources = self.reagent_plan[self._strips_content].column_wells
         for i, d in enumerate(self._dests_multi):
             if self.run_stage("transfer proteinase {}/{}".format(i + 1, len(self._dests_multi))):
                 self.pick_up(self._m20)
-                self._m20.transfer(self._prot_k_volume, self._prot_k[i // self.cols_per_strip], d.bottom(self._ic_headroom_bottom), new_tip='never')
+                self._m20.transfer(self._prot_k_volume, sources[i], d.bottom(self._ic_headroom_bottom), new_tip='never')
                 self._m20.drop_tip()
     
     def transfer_beads(self):
@@ -108,10 +116,12 @@ class StationATechnogenetics(StationAP1000):
                 self._m20.mix(self._beads_mix_repeats, self._beads_mix_volume, d.bottom(self._dest_multi_headroom_height))
                 self._m20.air_gap(self._air_gap_dest_multi)
                 self._m20.drop_tip()
+                self.record("transfer_beads", self.column_wells(d))
     
     def body(self):
         self.setup_samples()
         self.setup_lys_tube()
+        self.log_load_sheet()
         self.msg = ""
         
         self.transfer_proteinase()
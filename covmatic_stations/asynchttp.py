@@ -0,0 +1,132 @@
+"""Minimal asyncio HTTP client.
+Keep-alive HTTP/1.1 GET and POST requests over asyncio streams, without further dependencies,
+for polling the REST API of many stations (see :py:mod:`covmatic_stations.fleet` and :py:mod:`covmatic_stations.loadtest`)"""
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import asyncio
+import json
+
+
+class HTTPConnection:
+    def __init__(self, host: str, port: int, timeout: float = 10):
+        """ Build a :py:class:`.HTTPConnection`: a minimal keep-alive HTTP/1.1 client for asyncio.
+        :param host: the server host
+        :param port: the server port
+        :param timeout: timeout in seconds for each request
+        """
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+    
+    async def _request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        request = "{} {} HTTP/1.1\r\nHost: {}:{}\r\n".format(method, path, self._host, self._port).encode()
+        if body is not None:
+            data = json.dumps(body).encode()
+            request += "Content-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(len(data)).encode() + data
+        else:
+            request += b"\r\n"
+        self._writer.write(request)
+        await self._writer.drain()
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = (await self._reader.readline()).decode().strip()
+            if not line:
+                break
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            body = b""
+            while True:
+                size = int((await self._reader.readline()).strip(), 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self._reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection") == "close":
+            self.close()
+        return status, body
+    
+    async def get(self, path: str) -> Tuple[int, bytes]:
+        """Send a GET request
+        :return: the status code and the body of the response"""
+        return await self.request("GET", path)
+    
+    async def post(self, path: str, body: dict) -> Tuple[int, bytes]:
+        """Send a POST request with a JSON body
+        :return: the status code and the body of the response"""
+        return await self.request("POST", path, body)
+    
+    async def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, bytes]:
+        try:
+            return await asyncio.wait_for(self._request(method, path, body), self._timeout)
+        except Exception:
+            self.close()
+            raise
+    
+    @property
+    def open(self) -> bool:
+        return self._writer is not None
+    
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class ConnectionPool:
+    def __init__(self, timeout: float = 10):
+        """ Build a :py:class:`.ConnectionPool`: keep-alive connections shared by the requests to the same servers.
+        :param timeout: timeout in seconds for each request
+        """
+        self._timeout = timeout
+        self._idle: Dict[Tuple[str, int], List[HTTPConnection]] = {}
+    
+    async def get(self, url: str) -> Tuple[int, bytes]:
+        """Send a GET request, reusing an idle connection to the server if there is one
+        :return: the status code and the body of the response"""
+        return await self.request("GET", url)
+    
+    async def post(self, url: str, body: dict) -> Tuple[int, bytes]:
+        """Send a POST request with a JSON body, reusing an idle connection to the server if there is one
+        :return: the status code and the body of the response"""
+        return await self.request("POST", url, body)
+    
+    async def request(self, method: str, url: str, body: Optional[dict] = None) -> Tuple[int, bytes]:
+        parts = urlsplit(url if "://" in url else "http://" + url)
+        key = (parts.hostname, parts.port or 80)
+        idle = self._idle.setdefault(key, [])
+        conn = idle.pop() if idle else HTTPConnection(*key, timeout=self._timeout)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        reused = conn.open
+        try:
+            status, data = await conn.request(method, path, body)
+        except ConnectionError:
+            if not reused:
+                raise
+            # The server closed the idle connection (e.g. after its socket timeout): retry once on a new one
+            conn = HTTPConnection(*key, timeout=self._timeout)
+            status, data = await conn.request(method, path, body)
+        idle.append(conn)
+        return status, data
+    
+    def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.close()
+        self._idle.clear()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -1,14 +1,26 @@
+from ..history import stage_durations
 from ..station import Station, labware_loader, instrument_loader
+from ..liquids import LiquidClass
+from ..profiles import Profile
+from ..reagents import ReagentRequirement
 from ..utils import mix_bottom_top, uniform_divide, mix_walk
 from . import magnets
+from .pipeline import Lane, PipelineScheduler
 from opentrons.types import Point
 from typing import Optional, Tuple
 import logging
 import math
+import re
+import time
+
+
+# Plate in the stage names of runs with more plates (e.g. 'plate 2/4 wash 1 3/6')
+_stage_plate = re.compile(r"^plate (\d+)/\d+ ")
 
 
 class StationB(Station):
     _protocol_description = "station B protocol"
+    _multi_plate = True
     
     def __init__(
         self,
@@ -45,6 +57,7 @@ class StationB(Station):
         metadata: Optional[dict] = None,
         num_samples: int = 96,
         samples_per_col: int = 8,
+        second_magdeck_slot: Optional[str] = None,
         skip_delay: bool = False,
         supernatant_removal_air_gap: float = 20,
         supernatant_removal_aspiration_rate: float = 25,
@@ -109,6 +122,7 @@ class StationB(Station):
         :param metadata: protocol metadata
         :param num_samples: The number of samples that will be loaded on the station B
         :param samples_per_col: The number of samples in a column of the destination plate
+        :param second_magdeck_slot: Slot of an optional second magnetic module. If specified, plates are processed in pairs of 48 samples, one per magnetic module, interleaving the work on one plate with the incubations of the other (the slot must not be used by the tipracks)
         :param skip_delay: If True, pause instead of delay.
         :param supernatant_removal_air_gap: Air gap when removing the supernatant in uL
         :param supernatant_removal_aspiration_rate: Aspiration flow rate when removing the supernatant in uL/s
@@ -174,6 +188,7 @@ class StationB(Station):
         self._elution_height = elution_height
         self._elution_vol = elution_vol
         self._magheight = magheight
+        self._magheight_default = magheight
         self._magheight_load = magheight_load
         self._magplate_model = magplate_model
         self._supernatant_removal_air_gap = supernatant_removal_air_gap
@@ -182,6 +197,7 @@ class StationB(Station):
         self._starting_vol = starting_vol
         self._tempdeck_slot = tempdeck_slot
         self._tempdeck_temp = tempdeck_temp
+        self._second_magdeck_slot = second_magdeck_slot
         self._tipracks_slots = tipracks_slots
         self._touch_tip_height = touch_tip_height
         self._wait_time_bind_off = wait_time_bind_off
@@ -204,6 +220,22 @@ class StationB(Station):
         self._wash_1_vol = wash_1_vol
         self._wash_2_times = wash_2_times
         self._wash_2_vol = wash_2_vol
+        self._col_offset = 0
+        self._pair_cols: Optional[int] = None
+        self._scheduler: Optional[PipelineScheduler] = None
+    
+    @property
+    def _plate_capacity(self) -> int:
+        return 96 if self._second_magdeck_slot is None else 48
+    
+    @property
+    def total_cols(self) -> int:
+        """Number of columns drawn from the reagents (for all the plates on the deck)"""
+        return self._pair_cols or self.num_cols
+    
+    @property
+    def _reagent_plan_key(self):
+        return self.plate_samples, self.total_cols
     
     @labware_loader(0, "_tips300")
     def load_tips300(self):
@@ -212,18 +244,32 @@ class StationB(Station):
             for slot in self._tipracks_slots
         ]
     
+    def magnet_height(self, magdeck) -> float:
+        if self._magheight_load:
+            return magnets.height.by_serial.get(magdeck._module._driver.get_device_info()['serial'], self._magheight_default)
+        return self._magheight_default
+    
     @labware_loader(2, "_magdeck")
     def load_magdeck(self):
         self._magdeck = self._ctx.load_module('Magnetic Module Gen2', '4')
         self._magdeck.disengage()
-        if (self._magheight_load):
-            self._magheight = magnets.height.by_serial.get(self._magdeck._module._driver.get_device_info()['serial'], self._magheight)
+        self._magheight = self.magnet_height(self._magdeck)
     
     @labware_loader(3, "_magplate")
     def load_magplate(self):
         self._magplate = self._magdeck.load_labware(self._magplate_model)
         self.logger.debug("using '{}' magnetic plate".format(self._magplate_model))
     
+    @labware_loader(3, "_magdeck2", "_magplate2")
+    def load_second_magdeck(self):
+        self._magdeck2 = self._magplate2 = None
+        self._magheight2 = self._magheight_default
+        if self._second_magdeck_slot is not None:
+            self._magdeck2 = self._ctx.load_module('Magnetic Module Gen2', self._second_magdeck_slot)
+            self._magdeck2.disengage()
+            self._magheight2 = self.magnet_height(self._magdeck2)
+            self._magplate2 = self._magdeck2.load_labware(self._magplate_model)
+    
     @property
     def mag_samples_m(self):
         return self._magplate.rows()[0][:self.num_cols]
@@ -240,7 +286,7 @@ class StationB(Station):
     
     @property
     def elution_samples_m(self):
-        return self._flatplate.rows()[0][:self.num_cols]
+        return self._flatplate.rows()[0][self._col_offset:self._col_offset + self.num_cols]
     
     @labware_loader(6, "_waste")
     def load_waste(self):
@@ -284,54 +330,99 @@ class StationB(Station):
     def _tipracks(self) -> dict:
         return {"_tips300": "_m300",}
     
+    def profiles(self):
+        return dict(
+            super(StationB, self).profiles(),
+            **{"wash-mix": Profile(aspirate=self._wash_mix_aspiration_rate, dispense=self._wash_mix_dispense_rate)}
+        )
+    
+    def liquid_classes(self):
+        wash = LiquidClass(aspirate=self._default_aspiration_rate, air_gap=self._wash_air_gap)
+        return dict(
+            super(StationB, self).liquid_classes(),
+            supernatant=LiquidClass(aspirate=self._supernatant_removal_aspiration_rate, air_gap=self._supernatant_removal_air_gap),
+            wash=wash,
+            ethanol=wash.updated(),
+            elution=LiquidClass(
+                aspirate=self._elute_aspiration_rate,
+                air_gap=self._elute_air_gap,
+                touch_tip=True,
+                touch_tip_v_offset=self._touch_tip_height,
+            ),
+            **{"bead mix": LiquidClass(
+                aspirate=self._bind_aspiration_rate,
+                dispense=self._bind_dispense_rate or None,
+                blow_out=self._bind_blowout_rate or None,
+                air_gap=self._bind_air_gap,
+                touch_tip=True,
+                touch_tip_v_offset=self._touch_tip_height,
+            )}
+        )
+    
+    def _column_requirement(self, name: str, wells, vol: float) -> ReagentRequirement:
+        return ReagentRequirement(name, wells, [vol * self._m300.channels] * self.total_cols, headroom=self._wash_headroom)
+    
+    def reagent_requirements(self):
+        return [
+            self._column_requirement("binding buffer", self.binding_buffer, self._bind_vol),
+            self._column_requirement("wash 1", self.wash1, self._wash_1_vol),
+            self._column_requirement("wash 2", self.wash2, self._wash_2_vol),
+            self._column_requirement("ethanol", self._etoh, self._wash_etoh_vol),
+            self._column_requirement("elution buffer", [self.water], self._elution_vol),
+        ]
+    
     def remove_supernatant(self, vol: float, stage: str = "remove supernatant"):
-        self._m300.flow_rate.aspirate = self._supernatant_removal_aspiration_rate
-        num_trans = math.ceil(vol / self._bind_max_transfer_vol)
-        vol_per_trans = vol / num_trans
-        
-        for i, m in enumerate(self.mag_samples_m):
-            if self.run_stage("{} {}/{}".format(stage, i + 1, len(self.mag_samples_m))):
-                self.pick_up(self._m300)
-                loc = m.bottom(self._supernatant_removal_height).move(Point(x=(-1 if i % 2 == 0 else 1)*2))
-                for _ in range(num_trans):
-                    if self._m300.current_volume > 0:
-                        self._m300.dispense(self._m300.current_volume, m.top())
-                    self._m300.move_to(m.center())
-                    self._m300.transfer(vol_per_trans, loc, self._waste, new_tip='never', air_gap=self._supernatant_removal_air_gap)
-                    self._m300.air_gap(self._supernatant_removal_air_gap)
-                self.drop(self._m300)
-        self._m300.flow_rate.aspirate = self._default_aspiration_rate
+        with self.liquid(self._m300, "supernatant") as supernatant:
+            num_trans = math.ceil(vol / self._bind_max_transfer_vol)
+            vol_per_trans = vol / num_trans
+            
+            for i, m in enumerate(self.mag_samples_m):
+                if self.run_stage("{} {}/{}".format(stage, i + 1, len(self.mag_samples_m))):
+                    with self.operations("_m300"):
+                        self.pick_up(self._m300)
+                        loc = m.bottom(self._supernatant_removal_height).move(Point(x=(-1 if i % 2 == 0 else 1)*2))
+                        for _ in range(num_trans):
+                            if self._m300.current_volume > 0:
+                                self._m300.dispense(self._m300.current_volume, m.top())
+                            self._m300.move_to(m.center())
+                            self._m300.transfer(vol_per_trans, loc, self._waste, new_tip='never', air_gap=supernatant.air_gap)
+                            self._m300.air_gap(supernatant.air_gap)
+                        self.drop(self._m300)
         
     def bind(self):
         """Add bead binding buffer and mix samples"""
-        self._m300.flow_rate.aspirate = self._bind_aspiration_rate
+        sources = self.reagent_plan["binding buffer"].column_wells
         
-        for i, well in enumerate(self.mag_samples_m):
-            if self.run_stage("transfer binding {}/{}".format(i + 1, len(self.mag_samples_m))):
-                source = self.binding_buffer[i // ((len(self.mag_samples_m) // len(self.binding_buffer)) or 1)]
-                self.pick_up(self._m300)
-                mix_bottom_top(
-                    self._m300,
-                    self._bind_mix_times,
-                    self._bind_mix_vol,
-                    source.bottom,
-                    self._bind_mix_loc_bottom,
-                    self._bind_mix_loc_top
-                )
-                
-                num_trans, vol_per_trans = uniform_divide(self._bind_vol, self._bind_max_transfer_vol)
-                
-                for t in range(num_trans):
-                    if self._m300.current_volume > 0:
-                        self._m300.dispense(self._m300.current_volume, source.top())  # void air gap if necessary
-                    self._m300.transfer(vol_per_trans, source, well.top(), air_gap=self._bind_air_gap, new_tip='never')
-                    if t == 0:
-                        self._m300.air_gap(self._bind_air_gap)
-                self._m300.mix(self._bind_sample_mix_times, self._bind_sample_mix_vol, well)
-                
-                self._m300.touch_tip(v_offset=self._touch_tip_height)
-                self._m300.air_gap(self._bind_air_gap)
-                self.drop(self._m300)
+        with self.liquid(self._m300, "bead mix") as beads:
+            for i, well in enumerate(self.mag_samples_m):
+                if self.run_stage("transfer binding {}/{}".format(i + 1, len(self.mag_samples_m))):
+                    with self.operations("_m300"):
+                        source = sources[self._col_offset + i]
+                        self.pick_up(self._m300)
+                        mix_bottom_top(
+                            self._m300,
+                            self._bind_mix_times,
+                            self._bind_mix_vol,
+                            source.bottom,
+                            self._bind_mix_loc_bottom,
+                            self._bind_mix_loc_top
+                        )
+                        
+                        num_trans, vol_per_trans = uniform_divide(self._bind_vol, self._bind_max_transfer_vol)
+                        
+                        for t in range(num_trans):
+                            if self._m300.current_volume > 0:
+                                self._m300.dispense(self._m300.current_volume, source.top())  # void air gap if necessary
+                            self._m300.transfer(vol_per_trans, source, well.top(), air_gap=beads.air_gap, new_tip='never')
+                            if t == 0:
+                                self._m300.air_gap(beads.air_gap)
+                        self._m300.mix(self._bind_sample_mix_times, self._bind_sample_mix_vol, well)
+                        
+                        if beads.touch_tip:
+                            self._m300.touch_tip(v_offset=beads.touch_tip_v_offset)
+                        self._m300.air_gap(beads.air_gap)
+                        self.drop(self._m300)
+                    self.record("bind", self.column_wells(well))
         
         if self.run_stage("bind wait"):
             # Time Issue in Station B After the waiting time of 5 min the magnetic module should run for 6 min.
@@ -341,7 +432,7 @@ class StationB(Station):
         if self.run_stage("bind incubate"):
             # Time Issue in Station B After the waiting time of 5 min the magnetic module should run for 6 min.
             self.delay(self._wait_time_bind_on, self.get_msg_format("incubate on magdeck", self.get_msg("on")))
-
+    
         # Remove initial supernatant
         self.remove_supernatant(self._bind_vol + self._starting_vol, "remove binding")
     
@@ -351,37 +442,40 @@ class StationB(Station):
     
     def wash(self, vol: float, source, mix_reps: int, wash_name: str = "wash"):
         self.logger.info(self.msg_format("wash info", vol, wash_name, mix_reps))
-        self._m300.flow_rate.aspirate = self._default_aspiration_rate
-        dispense_rate = self._m300.flow_rate.dispense
         self._magdeck.disengage()
         num_trans, vol_per_trans = uniform_divide(vol, self._wash_max_transfer_vol)
+        plan = self.reagent_plan.get(wash_name)
+        if plan is None:
+            sources = [self.wash_getcol(i, self.total_cols, source) for i in range(self.total_cols)]
+        else:
+            sources = plan.column_wells
         
-        for i, m in enumerate(self.mag_samples_m):
-            if self.run_stage("{} {}/{}".format(wash_name, i + 1, len(self.mag_samples_m))):
-                self.pick_up(self._m300)
-                src = self.wash_getcol(i, len(self.mag_samples_m), source)
-                
-                for n in range(num_trans):
-                    if self._m300.current_volume > 0:
-                        self._m300.dispense(self._m300.current_volume, src.top())
-                    self._m300.transfer(vol_per_trans, src, m.top(), air_gap=20, new_tip='never')
-                    if n < num_trans - 1:  # only air_gap if going back to source
-                        self._m300.air_gap(self._wash_air_gap)
-                
-                # Mix
-                self._m300.flow_rate.aspirate = self._wash_mix_aspiration_rate
-                self._m300.flow_rate.dispense = self._wash_mix_dispense_rate
-                if self._wash_mix_walk:
-                    a_locs = [m.bottom(self._bottom_headroom_height).move(Point(x=2*(-1 if i % 2 else +1), y=2*(2*j/(mix_reps - 1) - 1))) for j in range(mix_reps)]
-                    mix_walk(self._m300, mix_reps, self._wash_mix_vol, a_locs, speed=self._wash_mix_speed, logger=self.logger)
-                else:
-                    loc = m.bottom(self._bottom_headroom_height).move(Point(x=2*(-1 if i % 2 else +1)))
-                    self._m300.mix(mix_reps, self._wash_mix_vol, loc)
-                self._m300.flow_rate.aspirate = self._default_aspiration_rate
-                self._m300.flow_rate.dispense = dispense_rate
-                
-                self._m300.air_gap(self._wash_air_gap)
-                self.drop(self._m300)
+        with self.liquid(self._m300, wash_name if wash_name in self.liquids else "wash") as wash:
+            for i, m in enumerate(self.mag_samples_m):
+                if self.run_stage("{} {}/{}".format(wash_name, i + 1, len(self.mag_samples_m))):
+                    with self.operations("_m300"):
+                        self.pick_up(self._m300)
+                        src = sources[self._col_offset + i]
+                        
+                        for n in range(num_trans):
+                            if self._m300.current_volume > 0:
+                                self._m300.dispense(self._m300.current_volume, src.top())
+                            self._m300.transfer(vol_per_trans, src, m.top(), air_gap=wash.air_gap, new_tip='never')
+                            if n < num_trans - 1:  # only air_gap if going back to source
+                                self._m300.air_gap(wash.air_gap)
+                        
+                        # Mix
+                        with self.profile(self._m300, "wash-mix"):
+                            if self._wash_mix_walk:
+                                a_locs = [m.bottom(self._bottom_headroom_height).move(Point(x=2*(-1 if i % 2 else +1), y=2*(2*j/(mix_reps - 1) - 1))) for j in range(mix_reps)]
+                                mix_walk(self._m300, mix_reps, self._wash_mix_vol, a_locs, speed=self._wash_mix_speed, logger=self.logger)
+                            else:
+                                loc = m.bottom(self._bottom_headroom_height).move(Point(x=2*(-1 if i % 2 else +1)))
+                                self._m300.mix(mix_reps, self._wash_mix_vol, loc)
+                        
+                        self._m300.air_gap(wash.air_gap)
+                        self.drop(self._m300)
+                    self.record(wash_name.replace(" ", "_"), self.column_wells(m))
         
         self._magdeck.engage(height=self._magheight)
         if self.run_stage("{} incubate".format(wash_name)):
@@ -392,42 +486,50 @@ class StationB(Station):
         """Resuspend beads in elution"""
         if positions is None:
             positions = self.mag_samples_m
-        self._m300.flow_rate.aspirate = self._elute_aspiration_rate
-        for i, m in enumerate(positions):
-            if self.run_stage("{} {}/{}".format(stage, i + 1, len(positions))):
-                self.pick_up(self._m300)
-                side = 1 if i % 2 == 0 else -1
-                loc = m.bottom(self._bottom_headroom_height).move(Point(x=side*2))
-                self._m300.aspirate(self._elution_vol, self.water)
-                self._m300.air_gap(self._elute_air_gap)
-                self._m300.dispense(self._elute_air_gap, m.top())
-                self._m300.dispense(self._elution_vol, loc)
-                self._m300.mix(self._elute_mix_times, self._elute_mix_vol, loc)
-                self._m300.touch_tip(v_offset=self._touch_tip_height)
-                self._m300.air_gap(self._elute_air_gap)
-                self.drop(self._m300)
-        
-        if self._elute_incubate and self.run_stage("{} incubate off".format(stage)):
-            self.delay(self._wait_time_elute_off, self.get_msg_format("incubate on magdeck", self.get_msg("off")))
-        self._magdeck.engage(height=self._magheight)
-        if self._elute_incubate and self.run_stage("{} incubate on".format(stage)):
-            self.delay(self._wait_time_elute_on, self.get_msg_format("incubate on magdeck", self.get_msg("on")))
-        
-        if transfer:
-            for i, (m, e) in enumerate(zip(
-                positions,
-                self.elution_samples_m
-            )):
-                if self.run_stage("{} transfer {}/{}".format(stage, i + 1, len(positions))):
-                    self.pick_up(self._m300)
-                    side = -1 if i % 2 == 0 else 1
-                    loc = m.bottom(self._bottom_headroom_height).move(Point(x=side*2))
-                    self._m300.transfer(self._elution_vol, loc, e.bottom(self._elution_height), air_gap=self._elute_air_gap, new_tip='never')
-                    # m300.blow_out(e.top(-2))
-                    self._m300.air_gap(self._elute_air_gap)
-                    self.drop(self._m300)
+        with self.liquid(self._m300, "elution") as elution:
+            for i, m in enumerate(positions):
+                if self.run_stage("{} {}/{}".format(stage, i + 1, len(positions))):
+                    with self.operations("_m300"):
+                        self.pick_up(self._m300)
+                        side = 1 if i % 2 == 0 else -1
+                        loc = m.bottom(self._bottom_headroom_height).move(Point(x=side*2))
+                        self._m300.aspirate(self._elution_vol, self.water)
+                        self.liquid_delay(elution.aspirate_delay)
+                        self._m300.air_gap(elution.air_gap)
+                        self._m300.dispense(elution.air_gap, m.top())
+                        self._m300.dispense(self._elution_vol, loc)
+                        self.liquid_delay(elution.dispense_delay)
+                        self._m300.mix(self._elute_mix_times, self._elute_mix_vol, loc)
+                        if elution.touch_tip:
+                            self._m300.touch_tip(v_offset=elution.touch_tip_v_offset)
+                        self._m300.air_gap(elution.air_gap)
+                        self.drop(self._m300)
+                    self.record("elute", self.column_wells(m))
+            
+            if self._elute_incubate and self.run_stage("{} incubate off".format(stage)):
+                self.delay(self._wait_time_elute_off, self.get_msg_format("incubate on magdeck", self.get_msg("off")))
+            self._magdeck.engage(height=self._magheight)
+            if self._elute_incubate and self.run_stage("{} incubate on".format(stage)):
+                self.delay(self._wait_time_elute_on, self.get_msg_format("incubate on magdeck", self.get_msg("on")))
+            
+            if transfer:
+                for i, (m, e) in enumerate(zip(
+                    positions,
+                    self.elution_samples_m
+                )):
+                    if self.run_stage("{} transfer {}/{}".format(stage, i + 1, len(positions))):
+                        with self.operations("_m300"):
+                            self.pick_up(self._m300)
+                            side = -1 if i % 2 == 0 else 1
+                            loc = m.bottom(self._bottom_headroom_height).move(Point(x=side*2))
+                            self._m300.transfer(self._elution_vol, loc, e.bottom(self._elution_height), air_gap=elution.air_gap, new_tip='never')
+                            # m300.blow_out(e.top(-2))
+                            self._m300.air_gap(elution.air_gap)
+                            self.drop(self._m300)
+                        self.record("final_transfer", self.column_wells(m))
     
     def body(self):
+        self.log_load_sheet()
         self.bind()
         self.wash(self._wash_1_vol, self.wash1, self._wash_1_times, "wash 1")
         self.wash(self._wash_2_vol, self.wash2, self._wash_2_times, "wash 2")
@@ -437,6 +539,63 @@ class StationB(Station):
             self.delay(self._wait_time_dry, 'airdry')
         self.elute()
         self._magdeck.disengage()
+    
+    def delay(self, mins: float, msg: str = "", *args, **kwargs):
+        if self._scheduler is None:
+            return super(StationB, self).delay(mins, msg, *args, **kwargs)
+        self._scheduler.wait(60 * mins, lambda t: super(StationB, self).delay(round(t / 60, 2), msg, *args, **kwargs))
+    
+    def plate_cols(self, plate_idx: int) -> int:
+        idx = self._plate_idx
+        self._plate_idx = plate_idx
+        try:
+            return self.num_cols
+        finally:
+            self._plate_idx = idx
+    
+    def lane_run_stage(self, plate_idx: int) -> bool:
+        """Whether the lane of a plate runs its stages from the start: the plates before the one of the stage
+        to start at are skipped, as they are when processed one at a time, while the later ones start over"""
+        if self._run_stage:
+            return True
+        m = _stage_plate.match(self._start_at or "")
+        return m is not None and int(m.group(1)) - 1 < plate_idx
+    
+    def _clock(self) -> float:
+        return self._estimator.elapsed if self._ctx.is_simulating() else time.monotonic()
+    
+    def run_plates(self):
+        if self._magdeck2 is None:
+            return super(StationB, self).run_plates()
+        decks = ((self._magdeck, self._magplate, self._magheight), (self._magdeck2, self._magplate2, self._magheight2))
+        for first in range(0, self.num_plates, len(decks)):
+            plates = range(first, min(first + len(decks), self.num_plates))
+            offsets = [sum(map(self.plate_cols, plates[:i])) for i in range(len(plates) + 1)]
+            self._plate_idx = first
+            self._col_offset = 0
+            self._pair_cols = offsets[-1]
+            if first and self.run_stage("swap plates"):
+                self.log_load_sheet()
+                self.dual_pause(self.msg_format("swap plates", first + 1, plates[-1] + 1, self.num_plates))
+            self.log_load_sheet()
+            self._load_sheet_plates.update(plates)
+            lanes = [Lane(i, *decks[i], p, o, self.lane_run_stage(p)) for i, (p, o) in enumerate(zip(plates, offsets))]
+            stage_log = self._stage_log
+            self._scheduler = PipelineScheduler(self, lanes, self._clock)
+            try:
+                self._scheduler.run(self.body)
+            finally:
+                self._magdeck, self._magplate, self._magheight = decks[0]
+                self._col_offset = 0
+                self._pair_cols = None
+                self._stage_log = stage_log
+                self._run_stage = any(lane.state["_run_stage"] for lane in lanes)
+                for lane in lanes:
+                    self._stage_durations += stage_durations(lane.state["_stage_log"], lane.end or self.timestamp(), self.pause_intervals())
+            self._estimator.requested += self._scheduler.requested
+            self._estimator.overlapped += self._scheduler.overlapped
+            self.logger.info(self.msg_format("pipeline gain", self._scheduler.overlapped / 60, self._scheduler.requested / 60))
+            self._scheduler = None
 
 
 if __name__ == "__main__":
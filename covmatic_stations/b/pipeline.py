@@ -0,0 +1,216 @@
+"""Pipelined processing on two magnetic modules.
+Each lane is a plate on its own magnetic module, processed by a thread that runs the usual station
+methods. Only one lane at a time drives the robot: when the running lane has to wait (e.g. while the
+beads separate on the magnet), the lane that is ready first takes over, so that the incubations of
+one plate overlap with the pipetting on the other one.
+The scheduler can be tried with a :py:class:`StandInStation` in place of a station: in each lane, the body
+pipettes for 10 s, incubates for 60 s and pipettes again. The second lane pipettes during the incubation
+of the first one, and each lane sees the plate and the columns of its own state
+    >>> station = StandInStation()
+    >>> lanes = [Lane(i, "magdeck {}".format(i + 1), "plate {}".format(i + 1), 10, i, 6 * i) for i in range(2)]
+    >>> station.scheduler = PipelineScheduler(station, lanes, station.clock)
+    >>> def body():
+    ...     station.work("mix", 10)
+    ...     station.wait(60)
+    ...     station.work("elute", 10)
+    >>> station.scheduler.run(body)
+    >>> station.events
+    [(0, 'mix', 0, 0), (1, 'mix', 6, 10), (0, 'elute', 0, 70), (1, 'elute', 6, 80)]
+    >>> station.scheduler.requested, station.scheduler.overlapped
+    (120.0, 70.0)
+
+An error in a lane stops the other ones at their next handover and is raised by the scheduler
+    >>> station = StandInStation()
+    >>> lanes = [Lane(i, "magdeck {}".format(i + 1), "plate {}".format(i + 1), 10, i, 6 * i) for i in range(2)]
+    >>> station.scheduler = PipelineScheduler(station, lanes, station.clock)
+    >>> def failing():
+    ...     station.work("mix", 10)
+    ...     if station._plate_idx == 1:
+    ...         raise ValueError("plate 2 failed")
+    ...     station.wait(60)
+    ...     station.work("elute", 10)
+    >>> station.scheduler.run(failing)
+    Traceback (most recent call last):
+    ...
+    ValueError: plate 2 failed
+    >>> station.events
+    [(0, 'mix', 0, 0), (1, 'mix', 6, 10)]
+    >>> all(lane.end is not None for lane in lanes)
+    True"""
+from contextlib import contextmanager
+from threading import Condition, Thread
+from typing import Callable, List, Optional, Tuple
+
+
+class Lane:
+    def __init__(self, index: int, magdeck, magplate, magheight: float, plate_idx: int, col_offset: int, run_stage: bool = True):
+        """ Build a :py:class:`.Lane`.
+        :param index: index of the lane
+        :param magdeck: magnetic module of the lane
+        :param magplate: plate on the magnetic module
+        :param magheight: engage height of the magnetic module
+        :param plate_idx: index of the plate in the plate set
+        :param col_offset: first column of the lane in the shared labware (reagents and elution plate)
+        :param run_stage: whether the stages of the lane run from the start, or only from the stage to start at
+        """
+        self.index = index
+        self.ready_at = 0.
+        self.finished = False
+        self.end: Optional[float] = None
+        # The stages are tracked per lane: the stage to start at and the stage log refer to one plate
+        self.state = {
+            "_magdeck": magdeck,
+            "_magplate": magplate,
+            "_magheight": magheight,
+            "_plate_idx": plate_idx,
+            "_col_offset": col_offset,
+            "_run_stage": run_stage,
+            "_stage_log": [],
+            "_stage_name": "",
+            "stage": None,
+        }
+
+
+class LaneAborted(Exception):
+    pass
+
+
+class StandInStation:
+    """Stand-in for a station driven by a :py:class:`PipelineScheduler`, with a clock that only advances
+    with its work and its waits, recording the work of each lane"""
+    def __init__(self):
+        self.now = 0
+        self.events: List[Tuple[int, str, int, float]] = []
+        self.instruments = {}
+        self.scheduler: Optional[PipelineScheduler] = None
+        self._magdeck = self._magplate = None
+        self._magheight = 0.
+        self._plate_idx = self._col_offset = 0
+        self._run_stage = True
+        self._stage_log = []
+        self._stage_name = ""
+        self.stage = None
+    
+    def clock(self) -> float:
+        return self.now
+    
+    def timestamp(self) -> float:
+        return self.now
+    
+    @contextmanager
+    def abortable(self, threads):
+        yield
+    
+    def work(self, what: str, seconds: float):
+        """Record some work on the plate of the current lane"""
+        self.events.append((self._plate_idx, what, self._col_offset, self.now))
+        self.now += seconds
+    
+    def wait(self, seconds: float):
+        self.scheduler.wait(seconds, self.delay)
+    
+    def delay(self, seconds: float):
+        self.now += seconds
+
+
+class PipelineScheduler:
+    def __init__(self, station, lanes: List[Lane], clock: Callable[[], float], min_wait: float = 1):
+        """ Build a :py:class:`.PipelineScheduler`.
+        :param station: the station whose methods are run by the lanes
+        :param lanes: the lanes to interleave
+        :param clock: current time in seconds (e.g. time.monotonic, or an estimator while simulating)
+        :param min_wait: residual waits shorter than this (in seconds) are skipped
+        """
+        self._station = station
+        self.lanes = lanes
+        self._clock = clock
+        self._min_wait = min_wait
+        self._cond = Condition()
+        self._current: Optional[Lane] = None
+        self._error: Optional[BaseException] = None
+        self.requested = 0.
+        self.waited = 0.
+    
+    @property
+    def overlapped(self) -> float:
+        """Waiting time in seconds that was spent working on other lanes"""
+        return self.requested - self.waited
+    
+    def run(self, target: Callable[[], None]):
+        threads = [Thread(target=self._run_lane, args=(lane, target)) for lane in self.lanes]
+        with self._station.abortable(threads):
+            for t in threads:
+                t.start()
+            self._handover(self.lanes[0])
+            for t in threads:
+                t.join()
+        if self._error is not None:
+            raise self._error
+    
+    def wait(self, seconds: float, delay: Callable[[float], None]):
+        """Wait in the current lane, letting other lanes work in the meantime
+        :param seconds: time to wait
+        :param delay: function that actually waits the residual time"""
+        lane = self._current
+        self.requested += seconds
+        lane.ready_at = self._clock() + seconds
+        nxt = self._next_lane()
+        if nxt is not lane:
+            self._save(lane)
+            self._handover(nxt)
+            self._acquire(lane)
+        remaining = lane.ready_at - self._clock()
+        if remaining >= self._min_wait:
+            self.waited += remaining
+            delay(remaining)
+    
+    def _next_lane(self) -> Optional[Lane]:
+        lanes = [lane for lane in self.lanes if not lane.finished]
+        return min(lanes, key=lambda lane: lane.ready_at) if lanes else None
+    
+    def _handover(self, lane: Optional[Lane]):
+        with self._cond:
+            self._current = lane
+            self._cond.notify_all()
+    
+    def _acquire(self, lane: Lane):
+        with self._cond:
+            self._cond.wait_for(lambda: self._current is lane or self._error is not None)
+        if self._error is not None:
+            raise LaneAborted()
+        self._restore(lane)
+    
+    def _pipettes(self) -> list:
+        return list(self._station.instruments.values())
+    
+    def _save(self, lane: Lane):
+        lane.state = {k: getattr(self._station, k) for k in lane.state}
+        lane.flow_rates = [(p.flow_rate.aspirate, p.flow_rate.dispense, p.flow_rate.blow_out) for p in self._pipettes()]
+    
+    def _restore(self, lane: Lane):
+        for k, v in lane.state.items():
+            setattr(self._station, k, v)
+        for p, (a, d, b) in zip(self._pipettes(), getattr(lane, "flow_rates", [])):
+            p.flow_rate.aspirate = a
+            p.flow_rate.dispense = d
+            p.flow_rate.blow_out = b
+    
+    def _run_lane(self, lane: Lane, target: Callable[[], None]):
+        try:
+            self._acquire(lane)
+            target()
+        except LaneAborted:
+            lane.end = self._station.timestamp()
+            return
+        except BaseException as e:
+            self._error = e
+        lane.finished = True
+        lane.end = self._station.timestamp()
+        self._save(lane)
+        self._handover(None if self._error is not None else self._next_lane())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
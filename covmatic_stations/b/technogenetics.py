@@ -1,5 +1,6 @@
 from .b import StationB, labware_loader
 from typing import Tuple
+from ..profiles import Profile
 from ..utils import uniform_divide
 from opentrons.types import Point
 
@@ -94,14 +95,23 @@ class StationBTechnogenetics(StationB):
     
     @property
     def pcr_samples_m(self):
-        return self._flatplate.rows()[0][:self.num_cols]
+        return self._flatplate.rows()[0][self._col_offset:self._col_offset + self.num_cols]
     
     @property
     def temp_samples_m(self):
-        return self._tempplate.rows()[0][:self.num_cols]
+        return self._tempplate.rows()[0][self._col_offset:self._col_offset + self.num_cols]
     
     def load_etoh(self): pass
     
+    def profiles(self):
+        return dict(
+            super(StationBTechnogenetics, self).profiles(),
+            **{
+                "sample-mix": Profile(aspirate=94),
+                "final-transfer": Profile(aspirate=self._final_transfer_rate_aspirate, dispense=self._final_transfer_rate_dispense),
+            }
+        )
+    
     @property
     def wash1(self):
         return self._res12.wells()[:6]
@@ -122,14 +132,23 @@ class StationBTechnogenetics(StationB):
     def wash_getcol(sample_col_idx: int, wash_cols: int, source):
         return source[sample_col_idx // 2]
     
+    def reagent_requirements(self):
+        return [
+            self._column_requirement("wash 1", self.wash1, self._wash_1_vol),
+            self._column_requirement("wash 2", self.wash2, self._wash_2_vol),
+            self._column_requirement("elution buffer", [self.water], self._elution_vol),
+        ]
+    
     def mix_samples(self):
-        self._m300.flow_rate.aspirate = 94
-        for i, m in enumerate(self.mag_samples_m):
-            if self.run_stage("mix sample {}/{}".format(i + 1, len(self.mag_samples_m))):
-                self.pick_up(self._m300)
-                self._m300.mix(self._sample_mix_times, self._sample_mix_vol, m.bottom(self._sample_mix_height))
-                self._m300.air_gap(self._bind_air_gap)
-                self.drop(self._m300)
+        with self.profile(self._m300, "sample-mix"):
+            for i, m in enumerate(self.mag_samples_m):
+                if self.run_stage("mix sample {}/{}".format(i + 1, len(self.mag_samples_m))):
+                    with self.operations("_m300"):
+                        self.pick_up(self._m300)
+                        self._m300.mix(self._sample_mix_times, self._sample_mix_vol, m.bottom(self._sample_mix_height))
+                        self._m300.air_gap(self._bind_air_gap)
+                        self.drop(self._m300)
+                    self.record("bind", self.column_wells(m))
     
     def elute(self, positions=None, transfer: bool = False, stage: str = "elute"):
         if positions is None:
@@ -140,40 +159,39 @@ class StationBTechnogenetics(StationB):
     
     def remove_wash(self, vol):
         self._magdeck.engage(height=self._magheight)
-        self._m300.flow_rate.aspirate = self._supernatant_removal_aspiration_rate
-        num_trans, vol_per_trans = uniform_divide(vol, self._wash_max_transfer_vol)
-        
-        for i, m in enumerate(self.mag_samples_m):
-            if self.run_stage("remove wash {}/{}".format(i + 1, len(self.mag_samples_m))):
-                self.pick_up(self._m300)
-                for _ in range(num_trans):
-                    if self._m300.current_volume > 0:
-                        self._m300.dispense(self._m300.current_volume, m.top())  # void air gap if necessary
-                    self._m300.move_to(m.center())
-                    self._m300.transfer(vol_per_trans, m.bottom(self._supernatant_removal_height), self._waste, air_gap=self._supernatant_removal_air_gap, new_tip='never')
-                    self._m300.air_gap(self._supernatant_removal_air_gap)
-                self.drop(self._m300)
-        self._m300.flow_rate.aspirate = self._default_aspiration_rate
+        with self.liquid(self._m300, "supernatant") as supernatant:
+            num_trans, vol_per_trans = uniform_divide(vol, self._wash_max_transfer_vol)
+            
+            for i, m in enumerate(self.mag_samples_m):
+                if self.run_stage("remove wash {}/{}".format(i + 1, len(self.mag_samples_m))):
+                    with self.operations("_m300"):
+                        self.pick_up(self._m300)
+                        for _ in range(num_trans):
+                            if self._m300.current_volume > 0:
+                                self._m300.dispense(self._m300.current_volume, m.top())  # void air gap if necessary
+                            self._m300.move_to(m.center())
+                            self._m300.transfer(vol_per_trans, m.bottom(self._supernatant_removal_height), self._waste, air_gap=supernatant.air_gap, new_tip='never')
+                            self._m300.air_gap(supernatant.air_gap)
+                        self.drop(self._m300)
         self._magdeck.disengage()
     
     def final_transfer(self):
-        self._m300.flow_rate.aspirate = self._final_transfer_rate_aspirate
-        self._m300.flow_rate.dispense = self._final_transfer_rate_dispense
-        n = len(list(zip(self.mag_samples_m, self.pcr_samples_m)))
-        for i, (m, e) in enumerate(zip(self.mag_samples_m, self.pcr_samples_m)):
-            if self.run_stage("final transfer {}/{}".format(i + 1, n)):
-                self.pick_up(self._m300)
-                side = -1 if i % 2 == 0 else 1
-                loc = m.bottom(0.3).move(Point(x=side*2))
-                self._m300.transfer(self._final_vol, loc, e.bottom(self._elution_height), air_gap=self._elute_air_gap, new_tip='never')
-                self._m300.mix(self._final_mix_times, self._final_mix_vol, e.bottom(self._final_mix_height))
-                self._m300.air_gap(self._elute_air_gap)
-                self.drop(self._m300)
+        with self.profile(self._m300, "final-transfer"):
+            n = len(list(zip(self.mag_samples_m, self.pcr_samples_m)))
+            for i, (m, e) in enumerate(zip(self.mag_samples_m, self.pcr_samples_m)):
+                if self.run_stage("final transfer {}/{}".format(i + 1, n)):
+                    with self.operations("_m300"):
+                        self.pick_up(self._m300)
+                        side = -1 if i % 2 == 0 else 1
+                        loc = m.bottom(0.3).move(Point(x=side*2))
+                        self._m300.transfer(self._final_vol, loc, e.bottom(self._elution_height), air_gap=self._elute_air_gap, new_tip='never')
+                        self._m300.mix(self._final_mix_times, self._final_mix_vol, e.bottom(self._final_mix_height))
+                        self._m300.air_gap(self._elute_air_gap)
+                        self.drop(self._m300)
+                    self.record("final_transfer", self.column_wells(m))
     
     def body(self):
-        self.logger.info(self.get_msg_format("volume", "wash 1", self._wash_headroom * self._wash_1_vol * self._num_samples / 1000))
-        self.logger.info(self.get_msg_format("volume", "wash 2", self._wash_headroom * self._wash_2_vol * self._num_samples / 1000))
-        self.logger.info(self.get_msg_format("volume", "elution buffer", self._wash_headroom * self._elution_vol * self._num_samples / 1000))
+        self.log_load_sheet()
         self.mix_samples()
         
         if self.run_stage("mix incubate on"):
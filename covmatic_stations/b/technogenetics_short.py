@@ -44,6 +44,9 @@ class StationBTechnogeneticsShort(StationBTechnogenetics):
     def load_elut12(self):
         pass
     
+    def reagent_requirements(self):
+        return []
+    
     @property
     def transfer_dest(self):
         return (e.bottom(self._elution_height) for e in self.pcr_samples_m)
@@ -52,13 +55,13 @@ class StationBTechnogeneticsShort(StationBTechnogenetics):
         if self.run_stage("{} {}/{}".format(stage, idx + 1, self._num_cycles)):
             self._magdeck.engage(height=self._magheight)
             self.delay(2, self.get_msg_format("incubate on magdeck", self.get_msg("on")))
-            for i, (m, e) in enumerate(zip(self.mag_samples_m, self.transfer_dest)):
-                self.pick_up(self._m300)
-                self._m300.flow_rate.aspirate = self._elute_aspiration_rate
-                self._m300.transfer(self._elution_vol, m.bottom(self._bottom_headroom_height), e, air_gap=self._elute_air_gap, new_tip='never')
-                if self._air_gap_drop:
-                    self._m300.air_gap(self._air_gap_drop)
-                self.drop(self._m300)
+            with self.liquid(self._m300, "elution") as elution:
+                for i, (m, e) in enumerate(zip(self.mag_samples_m, self.transfer_dest)):
+                    self.pick_up(self._m300)
+                    self._m300.transfer(self._elution_vol, m.bottom(self._bottom_headroom_height), e, air_gap=elution.air_gap, new_tip='never')
+                    if self._air_gap_drop:
+                        self._m300.air_gap(self._air_gap_drop)
+                    self.drop(self._m300)
             
             self._magdeck.disengage()
             
@@ -0,0 +1,291 @@
+"""Protocol benchmark suite.
+Simulates every station class, and the station of every protocol in the protocols folder,
+over a sweep of sample counts (plus full plate sets for the stations processing more plates in a run).
+Each run records the simulation wall time, the commands by type, the tips picked up from each rack,
+the pauses and the estimated robot time. Results are saved as a JSON baseline, to be compared
+with the one of another commit, e.g.
+    python -m covmatic_stations.benchmark run -o baseline.json
+    git checkout <commit>
+    python -m covmatic_stations.benchmark run -o current.json
+    python -m covmatic_stations.benchmark compare baseline.json current.json
+The speedup command times the protocols with and without the fast simulation mode"""
+from . import __version__
+from .station import Station
+from opentrons import simulate
+from opentrons.commands import types as command_types
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+
+API_LEVEL = '2.3'
+SAMPLE_COUNTS = (8, 24, 48, 72, 96)
+PLATE_SETS = (2,)
+STATIONS = (
+    "covmatic_stations.a.a.StationA",
+    "covmatic_stations.a.p300.StationAP300",
+    "covmatic_stations.a.p1000.StationAP1000",
+    "covmatic_stations.a.reload.StationAReload",
+    "covmatic_stations.a.p1000reload.StationAP1000Reload",
+    "covmatic_stations.a.technogenetics.StationATechnogenetics",
+    "covmatic_stations.a.technogenetics.StationATechnogeneticsReload",
+    "covmatic_stations.a.technogenetics.StationATechnogenetics24",
+    "covmatic_stations.a.technogenetics.StationATechnogenetics48",
+    "covmatic_stations.b.b.StationB",
+    "covmatic_stations.b.technogenetics.StationBTechnogenetics",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsShort",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsElutionRemoval",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsWashBRemoval",
+    "covmatic_stations.c.c.StationC",
+    "covmatic_stations.c.technogenetics.StationCTechnogenetics",
+    "covmatic_stations.c.technogenetics.StationCTechnogeneticsM300",
+)
+PROTOCOLS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "protocols")
+# Metrics compared between baselines, with the relative tolerance key
+METRICS = OrderedDict([
+    ("estimated_time", "tolerance"),
+    ("pauses", "tolerance"),
+    ("tips", "tolerance"),
+    ("commands", "tolerance"),
+    ("wall_time", "wall_tolerance"),
+])
+
+
+def import_station(name: str) -> type:
+    """Import a station class from its dotted path"""
+    module, cls = name.rsplit(".", 1)
+    return getattr(importlib.import_module(module), cls)
+
+
+def protocol_station(fp: str) -> Tuple[type, dict]:
+    """Station class and keyword arguments of a protocol file"""
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(fp))[0], fp)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return type(module.station), dict(module.station._init_kwargs)
+
+
+def targets(stations: Iterable[str] = STATIONS, protocols_dir: Optional[str] = PROTOCOLS_DIR) -> Dict[str, Tuple[type, dict]]:
+    """Benchmark targets: station classes with their keyword arguments, by name"""
+    t = OrderedDict((name, (import_station(name), {})) for name in stations)
+    if protocols_dir and os.path.isdir(protocols_dir):
+        for f in sorted(os.listdir(protocols_dir)):
+            if f.endswith(".py"):
+                t["protocols/{}".format(f)] = protocol_station(os.path.join(protocols_dir, f))
+    return t
+
+
+def sample_counts(cls: type, counts: Iterable[int] = SAMPLE_COUNTS, plate_sets: Iterable[int] = PLATE_SETS) -> List[int]:
+    """Sample counts to benchmark for a station class"""
+    counts = list(counts)
+    if cls._multi_plate:
+        counts += [n * Station._plate_capacity for n in plate_sets]
+    return counts
+
+
+def _rack(location) -> str:
+    well = getattr(location, 'labware', location)
+    return str(getattr(well, 'parent', well))
+
+
+def measure(cls: type, **kwargs) -> dict:
+    """Simulate a station and collect its metrics
+    :param cls: the station class
+    :param kwargs: keyword arguments for the station"""
+    station = cls(**dict(kwargs, metadata={'apiLevel': API_LEVEL}, tip_track=False))
+    ctx = simulate.get_protocol_api(API_LEVEL)
+    commands = Counter()
+    tips = Counter()
+    
+    def count(message: dict):
+        if message['$'] != 'before':
+            return
+        commands[message['name']] += 1
+        if message['name'] == command_types.PICK_UP_TIP:
+            tips[_rack(message['payload']['location'])] += 1
+    
+    ctx.broker.subscribe(command_types.COMMAND, count)
+    t = time.perf_counter()
+    station.run(ctx)
+    return {
+        "num_samples": station._num_samples,
+        "wall_time": time.perf_counter() - t,
+        "estimated_time": station._estimator.elapsed,
+        "pauses": station._estimator.pauses,
+        "overlapped_time": station._estimator.overlapped,
+        "commands": dict(commands),
+        "tips": dict(tips),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    benchmark_targets: Optional[Dict[str, Tuple[type, dict]]] = None,
+    counts: Iterable[int] = SAMPLE_COUNTS,
+    plate_sets: Iterable[int] = PLATE_SETS,
+    logger: Optional[logging.Logger] = None,
+) -> dict:
+    """Run the benchmark suite. Failing runs are recorded with their error
+    :param benchmark_targets: station classes with their keyword arguments, by name. Defaults to :py:func:`targets`
+    :param counts: sample counts
+    :param plate_sets: numbers of plates, for the stations processing more plates in a run
+    :param logger: logger for the progress
+    :return: the baseline"""
+    logger = logger or logging.getLogger(__name__)
+    benchmark_targets = targets() if benchmark_targets is None else benchmark_targets
+    counts = list(counts)
+    plate_sets = list(plate_sets)
+    results = OrderedDict()
+    for name, (cls, kwargs) in benchmark_targets.items():
+        # Keep the station logs quiet
+        logging.getLogger(cls.__name__).setLevel(logging.WARNING)
+        results[name] = OrderedDict()
+        for n in sample_counts(cls, counts, plate_sets):
+            try:
+                r = measure(cls, **dict(kwargs, num_samples=n))
+            except Exception as e:
+                r = {"error": "{}: {}".format(type(e).__name__, e)}
+                logger.warning("{} ({} samples) failed: {}".format(name, n, r["error"]))
+            else:
+                logger.info("{} ({} samples): {:.1f} s, estimated {:.0f} min".format(name, n, r["wall_time"], r["estimated_time"] / 60))
+            results[name][str(n)] = r
+    return {
+        "version": __version__,
+        "commit": git_commit(),
+        "python": sys.version.split(" ")[0],
+        "results": results,
+    }
+
+
+def fast_simulation_speedup(
+    benchmark_targets: Optional[Dict[str, Tuple[type, dict]]] = None,
+    repeats: int = 1,
+    logger: Optional[logging.Logger] = None,
+) -> Dict[str, dict]:
+    """Time the stations with and without the fast simulation mode, keeping the best of the repeats
+    :param benchmark_targets: station classes with their keyword arguments, by name. Defaults to the protocols
+    :param repeats: runs for each mode
+    :param logger: logger for the progress
+    :return: the wall times and the speedup, by name"""
+    logger = logger or logging.getLogger(__name__)
+    benchmark_targets = targets(stations=()) if benchmark_targets is None else benchmark_targets
+    results = OrderedDict()
+    for name, (cls, kwargs) in benchmark_targets.items():
+        logging.getLogger(cls.__name__).setLevel(logging.WARNING)
+        normal = min(measure(cls, **kwargs)["wall_time"] for _ in range(repeats))
+        fast = min(measure(cls, **dict(kwargs, fast_simulation=True))["wall_time"] for _ in range(repeats))
+        results[name] = {"wall_time": normal, "fast_wall_time": fast, "speedup": normal / fast}
+        logger.info("{}: {:.2f} s -> {:.2f} s ({:.2f}x)".format(name, normal, fast, normal / fast))
+    return results
+
+
+def _value(result: dict, metric: str) -> float:
+    v = result[metric]
+    return sum(v.values()) if isinstance(v, dict) else v
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.01, wall_tolerance: float = 0.5) -> Tuple[List[str], List[str]]:
+    """Compare two baselines run by run
+    :param baseline: the reference baseline
+    :param current: the baseline to check
+    :param tolerance: relative increase allowed for the robot metrics (time, pauses, tips and commands)
+    :param wall_tolerance: relative increase allowed for the simulation wall time
+    :return: the regressions and the improvements, as report lines"""
+    tolerances = {"tolerance": tolerance, "wall_tolerance": wall_tolerance}
+    regressions = []
+    improvements = []
+    for name, runs in current["results"].items():
+        for n, r in runs.items():
+            b = baseline["results"].get(name, {}).get(n)
+            if b is None:
+                continue
+            label = "{} ({} samples)".format(name, n)
+            if "error" in r:
+                if "error" not in b:
+                    regressions.append("{}: {}".format(label, r["error"]))
+                continue
+            if "error" in b:
+                improvements.append("{}: fixed".format(label))
+                continue
+            for metric, key in METRICS.items():
+                old, new = _value(b, metric), _value(r, metric)
+                if old == new:
+                    continue
+                line = "{} {}: {:.6g} -> {:.6g} ({:+.1%})".format(label, metric, old, new, (new - old) / old if old else float("inf"))
+                if new > old * (1 + tolerances[key]):
+                    regressions.append(line)
+                elif new < old:
+                    improvements.append(line)
+    return regressions, improvements
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command")
+    run_parser = sub.add_parser("run", help="run the benchmark suite")
+    run_parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="the file path where to save the baseline JSON")
+    run_parser.add_argument("-n", "--samples", type=int, nargs="+", default=SAMPLE_COUNTS, help="sample counts")
+    run_parser.add_argument("-p", "--plates", type=int, nargs="*", default=PLATE_SETS, help="plate set sizes for the multi-plate stations")
+    run_parser.add_argument("-k", "--filter", type=str, default="", help="only run the targets whose name contains this string")
+    speedup_parser = sub.add_parser("speedup", help="time the protocols with and without the fast simulation mode")
+    speedup_parser.add_argument("-k", "--filter", type=str, default="", help="only run the protocols whose name contains this string")
+    speedup_parser.add_argument("-r", "--repeats", type=int, default=1, help="runs for each mode")
+    compare_parser = sub.add_parser("compare", help="compare two baselines")
+    compare_parser.add_argument("baseline", type=str, help="the reference baseline JSON")
+    compare_parser.add_argument("current", type=str, help="the baseline JSON to check")
+    compare_parser.add_argument("-t", "--tolerance", type=float, default=0.01, help="relative increase allowed for the robot metrics")
+    compare_parser.add_argument("-w", "--wall-tolerance", type=float, default=0.5, help="relative increase allowed for the simulation wall time")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
+    if args.command == "run":
+        t = OrderedDict((k, v) for k, v in targets().items() if args.filter in k)
+        with open(args.output, "w") as f:
+            json.dump(run(t, args.samples, args.plates), f, indent=2)
+        return 0
+    if args.command == "speedup":
+        t = OrderedDict((k, v) for k, v in targets(stations=()).items() if args.filter in k)
+        fast_simulation_speedup(t, args.repeats)
+        return 0
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions, improvements = compare(baseline, current, args.tolerance, args.wall_tolerance)
+        print("comparing {} with {}".format(current.get("commit") or args.current, baseline.get("commit") or args.baseline))
+        for title, lines in (("improvements", improvements), ("regressions", regressions)):
+            print("{} {}".format(len(lines), title))
+            for line in lines:
+                print("  " + line)
+        return 1 if regressions else 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
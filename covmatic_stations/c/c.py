@@ -1,13 +1,19 @@
 from ..station import Station, labware_loader, instrument_loader
+from ..liquids import LiquidClass
 from itertools import chain
 import math
 import logging
 from itertools import repeat
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
+import json
+import os
 
 
 class StationC(Station):
     _protocol_description = "station C protocol"
+    _passport_fields = ("positive_control_well",)
+    # Row and column offsets of the quadrants of a 384-well plate, in order of use (A1, B1, A2, B2)
+    _quadrants: Tuple[Tuple[int, int], ...] = ((0, 0), (1, 0), (0, 1), (1, 1))
     
     def __init__(
         self,
@@ -22,6 +28,9 @@ class StationC(Station):
         mastermix_vol_headroom_aspirate: float = 20/18,
         metadata: Optional[dict] = None,
         num_samples: int = 96,
+        pcr_plate_384: bool = False,
+        pcr_plate_384_model: str = 'covmatic_384_aluminumblock_biorad_wellplate_50ul',
+        pcr_plate_384_definition_filepath: str = os.path.join(os.path.split(__file__)[0], "covmatic_384_aluminumblock_biorad_wellplate_50ul.json"),
         positive_control_well: str = 'A10',
         sample_blow_height: float = -2,
         sample_bottom_height: float = 2,
@@ -29,7 +38,7 @@ class StationC(Station):
         sample_mix_reps: int = 1,
         sample_vol: float = 8,
         samples_per_col: int = 8,
-        samples_per_cycle: int = 96,
+        samples_per_cycle: Optional[int] = None,
         skip_delay: bool = False,
         source_plate_name: str = 'chilled elution plate on block from Station B',
         suck_height: float = 2,
@@ -50,6 +59,10 @@ class StationC(Station):
         :param mastermix_vol_headroom_aspirate: Headroom for mastermix aspiration volume as a divisor
         :param metadata: protocol metadata
         :param num_samples: The number of samples that will be loaded on the station B
+        :param pcr_plate_384: Whether to use a 384-well PCR plate. Each quadrant (A1, B1, A2, B2) receives the samples of one source plate
+        :param pcr_plate_384_model: Labware model of the 384-well PCR plate in its aluminum block on the temperature module
+        :param pcr_plate_384_definition_filepath: Labware definition of the 384-well PCR plate in its aluminum block, used if the model is not installed on the robot.
+        The default one raises the plate by the height of the 96-well aluminum block
         :param positive_control_well: Position of the positive control well
         :param sample_blow_height: Height from the top when blowing out in mm (should be negative)
         :param sample_bottom_height: Height to keep from the bottom in mm when dealing with samples
@@ -57,7 +70,7 @@ class StationC(Station):
         :param sample_mix_reps: Samples mixing repetitions 
         :param sample_vol: Sample volume
         :param samples_per_col: The number of samples in a column of the destination plate
-        :param samples_per_cycle: The number of samples processable in one cycle
+        :param samples_per_cycle: The number of samples processable in one cycle. If not specified, the capacity of the PCR plate is used
         :param source_plate_name: Name for the source plate
         :param skip_delay: If True, pause instead of delay.
         :param suck_height: Height from the top when sucking in any remaining droplets on way to trash in mm
@@ -81,13 +94,16 @@ class StationC(Station):
         self._mastermix_vol = mastermix_vol
         self._mastermix_vol_headroom = mastermix_vol_headroom
         self._mastermix_vol_headroom_aspirate = mastermix_vol_headroom_aspirate
+        self._pcr_plate_384 = pcr_plate_384
+        self._pcr_plate_384_model = pcr_plate_384_model
+        self._pcr_plate_384_definition_filepath = pcr_plate_384_definition_filepath
         self._positive_control_well = positive_control_well
         self._sample_blow_height = sample_blow_height
         self._sample_bottom_height = sample_bottom_height
         self._sample_mix_vol = sample_mix_vol
         self._sample_mix_reps = sample_mix_reps
         self._sample_vol = sample_vol
-        self._samples_per_cycle = int(math.ceil(samples_per_cycle / 8) * 8)
+        self._samples_per_cycle = int(math.ceil((samples_per_cycle or self.pcr_plate_capacity) / 8) * 8)
         self._source_plate_name = source_plate_name
         self._suck_height = suck_height
         self._suck_vol = suck_vol
@@ -97,6 +113,11 @@ class StationC(Station):
         
         self._remaining_samples = self._num_samples
         self._samples_this_cycle = min(self._remaining_samples, self._samples_per_cycle)
+        self._source_plate_offset = 0
+    
+    @property
+    def pcr_plate_capacity(self) -> int:
+        return 384 if self._pcr_plate_384 else 96
     
     @property
     def num_cycles(self) -> int:
@@ -124,10 +145,19 @@ class StationC(Station):
     @labware_loader(4, "_tempdeck")
     def load_tempdeck(self):
         self._tempdeck = self._ctx.load_module('Temperature Module Gen2', '4')
-
+    
     @labware_loader(5, "_pcr_plate")
     def load_pcr_plate(self):
-        self._pcr_plate = self._tempdeck.load_labware('opentrons_96_aluminumblock_biorad_wellplate_200ul', 'PCR plate')
+        if not self._pcr_plate_384:
+            self._pcr_plate = self._tempdeck.load_labware('opentrons_96_aluminumblock_biorad_wellplate_200ul', 'PCR plate')
+            return
+        try:
+            self._pcr_plate = self._tempdeck.load_labware(self._pcr_plate_384_model, 'PCR plate')
+        except FileNotFoundError:
+            # The block and plate definition is custom labware, shipped with the package
+            with open(self._pcr_plate_384_definition_filepath) as labware_file:
+                labware_def = json.load(labware_file)
+            self._pcr_plate = self._tempdeck.load_labware_from_definition(labware_def, 'PCR plate')
         
     @labware_loader(6, "_mm_strips")
     def load_mm_strips(self):
@@ -145,13 +175,25 @@ class StationC(Station):
     def load_p300(self):
         self._p300 = self._ctx.load_instrument('p300_single_gen2', 'left', tip_racks=self._tips300)
     
+    @property
+    def source_cols(self) -> int:
+        return len(self._source_plate.rows()[0])
+    
     @property
     def sources(self):
-        return self._source_plate.rows()[0][:self.num_cols]
+        """Source column for each destination column. A new source plate is loaded every source_cols columns"""
+        return [self._source_plate.rows()[0][i % self.source_cols] for i in range(self.num_cols)]
     
     @property
     def sample_dests(self):
-        return self._pcr_plate.rows()[0][:self.num_cols]
+        rows = self._pcr_plate.rows()
+        if not self._pcr_plate_384:
+            return rows[0][:self.num_cols]
+        # The multichannel reaches every other row: each quadrant is addressed from its first well
+        return [rows[r][2 * j + c] for r, c in self._quadrants for j in range(len(rows[0]) // 2)][:self.num_cols]
+    
+    def liquid_classes(self):
+        return dict(super(StationC, self).liquid_classes(), mastermix=LiquidClass())
     
     def _tipracks(self) -> dict:
         return {
@@ -163,51 +205,67 @@ class StationC(Station):
     def pick_up_no_a(self):
         self.pick_up(self._m20, tiprack="_tips20_no_a")
         
+    @property
+    def num_mm_strips(self) -> int:
+        """Number of strip columns for the mastermix of the cycle, each filled from its own tube"""
+        capacity = min(self._mm_strips.wells()[0].max_volume, self._tube_block.wells()[0].max_volume / len(self._mm_strips.columns()[0]))
+        return int(math.ceil(self.remaining_cols * self._mastermix_vol / capacity))
+    
     @property
     def mm_tubes(self):
-        return self._tube_block.wells()[:1]
+        return self._tube_block.wells()[:self.num_mm_strips]
     
     @property
     def mm_strips(self):
-        return self._mm_strips.columns()[:1]
+        return self._mm_strips.columns()[:self.num_mm_strips]
     
     @property
     def remaining_cols(self) -> int: 
         return int(math.ceil(min(self._remaining_samples, self._samples_per_cycle) / self._m20.channels))
     
     def fill_mm_strips(self):
-        vol_per_strip_well = self.remaining_cols * self._mastermix_vol / len(self.mm_strips)
+        strip_cols = self.mm_indices[::self._m20.channels]
+        if len(self.mm_strips) < len(set(strip_cols)) or len(self.mm_tubes) < len(self.mm_strips):
+            raise ValueError("mastermix needs {} strips, only {} strips and {} tubes available".format(len(set(strip_cols)), len(self.mm_strips), len(self.mm_tubes)))
         
         has_tip = False        
-        for j, (strip, tube) in enumerate(zip(self.mm_strips, self.mm_tubes)):
-            for i, well in enumerate(strip):
-                if self.run_stage("transfer mastermix {}/{} to strip {}/{}{}{}".format(i + 1, len(strip), j + 1, len(self.mm_strips), " " if self.num_cycles > 1 else "", self._cycle)):
-                    if not has_tip:
-                        self.pick_up(self._p300)
-                        has_tip = True
-                    self.logger.debug("filling mastermix at {}".format(well))
-                    self._p300.transfer(vol_per_strip_well, tube, well, new_tip='never')
+        with self.liquid(self._p300, "mastermix") as mastermix:
+            for j, (strip, tube) in enumerate(zip(self.mm_strips, self.mm_tubes)):
+                vol_per_strip_well = strip_cols.count(j) * self._mastermix_vol
+                if vol_per_strip_well > strip[0].max_volume:
+                    raise ValueError("mastermix strip {} needs {:.1f} uL per well, more than the {:.1f} uL it holds".format(j + 1, vol_per_strip_well, strip[0].max_volume))
+                for i, well in enumerate(strip):
+                    if self.run_stage("transfer mastermix {}/{} to strip {}/{}{}{}".format(i + 1, len(strip), j + 1, len(self.mm_strips), " " if self.num_cycles > 1 else "", self._cycle)):
+                        if not has_tip:
+                            self.pick_up(self._p300)
+                            has_tip = True
+                        self.logger.debug("filling mastermix at %s", well)
+                        self._p300.transfer(vol_per_strip_well, tube, well, air_gap=mastermix.air_gap, new_tip='never')
         if has_tip:
             self._p300.drop_tip()
     
     @property
     def mm_indices(self):
-        return list(repeat(0, self._samples_per_cycle))
+        """Mastermix strip of each sample of the cycle: the columns are split evenly among the strips"""
+        cols = self.remaining_cols
+        return list(chain.from_iterable(repeat(i * self.num_mm_strips // cols, self._m20.channels) for i in range(cols)))
     
     def transfer_mm(self, stage="transfer mastermix {}/{}"):
         has_tip = False
         n = len(list(zip(self.mm_indices[::self._m20.channels], self.sample_dests[:self.remaining_cols])))
-        for i, (m_idx, s) in enumerate(zip(self.mm_indices[::self._m20.channels], self.sample_dests[:self.remaining_cols])):
-            if self.run_stage(stage.format(i + 1, n)):
-                if not has_tip:
-                    self.pick_up(self._m20)
-                    has_tip = True
-            self._m20.transfer(self._mastermix_vol / self._mastermix_vol_headroom_aspirate, self.mm_strips[m_idx][0].bottom(0.5), s, new_tip='never')
+        with self.liquid(self._m20, "mastermix") as mastermix:
+            for i, (m_idx, s) in enumerate(zip(self.mm_indices[::self._m20.channels], self.sample_dests[:self.remaining_cols])):
+                if self.run_stage(stage.format(i + 1, n)):
+                    if not has_tip:
+                        self.pick_up(self._m20)
+                        has_tip = True
+                    self._m20.transfer(self._mastermix_vol / self._mastermix_vol_headroom_aspirate, self.mm_strips[m_idx][0].bottom(0.5), s, air_gap=mastermix.air_gap, new_tip='never')
+                    self.record_source("transfer_mm", i)
         if has_tip:
             self._m20.drop_tip()
     
     def transfer_sample(self, vol: float, source, dest):
-        self.logger.debug("transferring {:.0f} uL from {} to {}".format(vol, source, dest))
+        self.logger.debug("transferring %.0f uL from %s to %s", vol, source, dest)
         self.pick_up(self._m20, tiprack="_tips20_no_a" if source.display_name.split(" ")[0] == self._positive_control_well else None)
         self._m20.transfer(vol, source.bottom(self._sample_bottom_height), dest.bottom(self._sample_bottom_height), new_tip='never')
         self._m20.mix(self._sample_mix_reps, self._sample_mix_vol, dest.bottom(self._sample_bottom_height))
@@ -215,10 +273,23 @@ class StationC(Station):
         self._m20.aspirate(self._suck_vol, dest.top(self._suck_height))  # suck in any remaining droplets on way to trash
         self._m20.drop_tip()
         
+    def record_source(self, op: str, col: int):
+        """Record an operation on the samples of a source column of the cycle to the sample ledger"""
+        self.record(op, self.column_wells(self.sources[col]), self._source_plate_offset + col // self.source_cols)
+    
+    def ledger_plates(self) -> List[str]:
+        """Identifiers of the source plates of the ledger records, from the passports of the input plates (the elution plates of station B)"""
+        num_plates = max(self.ledger.plate, default=-1) + 1
+        return [self._passport[j]["plate"] if j < len(self._passport) else "{}-{}-source-{}".format(self.logger_name, self._run_id, j + 1) for j in range(num_plates)]
+    
     def cycle_begin(self):
         self.logger.info(self.get_msg_format("current cycle", self._cycle.split(" ")[-1]))
         self._cycle = self._cycle if self.num_cycles > 1 else ""
     
+    def swap_source_plate(self, idx: int, num: int):
+        if self.run_stage("swap source plate {}/{}{}{}".format(idx + 1, num, " " if self.num_cycles > 1 else "", self._cycle)):
+            self.pause(self.get_msg_format("swap source plate", idx + 1, num), color="yellow", reason="swap source plate")
+    
     def run_cycle(self):
         self._cycle = self.stage
         n = self._remaining_samples
@@ -228,24 +299,31 @@ class StationC(Station):
         
         self.fill_mm_strips()
         self.transfer_mm(stage="transfer mastermix to plate {}{}{}".format("{}/{}", " " if self.num_cycles > 1 else "", self._cycle))
+        source_plates = math.ceil(self.remaining_cols / self.source_cols)
         for i, (s, d) in enumerate(zip(self.sources, self.sample_dests)):
+            if self._transfer_samples and i and i % self.source_cols == 0:
+                self.swap_source_plate(i // self.source_cols, source_plates)
             if self._transfer_samples and self.run_stage("transfer samples {}/{}".format(self._num_samples + min(self._m20.channels - self._remaining_samples, 0), self._num_samples)):
                 if self.num_cycles > 1:
                     self.msg_format("sample per cycle", (i + 1) * self._m20.channels, self._samples_this_cycle, self._cycle.split(" ")[-1])
                     self.logger.info(self.msg)
                 self.transfer_sample(self._sample_vol, s, d)
+                self.record_source("transfer_sample", i)
                 self.msg = ""
             self._remaining_samples -= self._m20.channels
             if self._remaining_samples <= 0 or n - self._remaining_samples >= self._samples_this_cycle:
                 break 
+        # each cycle starts from a new source plate
+        self._source_plate_offset += source_plates
     
     def body(self):
         self.logger.info(self.get_msg_format("number of cycles", self._num_samples, self.num_cycles))
+        self._source_plate_offset = 0
         
         for i in range(self.num_cycles):
             self.run_stage("cycle {}/{}".format(i + 1, self.num_cycles))
             self.run_cycle()
-            self.pause(self.get_msg_format("end of cycle", i + 1, self.num_cycles), color="yellow")
+            self.pause(self.get_msg_format("end of cycle", i + 1, self.num_cycles), color="yellow", reason="end of cycle")
             if i + 1 < self.num_cycles and self.run_stage("pausing for next cycle {}/{}".format(i + 2, self.num_cycles)):
                 self.pause("new cycle", color="green", blink=False, home=False)
 
@@ -0,0 +1,164 @@
+"""Simulation result cache.
+Simulation results are stored on disk, keyed by a hash of the station class, its keyword arguments
+(with the defaults filled in), the package and opentrons versions and the content of the files the simulation
+depends on: the core modules, the modules and JSON files of the station sub-packages in the class
+hierarchy, the message files of the classes and the JSON files pointed by the environment variables.
+Changing any of them makes the affected entries miss. The least recently used entries are evicted
+beyond the maximum number of entries"""
+from . import __version__
+from typing import Callable, Iterable, List, Optional
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".covmatic", "simulation_cache")
+_env_key = "OT_SIMULATION_CACHE"
+# Environment variables pointing to JSON files read by the stations
+ENV_FILES = ("OT_MAGNET_JSON", "OT_COPAN_48_CORRECT", "OT_LIQUID_CLASSES_JSON")
+_package_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def normalized_kwargs(cls: type, kwargs: Optional[dict] = None) -> dict:
+    """Keyword arguments merged with the defaults of the constructors in the class hierarchy,
+    as JSON-compatible values"""
+    defaults = {}
+    for c in reversed(cls.__mro__):
+        init = c.__dict__.get("__init__")
+        if c is object or init is None:
+            continue
+        for p in inspect.signature(init).parameters.values():
+            if p.default is not p.empty:
+                defaults[p.name] = p.default
+    return json.loads(json.dumps(dict(defaults, **(kwargs or {})), sort_keys=True, default=repr))
+
+
+def dependencies(cls: type) -> List[str]:
+    """Files the simulation of the station class depends on"""
+    files = set(glob.glob(os.path.join(_package_dir, "*.py")))
+    for c in cls.__mro__:
+        if not c.__module__.startswith(__package__ + "."):
+            continue
+        module_dir = os.path.dirname(os.path.abspath(sys.modules[c.__module__].__file__))
+        if module_dir != _package_dir:
+            files.update(glob.glob(os.path.join(module_dir, "*.py")))
+            files.update(glob.glob(os.path.join(module_dir, "*.json")))
+        files.update(glob.glob(os.path.join(_package_dir, "msg", "{}.json".format(c.__name__))))
+    files.update(os.environ[k] for k in ENV_FILES if os.environ.get(k))
+    return sorted(files)
+
+
+def files_digest(files: Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for fp in files:
+        h.update(fp.encode())
+        try:
+            with open(fp, "rb") as f:
+                h.update(f.read())
+        except OSError:
+            h.update(b"missing")
+    return h.hexdigest()
+
+
+def opentrons_version() -> Optional[str]:
+    """Version of the installed opentrons package, whose simulator produces the results"""
+    try:
+        import opentrons
+    except ImportError:
+        return None
+    return opentrons.__version__
+
+
+def cache_key(cls: type, kwargs: Optional[dict] = None, kind: str = "simulation") -> str:
+    """Content-addressed key of a simulation
+    :param kind: the kind of result (e.g. the intervention trace), for results of different kinds of the same simulation"""
+    return hashlib.sha256(json.dumps({
+        "kind": kind,
+        "station": "{}.{}".format(cls.__module__, cls.__qualname__),
+        "kwargs": normalized_kwargs(cls, kwargs),
+        "version": __version__,
+        "opentrons": opentrons_version(),
+        "files": files_digest(dependencies(cls)),
+    }, sort_keys=True).encode()).hexdigest()
+
+
+class SimulationCache:
+    def __init__(self, path: Optional[str] = None, max_entries: int = 256):
+        """ Build a :py:class:`.SimulationCache`.
+        :param path: cache directory. Defaults to the OT_SIMULATION_CACHE environment variable, or DEFAULT_CACHE_DIR
+        :param max_entries: maximum number of entries, the least recently used are evicted
+        """
+        self.path = path or os.environ.get(_env_key, DEFAULT_CACHE_DIR)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+    
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.path, "{}.json".format(key))
+    
+    def get(self, key: str) -> Optional[dict]:
+        fp = self._entry(key)
+        try:
+            with open(fp, "r") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(fp)
+        return result
+    
+    def put(self, key: str, result: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._entry(key) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp, self._entry(key))
+        self.evict()
+    
+    def entries(self) -> List[str]:
+        """Entry files, from the least recently used"""
+        return sorted(glob.glob(os.path.join(self.path, "*.json")), key=os.path.getmtime)
+    
+    def evict(self):
+        entries = self.entries()
+        for fp in entries[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(fp)
+            except OSError:
+                pass
+    
+    def clear(self):
+        for fp in self.entries():
+            os.remove(fp)
+    
+    def simulate(self, cls: type, kwargs: Optional[dict] = None, run: Optional[Callable[[type, Optional[dict]], dict]] = None, kind: str = "simulation") -> dict:
+        """Simulation result of a station, from the cache if available
+        :param cls: the station class
+        :param kwargs: keyword arguments for the station
+        :param run: function simulating the station. Defaults to :py:func:`covmatic_stations.worker.simulate_job`
+        :param kind: the kind of result returned by run
+        :return: the result, with a cached field telling whether it comes from the cache"""
+        key = cache_key(cls, kwargs, kind)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return dict(result, cached=True)
+        self.misses += 1
+        if run is None:
+            from .worker import simulate_job
+            run = simulate_job
+        result = run(cls, kwargs)
+        try:
+            self.put(key, result)
+        except OSError:
+            pass  # e.g. a read-only cache directory: the result is still valid
+        return dict(result, cached=False)
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
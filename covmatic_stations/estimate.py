@@ -0,0 +1,81 @@
+"""Run duration estimation.
+The estimator listens to the commands published on the ProtocolContext broker and adds up a rough
+duration for each of them: liquid handling from volumes and flow rates, movements from the distance
+between consecutive locations of each pipette, plus fixed costs for tips and modules.
+During simulation no time passes, so the estimator also serves as the simulated clock"""
+from opentrons.types import Location
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+import math
+
+
+# Fixed duration of commands in seconds (movements excluded)
+FIXED_COSTS = {
+    'command.PICK_UP_TIP': 4,
+    'command.DROP_TIP': 3,
+    'command.BLOW_OUT': 1,
+    'command.TOUCH_TIP': 3,
+    'command.MAGDECK_ENGAGE': 4,
+    'command.MAGDECK_DISENGAGE': 4,
+}
+
+
+class DurationEstimator:
+    def __init__(self, fixed_costs: Optional[Dict[str, float]] = None, move_overhead: float = 0.5, stage: Optional[Callable[[], Optional[str]]] = None):
+        """ Build a :py:class:`.DurationEstimator`.
+        :param fixed_costs: fixed duration of commands in seconds, by command name. Defaults to FIXED_COSTS
+        :param move_overhead: duration in seconds added to each movement (accelerations and arcs)
+        :param stage: getter for the current stage, for the per-stage breakdown
+        """
+        self._fixed_costs = FIXED_COSTS if fixed_costs is None else fixed_costs
+        self._move_overhead = move_overhead
+        self._stage = stage
+        self._last_points = {}
+        self.elapsed = 0.
+        self.pauses = 0
+        # Waits of pipelined runs: requested, and spent working on other lanes (see covmatic_stations.b.pipeline)
+        self.requested = 0.
+        self.overlapped = 0.
+        self.stages: Dict[Optional[str], float] = OrderedDict()
+    
+    def __call__(self, message: dict):
+        if message['$'] != 'before':
+            return
+        if message['name'] == 'command.PAUSE':
+            self.pauses += 1
+        t = self.cost(message['name'], message['payload'])
+        self.elapsed += t
+        stage = self._stage() if self._stage is not None else None
+        self.stages[stage] = self.stages.get(stage, 0) + t
+    
+    def cost(self, name: str, payload: dict) -> float:
+        """Estimated duration of a command in seconds"""
+        t = self._fixed_costs.get(name, 0)
+        if name == 'command.DELAY':
+            return t + 60 * (payload.get('minutes') or 0) + (payload.get('seconds') or 0)
+        pip = payload.get('instrument')
+        if pip is None:
+            return t
+        t += self.move_cost(pip, payload.get('location'))
+        if name == 'command.ASPIRATE':
+            t += payload['volume'] / (pip.flow_rate.aspirate * (payload.get('rate') or 1))
+        elif name == 'command.DISPENSE':
+            t += payload['volume'] / (pip.flow_rate.dispense * (payload.get('rate') or 1))
+        return t
+    
+    def move_cost(self, pip, location) -> float:
+        if location is None:
+            return 0
+        point = location.point if isinstance(location, Location) else location.top().point
+        last = self._last_points.get(id(pip))
+        self._last_points[id(pip)] = point
+        if last is None:
+            return 0
+        d = math.sqrt(sum((a - b) ** 2 for a, b in zip(point, last)))
+        return self._move_overhead + d / pip.default_speed if d else 0
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,186 @@
+"""Fleet status aggregator.
+Polls the status endpoint of every robot of a line concurrently, with one asyncio loop and a shared pool
+of keep-alive connections, and merges the results into one view: station, status, stage, message,
+external flag, tips, temperature and estimated end time of each robot, plus whether it is waiting for an operator
+and, while paused, the reason and duration of the pause.
+The view can be printed once or served as JSON on ``/fleet``
+    python -m covmatic_stations.fleet A1=10.0.0.11 B1=10.0.0.12 C1=10.0.0.13
+    python -m covmatic_stations.fleet -c robots.json --serve --port 8095
+Robots are given as name=address (the port defaults to 8080), or in a JSON file mapping names to addresses.
+The ``/status`` endpoint is polled, so that the run log of the robots is not redirected to the aggregator"""
+from .asynchttp import ConnectionPool
+from .request import status_time
+from collections import OrderedDict
+from threading import Thread
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import cherrypy
+import json
+import logging
+import time
+
+
+DEFAULT_FLEET_CONFIG = {
+    "global": {
+        "server.socket_host": "0.0.0.0",
+        "server.socket_port": 8095,
+    },
+}
+FLEET_FIELDS = ("station", "status", "stage", "msg", "external", "temp", "eta", "pause_reason", "pause_duration")
+
+
+def robot_url(address: str, port: int = 8080) -> str:
+    """Base URL of the REST API of a robot from its address (host, host:port or URL)"""
+    if "://" not in address:
+        address = "http://" + address
+    if address.count(":") < 2:
+        address += ":{}".format(port)
+    return address.rstrip("/")
+
+
+def available_tips(tips: dict) -> Optional[int]:
+    available = tips.get("available")
+    return None if available is None else sum(available.values())
+
+
+def robot_view(status: dict) -> dict:
+    """View of a robot from its status"""
+    view = OrderedDict((k, status.get(k)) for k in FLEET_FIELDS)
+    view["tips"] = available_tips(status.get("tips") or {})
+    view["refills"] = status.get("refills") or {}
+    view["waiting_operator"] = status.get("status") == "pause" or bool(view["refills"])
+    return view
+
+
+class FleetMonitor:
+    def __init__(self, robots: Dict[str, str], interval: float = 2, timeout: float = 3, logger: Optional[logging.Logger] = None):
+        """ Build a :py:class:`.FleetMonitor`.
+        :param robots: the base URL of the REST API of each robot, by name
+        :param interval: interval in seconds between polls
+        :param timeout: timeout in seconds for each robot
+        :param logger: the logger
+        """
+        self.robots = robots
+        self._interval = interval
+        self._timeout = timeout
+        self.logger = logger or logging.getLogger(type(self).__name__)
+        self._pool: Optional[ConnectionPool] = None
+        self.views: Dict[str, dict] = OrderedDict((name, {"online": False}) for name in robots)
+        self.updated: Optional[str] = None
+    
+    async def poll_robot(self, name: str) -> dict:
+        t = time.perf_counter()
+        try:
+            status, body = await self._pool.get(self.robots[name] + "/status")
+            if status != 200:
+                raise ValueError("HTTP {}".format(status))
+            view = robot_view(json.loads(body.decode()))
+        except Exception as e:
+            view = dict(self.views.get(name, {}), error="{}: {}".format(type(e).__name__, e))
+            view["online"] = False
+        else:
+            view["online"] = True
+        view["latency"] = (time.perf_counter() - t) * 1000
+        return view
+    
+    async def poll(self) -> Dict[str, dict]:
+        """Poll all the robots once, concurrently"""
+        if self._pool is None:
+            self._pool = ConnectionPool(self._timeout)
+        views = await asyncio.gather(*map(self.poll_robot, self.robots))
+        self.views = OrderedDict(zip(self.robots, views))
+        self.updated = status_time()
+        return self.views
+    
+    async def run(self):
+        """Poll the robots forever"""
+        while True:
+            t = time.perf_counter()
+            await self.poll()
+            await asyncio.sleep(max(self._interval - (time.perf_counter() - t), 0))
+    
+    def start(self) -> Thread:
+        """Poll the robots forever in a background thread"""
+        def target():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            asyncio.get_event_loop().run_until_complete(self.run())
+        thread = Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+    
+    @property
+    def fleet(self) -> dict:
+        """The aggregated view"""
+        return {
+            "time": self.updated,
+            "robots": self.views,
+            "waiting_operator": [name for name, v in self.views.items() if v.get("waiting_operator")],
+            "offline": [name for name, v in self.views.items() if not v.get("online")],
+        }
+    
+    def format_table(self) -> str:
+        header = ("robot", "online") + FLEET_FIELDS + ("tips", "waiting_operator")
+        rows = [header] + [(name,) + tuple(v.get(k) for k in header[1:]) for name, v in self.views.items()]
+        return "\n".join("\t".join("" if x is None else str(x) for x in row) for row in rows)
+
+
+class FleetREST:
+    def __init__(self, monitor: FleetMonitor):
+        self._monitor = monitor
+    
+    @cherrypy.expose
+    def fleet(self) -> str:
+        return json.dumps(self._monitor.fleet, indent=2)
+    
+    @cherrypy.expose
+    def index(self) -> str:
+        return self.fleet()
+
+
+def parse_robots(items: List[str], port: int = 8080) -> Dict[str, str]:
+    robots = OrderedDict()
+    for item in items:
+        name, address = item.split("=", 1)
+        robots[name] = robot_url(address, port)
+    return robots
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate the status of the robots of a line")
+    parser.add_argument("robots", nargs="*", help="robots as name=address")
+    parser.add_argument("-c", "--config", default=None, help="JSON file mapping robot names to addresses")
+    parser.add_argument("-i", "--interval", type=float, default=2, help="interval in seconds between polls")
+    parser.add_argument("-t", "--timeout", type=float, default=3, help="timeout in seconds for each robot")
+    parser.add_argument("--robot-port", type=int, default=8080, help="default port of the robots")
+    parser.add_argument("--serve", action="store_true", help="serve the aggregated view on /fleet instead of printing it once")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_FLEET_CONFIG["global"]["server.socket_port"], help="the HTTP port of the aggregated view")
+    parser.add_argument("--host", default=DEFAULT_FLEET_CONFIG["global"]["server.socket_host"], help="the HTTP host of the aggregated view")
+    args = parser.parse_args()
+    
+    robots = OrderedDict()
+    if args.config:
+        with open(args.config) as f:
+            robots.update((name, robot_url(address, args.robot_port)) for name, address in json.load(f).items())
+    robots.update(parse_robots(args.robots, args.robot_port))
+    if not robots:
+        parser.error("no robots specified")
+    monitor = FleetMonitor(robots, interval=args.interval, timeout=args.timeout)
+    
+    if args.serve:
+        monitor.start()
+        cherrypy.config.update({"server.socket_host": args.host, "server.socket_port": args.port, "engine.autoreload.on": False})
+        cherrypy.quickstart(FleetREST(monitor))
+    else:
+        asyncio.get_event_loop().run_until_complete(monitor.poll())
+        print(monitor.format_table())
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -1,25 +1,89 @@
+import json
 import math
+import numpy as np
+from typing import Callable, Iterable, Tuple, Union
 
 
-class LysisTube:
-    """Geometrical model of the Lysis Buffer tube"""
-    def __init__(self, radius: float, cone_height: float = 0, fill: float = 0):
-        self.radius = radius 
-        self._ch = cone_height
+class VolumeHeightTable:
+    """Lookup table between the liquid volume and the liquid height in a container.
+    Values are linearly interpolated between samples and linearly extrapolated above the highest one.
+    All lookups are vectorized: they accept scalars or arrays"""
+    def __init__(self, heights: Iterable[float], volumes: Iterable[float]):
+        heights = np.asarray(heights, dtype=float)
+        volumes = np.asarray(volumes, dtype=float)
+        if heights.ndim != 1 or heights.shape != volumes.shape or len(heights) < 2:
+            raise ValueError("heights and volumes should be 1D sequences of the same length (at least 2)")
+        order = np.argsort(heights)
+        self.heights = heights[order]
+        self.volumes = volumes[order]
+        if np.any(np.diff(self.heights) <= 0) or np.any(np.diff(self.volumes) <= 0):
+            raise ValueError("volume should be strictly increasing with height")
+    
+    @classmethod
+    def from_function(cls, volume: Callable[[np.ndarray], np.ndarray], max_height: float, samples: int = 256) -> 'VolumeHeightTable':
+        """Sample an analytic shape
+        :param volume: vectorized function from height (mm) to volume (uL)
+        :param max_height: highest sampled height in mm
+        :param samples: number of samples"""
+        h = np.linspace(0, max_height, samples)
+        return cls(h, volume(h))
+    
+    @classmethod
+    def from_points(cls, points: Iterable[Tuple[float, float]]) -> 'VolumeHeightTable':
+        """Build the table from calibration points
+        :param points: (height in mm, volume in uL) couples"""
+        heights, volumes = zip(*points)
+        return cls(heights, volumes)
+    
+    @classmethod
+    def from_json(cls, filepath: str) -> 'VolumeHeightTable':
+        """Load calibration points from a JSON file with the fields `heights` (mm) and `volumes` (uL)"""
+        with open(filepath, "r") as f:
+            j = json.load(f)
+        return cls(j["heights"], j["volumes"])
+    
+    def toJSON(self) -> dict:
+        return {"heights": self.heights.tolist(), "volumes": self.volumes.tolist()}
+    
+    @staticmethod
+    def _interp(x, xp: np.ndarray, fp: np.ndarray) -> Union[float, np.ndarray]:
+        x = np.asarray(x, dtype=float)
+        slope = (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+        y = np.where(x > xp[-1], fp[-1] + (x - xp[-1]) * slope, np.interp(x, xp, fp))
+        return y if y.ndim else float(y)
+    
+    def height(self, volume) -> Union[float, np.ndarray]:
+        """Liquid height(s) in mm for the given volume(s) in uL"""
+        return self._interp(volume, self.volumes, self.heights)
+    
+    def volume(self, height) -> Union[float, np.ndarray]:
+        """Liquid volume(s) in uL for the given height(s) in mm"""
+        return self._interp(height, self.heights, self.volumes)
+
+
+class TabulatedTube:
+    """Geometrical model of a tube backed by a volume-height lookup table"""
+    def __init__(self, table: VolumeHeightTable, fill: float = 0):
+        self.table = table
         self.volume = fill
     
     @property
     def height(self) -> float:
-        return min(((3 * self._ch**2 * self.volume)/(math.pi * self.radius**2))**(1/3), self._ch) + max((self.volume / (math.pi * self.radius**2)) - (self._ch / 3), 0)
+        return self.table.height(self.volume)
     
     @height.setter
     def height(self, value: float):
-        self.volume = (math.pi * self.radius * self.radius) * (((min(value, self._ch)**3 / (3 * self._ch**2)) if self._ch > 0 else 0) + max(value - self._ch, 0))
+        self.volume = self.table.volume(value)
     
     def extract(self, volume: float) -> float:
         self.volume -= volume
         return self.height
     
+    def extraction_heights(self, volumes: Iterable[float]) -> np.ndarray:
+        """Liquid heights after each one of a sequence of extractions, starting from the current volume.
+        The tube state is not changed"""
+        return np.asarray(self.table.height(self.volume - np.cumsum(np.asarray(volumes, dtype=float))))
+    
     def fill(self, volume: float):
         self.volume += volume
     
@@ -27,6 +91,21 @@ class LysisTube:
         self.volume = volume
 
 
+class LysisTube(TabulatedTube):
+    """Geometrical model of the Lysis Buffer tube (a cone with a cylinder on top)"""
+    def __init__(self, radius: float, cone_height: float = 0, fill: float = 0, samples: int = 512):
+        self.radius = radius 
+        self._ch = cone_height
+        # above the cone the shape is a cylinder: one more sample makes the linear extrapolation exact
+        h = np.append(np.linspace(0, cone_height, samples) if cone_height > 0 else [0], cone_height + 1)
+        super(LysisTube, self).__init__(VolumeHeightTable(h, self.analytic_volume(h)), fill=fill)
+    
+    def analytic_volume(self, height):
+        height = np.asarray(height, dtype=float)
+        cone = (np.minimum(height, self._ch)**3 / (3 * self._ch**2)) if self._ch > 0 else 0
+        return (math.pi * self.radius * self.radius) * (cone + np.maximum(height - self._ch, 0))
+
+
 # Copyright (c) 2020 Covmatic.
 # Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
 # The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
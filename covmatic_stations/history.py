@@ -0,0 +1,294 @@
+"""Run history.
+At the end of each run, the station appends a record to a local SQLite database: station class, keyword arguments,
+version, robot name, start and end time, status and error, tips used, the duration of each stage
+(with the progress counters stripped, e.g. ``wash 1`` for ``wash 1 3/12``, and the pauses left out) and the operator pauses,
+each with its reason, phase (``stop blink`` or ``continue`` for the two halves of a dual pause), start and resume time
+and whether it was planned in the protocol or reactive (e.g. tips to refill or the tip waste to empty).
+The history is queried for trends across runs, grouped by robot, version, day, week or any keyword argument
+    python -m covmatic_stations.history runs --station StationB --days 7
+    python -m covmatic_stations.history stage "wash 1" --station StationB --days 30 --by robot
+    python -m covmatic_stations.history stages --station StationA --by wash_1_vol
+    python -m covmatic_stations.history pauses --days 30 --by robot
+    python -m covmatic_stations.history pauses --station StationB --by shift --shifts 6 14 22"""
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import argparse
+import datetime
+import json
+import numpy as np
+import sqlite3
+import time
+
+
+DEFAULT_HISTORY_FILEPATH = '/var/lib/jupyter/notebooks/outputs/history.db'
+DEFAULT_SHIFTS = (6, 14, 22)
+RUN_FIELDS = ("run", "station", "instance", "robot", "version", "kwargs", "num_samples", "start_time", "end_time", "status", "error", "tips")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run TEXT,
+    station TEXT,
+    instance TEXT,
+    robot TEXT,
+    version TEXT,
+    kwargs TEXT,
+    num_samples INTEGER,
+    start_time REAL,
+    end_time REAL,
+    status TEXT,
+    error TEXT,
+    tips TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER REFERENCES runs(id),
+    plate INTEGER,
+    stage TEXT,
+    start_time REAL,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS pauses (
+    run_id INTEGER REFERENCES runs(id),
+    stage TEXT,
+    msg TEXT,
+    start_time REAL,
+    duration REAL,
+    reason TEXT,
+    phase TEXT,
+    planned INTEGER,
+    interventions INTEGER,
+    resume_time REAL
+);
+CREATE INDEX IF NOT EXISTS runs_station ON runs (station, start_time);
+CREATE INDEX IF NOT EXISTS stages_run ON stages (run_id, stage);
+CREATE INDEX IF NOT EXISTS pauses_run ON pauses (run_id);
+"""
+PAUSE_FIELDS = ("stage", "msg", "start_time", "duration", "reason", "phase", "planned", "interventions", "resume_time")
+
+
+def stage_durations(stage_log: Iterable[Tuple[int, str, float]], end: float, pauses: Iterable[Tuple[float, float]] = ()) -> List[Tuple[int, str, float, float]]:
+    """Stage durations from the stage starts, without the time the robot was paused
+    :param stage_log: the plate index, stage name and start time of the stages, in order
+    :param end: the end time of the last stage
+    :param pauses: the start and resume time of the pauses
+    :return: the plate index, stage name, start time and duration of the stages"""
+    stage_log = list(stage_log)
+    pauses = list(pauses)
+    ends = [t for _, _, t in stage_log[1:]] + [end]
+    return [
+        (plate, stage, t, e - t - sum(max(min(e, r) - max(t, s), 0) for s, r in pauses))
+        for (plate, stage, t), e in zip(stage_log, ends)
+    ]
+
+
+class RunHistory:
+    def __init__(self, filepath: str = DEFAULT_HISTORY_FILEPATH, timeout: float = 30):
+        """ Build a :py:class:`.RunHistory`.
+        :param filepath: the SQLite database path, created if missing
+        :param timeout: seconds to wait for the database lock (e.g. while reports are being queried)
+        """
+        self._conn = sqlite3.connect(filepath, timeout=timeout)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
+    def close(self):
+        self._conn.close()
+    
+    def append(self, run: Dict[str, Any], stages: Iterable[Tuple[int, str, float, float]] = (), pauses: Iterable[dict] = ()) -> int:
+        """Append a run to the history
+        :param run: the run fields (see RUN_FIELDS), keyword arguments and tips are stored as JSON
+        :param stages: the plate index, stage name, start time and duration of the stages
+        :param pauses: the pauses, with stage, message, reason, phase, planned, interventions, start, resume and duration
+        :return: the row id of the run"""
+        values = [json.dumps(run.get(f), default=str) if f in ("kwargs", "tips") else run.get(f) for f in RUN_FIELDS]
+        with self._conn:
+            cursor = self._conn.execute("INSERT INTO runs ({}) VALUES ({})".format(", ".join(RUN_FIELDS), ", ".join("?" * len(RUN_FIELDS))), values)
+            run_id = cursor.lastrowid
+            self._conn.executemany("INSERT INTO stages VALUES (?, ?, ?, ?, ?)", ((run_id,) + tuple(s) for s in stages))
+            self._conn.executemany("INSERT INTO pauses (run_id, {}) VALUES (?, {})".format(", ".join(PAUSE_FIELDS), ", ".join("?" * len(PAUSE_FIELDS))), (
+                (run_id, p.get("stage"), p.get("msg"), p["start"], p["duration"], p.get("reason"), p.get("phase"),
+                 p.get("planned", True), p.get("interventions", 0), p.get("resume", p["start"] + p["duration"])) for p in pauses))
+        return run_id
+    
+    @staticmethod
+    def _filters(station: Optional[str] = None, robot: Optional[str] = None, days: Optional[float] = None) -> Tuple[str, list]:
+        # stations are matched by prefix, so that StationB matches all the station B classes
+        clauses, params = ["1"], []
+        if station:
+            clauses.append("runs.station LIKE ?")
+            params.append(station + "%")
+        if robot:
+            clauses.append("runs.robot = ?")
+            params.append(robot)
+        if days:
+            clauses.append("runs.start_time >= ?")
+            params.append(time.time() - days * 86400)
+        return " AND ".join(clauses), params
+    
+    @staticmethod
+    def _run(row: sqlite3.Row) -> dict:
+        run = dict(row)
+        for f in ("kwargs", "tips"):
+            if f in run:
+                run[f] = json.loads(run[f] or "null") or {}
+        return run
+    
+    def runs(self, station: Optional[str] = None, robot: Optional[str] = None, days: Optional[float] = None) -> List[dict]:
+        """The runs, oldest first"""
+        where, params = self._filters(station, robot, days)
+        return [self._run(r) for r in self._conn.execute("SELECT * FROM runs WHERE {} ORDER BY start_time".format(where), params)]
+    
+    def stages(self, stage: Optional[str] = None, station: Optional[str] = None, robot: Optional[str] = None, days: Optional[float] = None) -> List[dict]:
+        """The stage durations of the runs, summed over each plate
+        :param stage: the stage name, without progress counters. All stages if not specified"""
+        where, params = self._filters(station, robot, days)
+        if stage is not None:
+            where += " AND stages.stage = ?"
+            params.append(stage)
+        return [self._run(r) for r in self._conn.execute(
+            "SELECT runs.*, stages.plate, stages.stage, SUM(stages.duration) AS duration FROM stages JOIN runs ON stages.run_id = runs.id "
+            "WHERE {} GROUP BY runs.id, stages.plate, stages.stage ORDER BY runs.start_time, MIN(stages.start_time)".format(where), params)]
+    
+    def pauses(self, station: Optional[str] = None, robot: Optional[str] = None, days: Optional[float] = None, reason: Optional[str] = None) -> List[dict]:
+        """The operator pauses of the runs, with the pause start as pause_time"""
+        where, params = self._filters(station, robot, days)
+        if reason is not None:
+            where += " AND pauses.reason = ?"
+            params.append(reason)
+        return [self._run(r) for r in self._conn.execute(
+            "SELECT runs.*, pauses.stage, pauses.msg, pauses.start_time AS pause_time, pauses.resume_time, pauses.duration, "
+            "pauses.reason, pauses.phase, COALESCE(pauses.planned, 1) AS planned, pauses.interventions "
+            "FROM pauses JOIN runs ON pauses.run_id = runs.id WHERE {} ORDER BY pauses.start_time".format(where), params)]
+
+
+def shift_start(t: float, shifts: Sequence[int] = DEFAULT_SHIFTS) -> datetime.datetime:
+    """Start of the shift of a time
+    :param t: the time as a POSIX timestamp
+    :param shifts: the start hours of the shifts"""
+    d = datetime.datetime.fromtimestamp(t).replace(minute=0, second=0, microsecond=0)
+    starts = [h for h in sorted(shifts) if h <= d.hour]
+    if starts:
+        return d.replace(hour=starts[-1])
+    # before the first shift of the day, in the last shift of the day before
+    return (d - datetime.timedelta(days=1)).replace(hour=max(shifts))
+
+
+def group_key(row: dict, by: Optional[str], shifts: Sequence[int] = DEFAULT_SHIFTS) -> str:
+    """Group of a row: robot, station, version, day, week, shift, a field of the row (e.g. the pause reason),
+    or the value of a keyword argument. Pauses are grouped by their start time, the other rows by the run start"""
+    if by is None:
+        return "all"
+    t = row.get("pause_time", row["start_time"])
+    if by in ("day", "week"):
+        d = datetime.date.fromtimestamp(t)
+        return d.isoformat() if by == "day" else "{}-W{:02d}".format(*d.isocalendar()[:2])
+    if by == "shift":
+        return shift_start(t, shifts).strftime("%Y-%m-%d %H:%M")
+    if by in row:
+        return str(row[by])
+    return str(row["kwargs"].get(by, "default"))
+
+
+def summarize(rows: List[dict], by: Optional[str] = None, key: str = "duration", shifts: Sequence[int] = DEFAULT_SHIFTS) -> Dict[str, dict]:
+    """Median, 90th percentile and mean of a value of the rows, by group"""
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(group_key(row, by, shifts), []).append(row[key])
+    return OrderedDict((g, {
+        "count": len(v),
+        "median": float(np.median(v)),
+        "p90": float(np.percentile(v, 90)),
+        "mean": float(np.mean(v)),
+    }) for g, v in groups.items())
+
+
+def format_summary(summary: Dict[str, dict], title: str) -> str:
+    lines = ["{}\tcount\tmedian [min]\tp90 [min]\tmean [min]".format(title)]
+    for g, s in summary.items():
+        lines.append("{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}".format(g, s["count"], s["median"] / 60, s["p90"] / 60, s["mean"] / 60))
+    return "\n".join(lines)
+
+
+def summarize_waits(pauses: List[dict], by: Optional[str] = None, shifts: Sequence[int] = DEFAULT_SHIFTS) -> Dict[str, dict]:
+    """Robot time spent waiting for the operators, by group: total, planned and reactive seconds, median and 90th percentile"""
+    groups = OrderedDict()
+    for p in pauses:
+        groups.setdefault(group_key(p, by, shifts), []).append(p)
+    return OrderedDict((g, {
+        "count": len(v),
+        "total": sum(p["duration"] for p in v),
+        "planned": sum(p["duration"] for p in v if p["planned"]),
+        "reactive": sum(p["duration"] for p in v if not p["planned"]),
+        "median": float(np.median([p["duration"] for p in v])),
+        "p90": float(np.percentile([p["duration"] for p in v], 90)),
+    }) for g, v in groups.items())
+
+
+def format_waits(summary: Dict[str, dict], title: str) -> str:
+    lines = ["{}\tpauses\tidle [min]\tplanned [min]\treactive [min]\tmedian [min]\tp90 [min]".format(title)]
+    for g, s in summary.items():
+        lines.append("{}\t{}\t{:.1f}\t{:.1f}\t{:.1f}\t{:.2f}\t{:.2f}".format(
+            g, s["count"], s["total"] / 60, s["planned"] / 60, s["reactive"] / 60, s["median"] / 60, s["p90"] / 60))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports on the run history")
+    parser.add_argument("-f", "--filepath", default=DEFAULT_HISTORY_FILEPATH, help="the history database path")
+    subparsers = parser.add_subparsers(dest="command")
+    parsers = {
+        "runs": subparsers.add_parser("runs", help="list the runs"),
+        "stage": subparsers.add_parser("stage", help="duration of a stage"),
+        "stages": subparsers.add_parser("stages", help="duration of all the stages"),
+        "pauses": subparsers.add_parser("pauses", help="duration of the operator pauses"),
+    }
+    parsers["stage"].add_argument("stage", help="the stage name, without progress counters (e.g. 'wash 1')")
+    for p in parsers.values():
+        p.add_argument("--station", default=None, help="the station class, matched by prefix (e.g. StationB)")
+        p.add_argument("--robot", default=None, help="the robot name")
+        p.add_argument("--days", type=float, default=None, help="only the runs started in the last days")
+    for name in ("stage", "stages", "pauses"):
+        parsers[name].add_argument("--by", default="robot", help="group by robot, station, version, run, day, week, shift or a keyword argument (default: robot)")
+        parsers[name].add_argument("--shifts", nargs="+", type=int, default=DEFAULT_SHIFTS, help="start hours of the shifts (default: {})".format(
+            " ".join(map(str, DEFAULT_SHIFTS))))
+    parsers["pauses"].add_argument("--reason", default=None, help="only the pauses with this reason (e.g. 'refill tips')")
+    parsers["pauses"].set_defaults(by="run")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
+    
+    with RunHistory(args.filepath) as history:
+        if args.command == "runs":
+            print("id\tstart\tstation\trobot\tversion\tsamples\tduration [min]\tstatus\terror")
+            for r in history.runs(args.station, args.robot, args.days):
+                print("{}\t{}\t{}\t{}\t{}\t{}\t{:.1f}\t{}\t{}".format(
+                    r["id"], datetime.datetime.fromtimestamp(r["start_time"]).isoformat(" ", "seconds"), r["station"], r["robot"],
+                    r["version"], r["num_samples"], (r["end_time"] - r["start_time"]) / 60, r["status"], r["error"] or ""))
+        elif args.command == "stage":
+            print(format_summary(summarize(history.stages(args.stage, args.station, args.robot, args.days), args.by, shifts=args.shifts), args.by))
+        elif args.command == "stages":
+            rows = history.stages(None, args.station, args.robot, args.days)
+            for stage in OrderedDict.fromkeys(r["stage"] for r in rows):
+                print(format_summary(summarize([r for r in rows if r["stage"] == stage], args.by, shifts=args.shifts), "{} by {}".format(stage, args.by)))
+                print()
+        elif args.command == "pauses":
+            pauses = history.pauses(args.station, args.robot, args.days, args.reason)
+            print(format_waits(summarize_waits(pauses, args.by, args.shifts), args.by))
+            print()
+            print(format_waits(summarize_waits(pauses, "reason", args.shifts), "reason"))
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
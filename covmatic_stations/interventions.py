@@ -0,0 +1,145 @@
+"""Operator intervention planning.
+Tip refills and tip waste emptying normally stop the robot whenever a tiprack runs out or the
+waste fills up. Knowing the tip pick-ups and drops of the whole run, the planner asks for these
+interventions at the scheduled pauses where the operator is already at the robot, so that the
+unplanned pauses are avoided whenever possible"""
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+
+class Segment:
+    """Tip pick-ups and drops between two scheduled pauses"""
+    def __init__(self, stage: Optional[str] = None):
+        self.stage = stage
+        self.tips: Dict[str, int] = {}
+        self.drops: List[int] = []
+
+
+class InterventionTrace:
+    """Tip pick-ups and drops of a run, split at the scheduled pauses"""
+    def __init__(self):
+        self.segments: List[Segment] = [Segment()]
+    
+    def pick(self, tiprack: str):
+        tips = self.segments[-1].tips
+        tips[tiprack] = tips.get(tiprack, 0) + 1
+    
+    def drop(self, channels: int):
+        self.segments[-1].drops.append(channels)
+    
+    def slot(self, stage: Optional[str] = None):
+        self.segments.append(Segment(stage))
+    
+    @property
+    def num_slots(self) -> int:
+        return len(self.segments) - 1
+    
+    def to_dict(self) -> dict:
+        return {"segments": [{"stage": s.stage, "tips": s.tips, "drops": s.drops} for s in self.segments]}
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> 'InterventionTrace':
+        trace = cls()
+        trace.segments = []
+        for d in data["segments"]:
+            segment = Segment(d["stage"])
+            segment.tips = dict(d["tips"])
+            segment.drops = list(d["drops"])
+            trace.segments.append(segment)
+        return trace
+
+
+class Intervention:
+    def __init__(self, racks: Optional[Dict[str, List[int]]] = None, empty_trash: bool = False):
+        """ Build a :py:class:`.Intervention`.
+        :param racks: indices of the racks to be replaced, by tiprack attribute name
+        :param empty_trash: whether the tip waste should be emptied
+        """
+        self.racks = racks or {}
+        self.empty_trash = empty_trash
+    
+    def __bool__(self) -> bool:
+        return bool(self.racks) or self.empty_trash
+
+
+def used_racks(count: int, available: int, rack_sizes: List[int]) -> List[int]:
+    """Racks whose tips have all been picked up since they were last refilled
+    :param count: number of tips picked up from the start of the first rack (modulo the total)
+    :param available: number of tips that can still be picked up
+    :param rack_sizes: number of usable tips of each rack
+    :returns: the indices of the empty racks"""
+    bounds = list(accumulate(rack_sizes))
+    total = bounds[-1]
+    used = set((count - 1 - i) % total for i in range(total - available))
+    return [k for k, (a, b) in enumerate(zip([0] + bounds[:-1], bounds)) if all(p in used for p in range(a, b))]
+
+
+class InterventionPlanner:
+    def __init__(self, trace: InterventionTrace, rack_sizes: Dict[str, List[int]], drop_threshold: int):
+        """ Build a :py:class:`.InterventionPlanner`.
+        :param trace: predicted tip pick-ups and drops of the run
+        :param rack_sizes: number of usable tips of each rack, by tiprack attribute name
+        :param drop_threshold: number of dropped tips that fill up the tip waste
+        """
+        self.trace = trace
+        self._rack_sizes = rack_sizes
+        self._drop_threshold = drop_threshold
+    
+    def intervention(self, slot: int, tip_log: dict, drop_count: int) -> Intervention:
+        """Interventions to ask for at a scheduled pause, so that the run can get to the next one without stopping
+        :param slot: index of the scheduled pause
+        :param tip_log: current tip counts, as in :py:attr:`Station._tip_log`
+        :param drop_count: number of tips currently in the tip waste"""
+        if slot >= self.trace.num_slots:
+            return Intervention()
+        segment = self.trace.segments[slot + 1]
+        racks = {}
+        for t, n in segment.tips.items():
+            if n > tip_log['available'][t]:
+                r = used_racks(tip_log['count'][t], tip_log['available'][t], self._rack_sizes[t])
+                if r:
+                    racks[t] = r
+        empty_trash = drop_count > 0 and drop_count + sum(segment.drops) >= self._drop_threshold
+        return Intervention(racks, empty_trash)
+    
+    def apply(self, intervention: Intervention, tip_log: dict):
+        """Update the tip counts after the racks of an intervention have been replaced"""
+        for t, racks in intervention.racks.items():
+            tip_log['available'][t] += sum(self._rack_sizes[t][k] for k in racks)
+    
+    def replay(self, tip_log: dict, drop_count: int, planned: bool = True) -> Tuple[List[Tuple[int, Intervention]], int]:
+        """Replay the run from the given state
+        :param tip_log: initial tip counts, as in :py:attr:`Station._tip_log`
+        :param drop_count: initial number of tips in the tip waste
+        :param planned: whether to ask for interventions at the scheduled pauses
+        :returns: the planned interventions with their slot index and the number of unplanned pauses"""
+        tip_log = {k: dict(tip_log[k]) for k in ('count', 'available', 'max')}
+        interventions = []
+        unplanned = 0
+        for i, segment in enumerate(self.trace.segments):
+            if i and planned:
+                intervention = self.intervention(i - 1, tip_log, drop_count)
+                if intervention:
+                    interventions.append((i - 1, intervention))
+                    self.apply(intervention, tip_log)
+                    if intervention.empty_trash:
+                        drop_count = 0
+            for t, n in segment.tips.items():
+                for _ in range(n):
+                    if tip_log['available'][t] == 0:
+                        unplanned += 1
+                        tip_log['available'][t] = tip_log['max'][t]
+                    tip_log['count'][t] = tip_log['count'][t] % tip_log['max'][t] + 1
+                    tip_log['available'][t] -= 1
+            for channels in segment.drops:
+                drop_count += channels
+                if drop_count >= self._drop_threshold:
+                    unplanned += 1
+                    drop_count = 0
+        return interventions, unplanned
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,398 @@
+"""Intermediate representation of pipette operations.
+Within a :py:meth:`Station.operations` block the station methods drive an
+:py:class:`OperationRecorder` instead of the pipette: the calls are buffered as typed operations,
+rewritten by the optimization passes and then replayed on the pipette.
+The recorder keeps track of the volume in the tip, of the pipette settings and of the Z speed limits, so that the station
+code reading them behaves as if the operations were executed right away"""
+from .estimate import DurationEstimator
+from .profiles import FLOW_RATES, set_max_speed
+from opentrons.protocol_api.labware import Well
+from opentrons.types import Location
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import logging
+
+
+def well_contact(location) -> Tuple[Optional[Well], bool]:
+    """Well of a location and whether the location is below the top of the well"""
+    if isinstance(location, Well):
+        return location, True
+    if isinstance(location, Location) and isinstance(location.labware, Well):
+        return location.labware, location.point.z < location.labware.top().point.z
+    return None, False
+
+
+class Operation:
+    """A call to a pipette method"""
+    method: str = ""
+    params: Tuple[str, ...] = ()
+    
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+    
+    def arg(self, name: str, default=None):
+        i = self.params.index(name)
+        return self.args[i] if i < len(self.args) else self.kwargs.get(name, default)
+    
+    @property
+    def locations(self) -> list:
+        """Locations visited by the operation, in order"""
+        return [self.arg('location')] if 'location' in self.params else []
+    
+    @property
+    def command(self) -> str:
+        return 'command.' + self.method.upper()
+    
+    def payload(self, pip) -> dict:
+        return {'instrument': pip, 'location': self.locations[-1] if self.locations else None}
+    
+    def volume_after(self, current: float, pip) -> float:
+        """Volume in the tip after the operation"""
+        return current
+    
+    def apply(self, pip):
+        return getattr(pip, self.method)(*self.args, **self.kwargs)
+    
+    def __repr__(self) -> str:
+        return "{}({})".format(self.method, ", ".join(list(map(str, self.args)) + ["{}={}".format(k, v) for k, v in self.kwargs.items()]))
+
+
+class Aspirate(Operation):
+    method = 'aspirate'
+    params = ('volume', 'location', 'rate')
+    
+    def payload(self, pip) -> dict:
+        return dict(super(Aspirate, self).payload(pip), volume=self.arg('volume') or 0, rate=self.arg('rate', 1.0))
+    
+    def volume_after(self, current: float, pip) -> float:
+        v = self.arg('volume')
+        return pip.max_volume if v is None else current + v
+
+
+class Dispense(Aspirate):
+    method = 'dispense'
+    
+    def volume_after(self, current: float, pip) -> float:
+        v = self.arg('volume')
+        return 0 if v is None else current - v
+
+
+class AirGap(Operation):
+    method = 'air_gap'
+    params = ('volume', 'height')
+    
+    @property
+    def command(self) -> str:
+        return 'command.ASPIRATE'
+    
+    def payload(self, pip) -> dict:
+        return dict(super(AirGap, self).payload(pip), volume=self.arg('volume') or 0)
+    
+    def volume_after(self, current: float, pip) -> float:
+        v = self.arg('volume')
+        return pip.max_volume if v is None else current + v
+
+
+class Mix(Operation):
+    method = 'mix'
+    params = ('repetitions', 'volume', 'location', 'rate')
+
+
+class Transfer(Operation):
+    method = 'transfer'
+    params = ('volume', 'source', 'dest')
+    
+    @property
+    def locations(self) -> list:
+        return [self.arg('source'), self.arg('dest')]
+    
+    def volume_after(self, current: float, pip) -> float:
+        return 0
+
+
+class TouchTip(Operation):
+    method = 'touch_tip'
+    params = ('location', 'radius', 'v_offset', 'speed')
+
+
+class BlowOut(Operation):
+    method = 'blow_out'
+    params = ('location',)
+    
+    def volume_after(self, current: float, pip) -> float:
+        return 0
+
+
+class MoveTo(Operation):
+    method = 'move_to'
+    params = ('location', 'force_direct', 'minimum_z_height', 'speed')
+    default_motion = (False, None, None)
+    
+    @property
+    def motion(self) -> tuple:
+        """The parameters of the movement other than the location"""
+        return bool(self.arg('force_direct')), self.arg('minimum_z_height'), self.arg('speed')
+
+
+class TipOperation(Operation):
+    @property
+    def locations(self) -> list:
+        return []
+    
+    def volume_after(self, current: float, pip) -> float:
+        return 0
+
+
+class PickUpTip(TipOperation):
+    method = 'pick_up_tip'
+    params = ('location', 'presses', 'increment')
+
+
+class DropTip(TipOperation):
+    method = 'drop_tip'
+    params = ('location', 'home_after')
+
+
+class Setting(Operation):
+    """Assignment of a flow rate or of the default speed"""
+    def __init__(self, name: str, value: float):
+        super(Setting, self).__init__(name, value)
+        self.name = name
+        self.value = value
+    
+    @property
+    def command(self) -> str:
+        return 'setting'
+    
+    def payload(self, pip) -> dict:
+        return {}
+    
+    def apply(self, pip):
+        setattr(pip.flow_rate if self.name in FLOW_RATES else pip, self.name, self.value)
+    
+    def __repr__(self) -> str:
+        return "{} = {}".format(self.name, self.value)
+
+
+class SpeedLimit(Operation):
+    """Assignment of the maximum speed of a gantry axis (None for no limit)"""
+    def __init__(self, ctx, axis: str, value: Optional[float]):
+        super(SpeedLimit, self).__init__(axis, value)
+        self.ctx = ctx
+        self.axis = axis
+        self.value = value
+    
+    @property
+    def command(self) -> str:
+        return 'setting'
+    
+    def payload(self, pip) -> dict:
+        return {}
+    
+    def apply(self, pip):
+        set_max_speed(self.ctx, self.axis, self.value)
+    
+    def __repr__(self) -> str:
+        return "max_speeds[{}] = {}".format(self.axis, self.value)
+
+
+OPERATIONS = {op.method: op for op in (Aspirate, Dispense, AirGap, Mix, Transfer, TouchTip, BlowOut, MoveTo, PickUpTip, DropTip)}
+
+
+def pipette_settings(pip) -> Dict[str, float]:
+    settings = {k: getattr(pip.flow_rate, k) for k in FLOW_RATES}
+    settings['default_speed'] = pip.default_speed
+    return settings
+
+
+def estimate_seconds(pip, operations: List[Operation]) -> float:
+    """Rough duration of a sequence of operations"""
+    estimator = DurationEstimator()
+    return sum(estimator.cost(op.command, op.payload(pip)) for op in operations)
+
+
+class OperationBuffer:
+    def __init__(self, pipette):
+        """ Build a :py:class:`.OperationBuffer`.
+        :param pipette: the pipette the operations are replayed on
+        """
+        self.pipette = pipette
+        self.settings = pipette_settings(pipette)
+        self.operations: List[Operation] = []
+    
+    def execute(self):
+        for op in self.operations:
+            op.apply(self.pipette)
+
+
+class _FlowRateRecorder:
+    def __init__(self, recorder: 'OperationRecorder'):
+        object.__setattr__(self, '_recorder', recorder)
+    
+    def __getattr__(self, name: str):
+        if name in FLOW_RATES:
+            return self._recorder.settings[name]
+        return getattr(self._recorder.pipette.flow_rate, name)
+    
+    def __setattr__(self, name: str, value):
+        self._recorder.set(name, value)
+
+
+class OperationRecorder:
+    """Stand-in for a pipette that buffers its operations"""
+    def __init__(self, pipette):
+        self.pipette = pipette
+        self.buffer = OperationBuffer(pipette)
+        self.settings = dict(self.buffer.settings)
+        self.current_volume = pipette.current_volume
+        self.flow_rate = _FlowRateRecorder(self)
+        self.max_speeds: Dict[str, Optional[float]] = {}
+    
+    def __getattr__(self, name: str):
+        if name in OPERATIONS:
+            return lambda *args, **kwargs: self.record(OPERATIONS[name](*args, **kwargs))
+        return getattr(self.pipette, name)
+    
+    def __setattr__(self, name: str, value):
+        if name == 'default_speed':
+            self.set(name, value)
+        else:
+            object.__setattr__(self, name, value)
+    
+    @property
+    def default_speed(self) -> float:
+        return self.settings['default_speed']
+    
+    def set(self, name: str, value: float):
+        self.settings[name] = value
+        self.record(Setting(name, value))
+    
+    def max_speed(self, ctx, axis: str) -> Optional[float]:
+        """Maximum speed of a gantry axis, as of the buffered operations"""
+        return self.max_speeds[axis] if axis in self.max_speeds else ctx.max_speeds.get(axis)
+    
+    def set_max_speed(self, ctx, axis: str, value: Optional[float]):
+        self.max_speeds[axis] = value
+        self.record(SpeedLimit(ctx, axis, value))
+    
+    def record(self, op: Operation) -> 'OperationRecorder':
+        self.current_volume = op.volume_after(self.current_volume, self.pipette)
+        self.buffer.operations.append(op)
+        return self
+    
+    def take(self) -> OperationBuffer:
+        """Get the buffered operations and start a new buffer"""
+        buffer = self.buffer
+        self.buffer = OperationBuffer(self.pipette)
+        self.buffer.settings = dict(self.settings)
+        return buffer
+
+
+class OperationPass:
+    """Base class for the passes rewriting an :py:class:`OperationBuffer`"""
+    def __init__(self):
+        self.operations = 0
+        self.seconds = 0.
+    
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+    
+    def run(self, buffer: OperationBuffer) -> List[Operation]:
+        """Rewrite the buffer in place and return the removed operations"""
+        return []
+    
+    def __call__(self, buffer: OperationBuffer):
+        before = estimate_seconds(buffer.pipette, buffer.operations)
+        self.operations += len(self.run(buffer))
+        self.seconds += before - estimate_seconds(buffer.pipette, buffer.operations)
+
+
+class RedundantMovePass(OperationPass):
+    """Remove consecutive moves (only the last one matters, unless the movements differ in their parameters) and
+    air gaps that are dispensed right away in the well where they were taken"""
+    def run(self, buffer: OperationBuffer) -> List[Operation]:
+        kept: List[Tuple[Operation, Optional[Well]]] = []
+        removed = []
+        for op in buffer.operations:
+            well = kept[-1][1] if kept else None
+            if op.locations and op.locations[-1] is not None:
+                well = well_contact(op.locations[-1])[0]
+            if isinstance(op, MoveTo) and kept and isinstance(kept[-1][0], MoveTo) \
+                    and op.motion in (MoveTo.default_motion, kept[-1][0].motion):
+                removed.append(kept.pop()[0])
+            elif isinstance(op, Dispense) and kept and isinstance(kept[-1][0], AirGap) and op.arg('volume') is not None \
+                    and op.arg('volume') == kept[-1][0].arg('volume') and well is not None and well == kept[-1][1]:
+                removed += [kept.pop()[0], op]
+                continue
+            kept.append((op, well))
+        buffer.operations = [op for op, _ in kept]
+        return removed
+
+
+class FlowRateCoalescingPass(OperationPass):
+    """Apply the settings only right before the operations that use them,
+    dropping those that are overwritten or that do not change the current value"""
+    def run(self, buffer: OperationBuffer) -> List[Operation]:
+        current = dict(buffer.settings)
+        pending: Dict[str, Setting] = OrderedDict()
+        kept = []
+        removed = []
+        
+        def flush():
+            for s in pending.values():
+                if current.get(s.name) == s.value:
+                    removed.append(s)
+                else:
+                    current[s.name] = s.value
+                    kept.append(s)
+            pending.clear()
+        
+        for op in buffer.operations:
+            if isinstance(op, Setting):
+                if op.name in pending:
+                    removed.append(pending.pop(op.name))
+                pending[op.name] = op
+            else:
+                flush()
+                kept.append(op)
+        flush()
+        buffer.operations = kept
+        return removed
+
+
+class TipReuseCheckPass(OperationPass):
+    """Warn when a tip goes back into a well after having been into another one"""
+    def __init__(self, logger: Optional[logging.getLoggerClass()] = None):
+        super(TipReuseCheckPass, self).__init__()
+        self._logger = logger or logging.getLogger(__name__)
+        self.violations = 0
+    
+    def run(self, buffer: OperationBuffer) -> List[Operation]:
+        visited: List[Well] = []
+        for op in buffer.operations:
+            if isinstance(op, PickUpTip):
+                visited = []
+            for loc in op.locations:
+                well, inside = well_contact(loc)
+                if not inside:
+                    continue
+                if visited and visited[-1] != well:
+                    if well in visited:
+                        self.violations += 1
+                        self._logger.warning("tip used in {} goes back into {} ({})".format(visited[-1], well, op))
+                    visited.append(well)
+                elif not visited:
+                    visited.append(well)
+        return []
+
+
+def default_passes(logger: Optional[logging.getLoggerClass()] = None) -> List[OperationPass]:
+    return [RedundantMovePass(), FlowRateCoalescingPass(), TipReuseCheckPass(logger)]
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
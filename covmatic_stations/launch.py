@@ -0,0 +1,48 @@
+"""Run a station from the command line.
+The sidecar uses it to start the runs requested over the REST API
+    python -m covmatic_stations.launch StationBTechnogenetics '{"num_samples": 48}'
+With ``--simulate`` the run is simulated (and its status is still served by the sidecar)"""
+from .benchmark import API_LEVEL
+from .station import Station
+from .worker import station_class
+from typing import Optional
+import argparse
+import json
+
+
+def launch(name: str, kwargs: Optional[dict] = None, simulate: bool = False, api_level: str = API_LEVEL) -> Station:
+    """Run a station
+    :param name: the station class name or dotted path
+    :param kwargs: keyword arguments for the station
+    :param simulate: simulate the run instead of executing it on the robot
+    :param api_level: the API level of the protocol context
+    :return: the station after the run"""
+    kwargs = dict(kwargs or {}, metadata={'apiLevel': api_level})
+    if simulate:
+        kwargs.setdefault("simulation_log_lws", True)
+    station = station_class(name)(**kwargs)
+    if simulate:
+        station.simulate()
+    else:
+        from opentrons import execute
+        station.run(execute.get_protocol_api(api_level))
+    return station
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a station")
+    parser.add_argument("station", help="station class name or dotted path")
+    parser.add_argument("kwargs", nargs="?", type=json.loads, default={}, help="JSON object of keyword arguments for the station")
+    parser.add_argument("--simulate", action="store_true", help="simulate the run")
+    args = parser.parse_args()
+    launch(args.station, args.kwargs, args.simulate)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,191 @@
+"""Per-sample turnaround ledger.
+Each station records the time of the key operations on the samples: ``transfer_sample``, ``transfer_lys`` and
+``transfer_beads`` on station A, ``bind``, each wash, ``elute`` and ``final_transfer`` on station B,
+``transfer_mm`` and ``transfer_sample`` on station C. Operations by multichannel pipettes are recorded
+for all the samples of the column. Samples are identified by the plate and the well of the plate moving
+between the stations (the deepwell plate of station A, which is the sample plate of station B,
+whose elution plate is the source plate of station C).
+Records are kept in columns (plate, well, operation and time, with the names of the wells and operations
+stored once) and saved at the end of each run to a compressed NumPy file, together with the plate identifiers
+of the passports (see :py:mod:`covmatic_stations.passport`): the output plates, or the input plates on station C.
+The ledgers of the stations are joined by plate and well into one row per sample
+    python -m covmatic_stations.ledger join A=ledger_a.npz B=ledger_b.npz C=ledger_c.npz -o samples.csv
+    python -m covmatic_stations.ledger join A=ledger_a.npz C=ledger_c.npz --latency A.transfer_sample C.transfer_sample"""
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import argparse
+import csv
+import json
+import numpy as np
+import sys
+
+
+DEFAULT_LEDGER_FILEPATH = '/var/lib/jupyter/notebooks/outputs/ledger_{}.npz'
+PERCENTILES = (50, 90, 99)
+
+
+class SampleLedger:
+    def __init__(self, meta: Optional[dict] = None):
+        """ Build a :py:class:`.SampleLedger`.
+        :param meta: run information saved with the ledger (e.g. station and plate identifiers)
+        """
+        self.meta = meta or {}
+        self.ops: List[str] = []
+        self.wells: List[str] = []
+        self._op_codes: Dict[str, int] = {}
+        self._well_codes: Dict[str, int] = {}
+        self.plate = array('H')
+        self.well = array('H')
+        self.op = array('H')
+        self.time = array('d')
+    
+    def __len__(self) -> int:
+        return len(self.time)
+    
+    @staticmethod
+    def _code(name: str, names: List[str], codes: Dict[str, int]) -> int:
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+        return code
+    
+    def record(self, op: str, wells: Iterable[str], plate: int, t: float):
+        """Record an operation on the samples in the wells
+        :param op: the operation name
+        :param wells: the well names
+        :param plate: the index of the plate in the run
+        :param t: the time as a POSIX timestamp"""
+        op_code = self._code(op, self.ops, self._op_codes)
+        for w in wells:
+            self.plate.append(plate)
+            self.well.append(self._code(w, self.wells, self._well_codes))
+            self.op.append(op_code)
+            self.time.append(t)
+    
+    def rows(self) -> Iterator[Tuple[int, str, str, float]]:
+        """Records as (plate index, well, operation, time) tuples"""
+        for p, w, o, t in zip(self.plate, self.well, self.op, self.time):
+            yield p, self.wells[w], self.ops[o], t
+    
+    def plate_id(self, plate: int) -> str:
+        plates = self.meta.get("plates", [])
+        return plates[plate] if plate < len(plates) else str(plate + 1)
+    
+    def save(self, filepath: str):
+        np.savez_compressed(
+            filepath,
+            plate=np.frombuffer(self.plate, dtype=np.uint16),
+            well=np.frombuffer(self.well, dtype=np.uint16),
+            op=np.frombuffer(self.op, dtype=np.uint16),
+            time=np.frombuffer(self.time, dtype=np.float64),
+            wells=np.array(self.wells),
+            ops=np.array(self.ops),
+            meta=np.array(json.dumps(self.meta)),
+        )
+    
+    @classmethod
+    def load(cls, filepath: str) -> 'SampleLedger':
+        with np.load(filepath) as data:
+            ledger = cls(json.loads(str(data["meta"])))
+            ledger.wells = list(map(str, data["wells"]))
+            ledger.ops = list(map(str, data["ops"]))
+            ledger.plate = array('H', data["plate"].astype(np.uint16).tobytes())
+            ledger.well = array('H', data["well"].astype(np.uint16).tobytes())
+            ledger.op = array('H', data["op"].astype(np.uint16).tobytes())
+            ledger.time = array('d', data["time"].astype(np.float64).tobytes())
+        ledger._op_codes = {o: i for i, o in enumerate(ledger.ops)}
+        ledger._well_codes = {w: i for i, w in enumerate(ledger.wells)}
+        return ledger
+
+
+def join(ledgers: Dict[str, SampleLedger]) -> Tuple[List[str], List[dict]]:
+    """Join the ledgers of the stations by plate and well
+    :param ledgers: the ledgers, by label (e.g. A, B and C)
+    :return: the operation columns, as label.operation, and one row per sample with the plate, the well,
+    the first time of each operation and the turnaround from the first to the last operation in seconds"""
+    columns = []
+    samples: Dict[Tuple[str, str], dict] = OrderedDict()
+    for label, ledger in ledgers.items():
+        for plate, well, op, t in ledger.rows():
+            column = "{}.{}".format(label, op)
+            if column not in columns:
+                columns.append(column)
+            row = samples.setdefault((ledger.plate_id(plate), well), {"plate": ledger.plate_id(plate), "well": well})
+            row[column] = min(row.get(column, t), t)
+    for row in samples.values():
+        times = [row[c] for c in columns if c in row]
+        row["turnaround"] = max(times) - min(times)
+    return columns, list(samples.values())
+
+
+def latencies(rows: List[dict], start: str, end: str) -> List[float]:
+    """Time in seconds between two operations of each sample that went through both"""
+    return [row[end] - row[start] for row in rows if start in row and end in row]
+
+
+def stats(values: List[float]) -> dict:
+    if not values:
+        return {"samples": 0}
+    return dict(samples=len(values), mean=float(np.mean(values)), **{"p{}".format(q): float(np.percentile(values, q)) for q in PERCENTILES})
+
+
+def write_csv(f, columns: List[str], rows: List[dict]):
+    writer = csv.DictWriter(f, ["plate", "well"] + columns + ["turnaround"])
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: "{:.3f}".format(v) if isinstance(v, float) else v for k, v in row.items()})
+
+
+def format_stats(name: str, s: dict) -> str:
+    if not s["samples"]:
+        return "{}: no samples".format(name)
+    return "{}: {} samples, mean {:.1f} min, ".format(name, s["samples"], s["mean"] / 60) + ", ".join(
+        "p{} {:.1f} min".format(q, s["p{}".format(q)] / 60) for q in PERCENTILES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-sample turnaround ledgers")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_join = subparsers.add_parser("join", help="join the ledgers of the stations by plate and well")
+    parser_join.add_argument("ledgers", nargs="+", help="ledgers as label=path, in the order of the line")
+    parser_join.add_argument("-o", "--output", default=None, help="the file path where to save the samples CSV (defaults to standard output)")
+    parser_join.add_argument("--latency", nargs=2, action="append", default=[], metavar=("START", "END"),
+                             help="report the time between two operations, as label.operation (can be repeated)")
+    parser_show = subparsers.add_parser("show", help="print the records of a ledger")
+    parser_show.add_argument("ledger", help="the ledger path")
+    args = parser.parse_args()
+    
+    if args.command == "join":
+        ledgers = OrderedDict()
+        for item in args.ledgers:
+            label, path = item.split("=", 1) if "=" in item else (str(len(ledgers) + 1), item)
+            ledgers[label] = SampleLedger.load(path)
+        columns, rows = join(ledgers)
+        if args.output:
+            with open(args.output, "w", newline="") as f:
+                write_csv(f, columns, rows)
+        else:
+            write_csv(sys.stdout, columns, rows)
+        report = sys.stderr if not args.output else sys.stdout
+        print(format_stats("turnaround", stats([row["turnaround"] for row in rows])), file=report)
+        for start, end in args.latency:
+            print(format_stats("{} -> {}".format(start, end), stats(latencies(rows, start, end))), file=report)
+    elif args.command == "show":
+        ledger = SampleLedger.load(args.ledger)
+        print(json.dumps(ledger.meta))
+        for plate, well, op, t in ledger.rows():
+            print("{}\t{}\t{}\t{:.3f}".format(ledger.plate_id(plate), well, op, t))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
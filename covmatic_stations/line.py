@@ -0,0 +1,20 @@
+"""Description of a line of A, B and C stations, shared by the orchestrator and the line simulator.
+It has no dependencies, so that the line simulator runs without opentrons"""
+
+
+STEPS = ("A", "B", "C")
+DEFAULT_LINE = {
+    "robots": [
+        {"name": "A1", "url": "127.0.0.1:8080", "step": "A", "station": "StationATechnogenetics48"},
+        {"name": "B1", "url": "127.0.0.1:8081", "step": "B", "station": "StationBTechnogenetics"},
+        {"name": "C1", "url": "127.0.0.1:8082", "step": "C", "station": "StationCTechnogenetics"},
+    ],
+    "operators": 1,
+    "handoff_time": 120,
+}
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
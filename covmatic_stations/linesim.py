@@ -0,0 +1,366 @@
+"""Discrete-event simulation of a line of A, B and C stations.
+Each station is described by a profile: the sequence of robot work, operator steps (the pauses, including
+both halves of :py:meth:`Station.dual_pause`) and external incubations (the pauses while the plate is out of the robot,
+see :py:meth:`Station.set_external`). Profiles are derived from the simulation of the stations (see
+:py:func:`covmatic_stations.worker.simulate_job`), so that the robot work durations come from the run estimator,
+or loaded from a JSON file, e.g. built from recorded runs.
+Plates of one batch size go through the steps; each plate holds its robot until an operator moves it to the next step.
+Robots and operators are limited: plates queue for the robots, robots wait for the operators.
+Durations are drawn around their nominal values for each Monte-Carlo replication, and replications run on all cores
+    python -m covmatic_stations.linesim -r A=1 B=2 C=1 --operators 2 --shift 8 --batch 96 -n 200
+The report holds the samples completed in the shift, the utilisation of each robot, the queueing delay of each step,
+the waiting time for the operators, the capacity of each step and the bottleneck: the step with the lowest capacity"""
+from .line import DEFAULT_LINE, STEPS
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+from typing import Callable, Deque, Dict, Generator, List, Optional, Tuple
+import argparse
+import heapq
+import json
+import logging
+import math
+import numpy as np
+import os
+import random
+
+
+DEFAULT_STATIONS = OrderedDict((r["step"], r["station"]) for r in DEFAULT_LINE["robots"])
+DEFAULT_OPERATOR_TIME = 120
+DEFAULT_EXTERNAL_TIME = 600
+DEFAULT_HANDOFF_TIME = DEFAULT_LINE["handoff_time"]
+PERCENTILES = (5, 50, 95)
+
+
+def station_profile(result: dict) -> List[Tuple[str, object]]:
+    """Profile of a station from its simulation result
+    :param result: the simulation result, with the pauses and the overall estimate
+    :return: the steps, as ("robot", seconds), ("operator", stage) and ("external", stage) pairs"""
+    steps = []
+    t = 0
+    for p in result["pauses"]:
+        if p["time"] > t:
+            steps.append(("robot", p["time"] - t))
+            t = p["time"]
+        if p["external"]:
+            steps.append(("external", p["stage"]))
+        # Consecutive pauses are one operator step, like the halves of a dual pause
+        if p["external"] or not steps or steps[-1][0] != "operator":
+            steps.append(("operator", p["stage"]))
+    if result["estimate"]["duration"] > t:
+        steps.append(("robot", result["estimate"]["duration"] - t))
+    return steps
+
+
+def line_profiles(stations: Dict[str, str], batch_size: int, kwargs: Optional[Dict[str, dict]] = None) -> Dict[str, list]:
+    """Profiles of the stations of a line, from their (cached) simulations
+    :param stations: the station class name of each step
+    :param batch_size: the samples in each plate
+    :param kwargs: keyword arguments for the station of each step"""
+    from .cache import SimulationCache
+    from .worker import station_class
+    cache = SimulationCache()
+    profiles = OrderedDict()
+    for step, name in stations.items():
+        cls = station_class(name)
+        logging.getLogger(cls.__name__).setLevel(logging.WARNING)
+        result = cache.simulate(cls, dict((kwargs or {}).get(step, {}), num_samples=batch_size))
+        profiles[step] = station_profile(result)
+    return profiles
+
+
+class Resource:
+    def __init__(self, names: List[str]):
+        """ Build a :py:class:`.Resource`: units (robots or operators) acquired in FIFO order.
+        :param names: the names of the units
+        """
+        self.names = names
+        self._free: Deque[int] = deque(range(len(names)))
+        self._waiting: Deque[Callable[[int], None]] = deque()
+        self.busy = [0.] * len(names)
+    
+    def request(self, callback: Callable[[int], None]) -> Optional[int]:
+        """Acquire a unit, or queue the callback until a unit is released
+        :return: the acquired unit, or None if queued"""
+        if self._free:
+            return self._free.popleft()
+        self._waiting.append(callback)
+        return None
+    
+    def release(self, unit: int) -> Optional[Callable[[int], None]]:
+        """Release a unit, handing it to the first waiting callback, if any
+        :return: the callback to be resumed with the unit"""
+        if self._waiting:
+            return self._waiting.popleft()
+        self._free.append(unit)
+        return None
+
+
+class LineSimulation:
+    def __init__(self, profiles: Dict[str, list], robots: Dict[str, int], operators: int = 1, shift: float = 8 * 3600,
+                 batch_size: int = 96, batches: Optional[int] = None, arrival_interval: float = 0,
+                 operator_time: float = DEFAULT_OPERATOR_TIME, handoff_time: float = DEFAULT_HANDOFF_TIME,
+                 external_times: Optional[Dict[str, float]] = None, external_time: float = DEFAULT_EXTERNAL_TIME,
+                 cv: float = 0.1, seed: Optional[int] = None):
+        """ Build a :py:class:`.LineSimulation`.
+        :param profiles: the profile of each step (see :py:func:`station_profile`)
+        :param robots: the number of robots of each step
+        :param operators: the number of operators
+        :param shift: the shift length in seconds: plates are started on the first step only within the shift
+        :param batch_size: the samples in each plate
+        :param batches: the maximum number of plates. Defaults to as many as the line can take in the shift
+        :param arrival_interval: interval in seconds between the arrivals of the plates. If 0, a plate is always ready for the first step
+        :param operator_time: nominal duration in seconds of an operator step at a robot
+        :param handoff_time: nominal duration in seconds of moving a plate to the next step
+        :param external_times: nominal duration in seconds of the external incubations, by stage
+        :param external_time: nominal duration in seconds of the other external incubations
+        :param cv: coefficient of variation of the durations
+        :param seed: the random seed
+        """
+        self.profiles = profiles
+        self.robots = OrderedDict((step, Resource(["{}{}".format(step, i + 1) for i in range(robots.get(step, 1))])) for step in profiles)
+        self.operators = Resource(["operator {}".format(i + 1) for i in range(operators)])
+        self.shift = shift
+        self.batch_size = batch_size
+        self.batches = batches
+        self.arrival_interval = arrival_interval
+        self.operator_time = operator_time
+        self.handoff_time = handoff_time
+        self.external_times = external_times or {}
+        self.external_time = external_time
+        self.cv = cv
+        self._rng = random.Random(seed)
+        self._events: List[tuple] = []
+        self._seq = 0
+        self.now = 0.
+        self.completed: List[float] = []
+        self.queue_delays: Dict[str, List[float]] = {step: [] for step in profiles}
+        self.cycle_times: Dict[str, List[float]] = {step: [] for step in profiles}
+        self.operator_delays: List[float] = []
+    
+    def duration(self, nominal: float) -> float:
+        """A duration drawn from a gamma distribution around the nominal value"""
+        if self.cv <= 0 or nominal <= 0:
+            return nominal
+        k = 1 / self.cv ** 2
+        return self._rng.gammavariate(k, nominal / k)
+    
+    def _schedule(self, t: float, callback: Callable, *args):
+        heapq.heappush(self._events, (t, self._seq, callback, args))
+        self._seq += 1
+    
+    def _start(self, process: Generator, value=None):
+        """Resume a process until it waits: for a duration (a number) or for a unit of a resource"""
+        try:
+            request = process.send(value)
+        except StopIteration:
+            return
+        if isinstance(request, Resource):
+            unit = request.request(lambda u: self._schedule(self.now, self._start, process, u))
+            if unit is not None:
+                self._start(process, unit)
+        else:
+            self._schedule(self.now + request, self._start, process)
+    
+    def _busy(self, resource: Resource, unit: int, t0: float):
+        """Account the time from t0 to now as busy, within the shift"""
+        resource.busy[unit] += max(min(self.now, self.shift) - min(t0, self.shift), 0)
+    
+    def _release(self, resource: Resource, unit: int):
+        callback = resource.release(unit)
+        if callback is not None:
+            callback(unit)
+    
+    def _operator_step(self, nominal: float):
+        t = self.now
+        operator = yield self.operators
+        self.operator_delays.append(self.now - t)
+        t = self.now
+        yield self.duration(nominal)
+        self._busy(self.operators, operator, t)
+        self._release(self.operators, operator)
+    
+    def _plate(self, robot: Optional[int] = None):
+        for step, profile in self.profiles.items():
+            resource = self.robots[step]
+            if robot is None:
+                t = self.now
+                robot = yield resource
+                self.queue_delays[step].append(self.now - t)
+            t = self.now
+            for kind, value in profile:
+                if kind == "robot":
+                    yield self.duration(value)
+                elif kind == "operator":
+                    yield from self._operator_step(self.operator_time)
+                else:
+                    yield self.duration(self.external_times.get(value, self.external_time))
+            yield from self._operator_step(self.handoff_time)
+            self._busy(resource, robot, t)
+            self.cycle_times[step].append(self.now - t)
+            self._release(resource, robot)
+            robot = None
+        self.completed.append(self.now)
+    
+    def _source(self):
+        n = 0
+        first = self.robots[next(iter(self.profiles))]
+        while self.now < self.shift and (self.batches is None or n < self.batches):
+            n += 1
+            if self.arrival_interval:
+                self._start(self._plate())
+                yield self.arrival_interval
+            else:
+                robot = yield first
+                if self.now >= self.shift:
+                    self._release(first, robot)
+                    break
+                self.queue_delays[next(iter(self.profiles))].append(0.)
+                self._start(self._plate(robot))
+    
+    def run(self) -> dict:
+        """Simulate the line until the plates started in the shift are completed"""
+        self._start(self._source())
+        while self._events:
+            self.now, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+        utilization = OrderedDict()
+        for resource in self.robots.values():
+            for name, busy in zip(resource.names, resource.busy):
+                utilization[name] = busy / self.shift
+        return {
+            "samples": sum(1 for t in self.completed if t <= self.shift) * self.batch_size,
+            "plates": len(self.completed),
+            "makespan": self.now,
+            "utilization": utilization,
+            "step_utilization": OrderedDict((step, float(np.mean(r.busy)) / self.shift) for step, r in self.robots.items()),
+            "operator_utilization": float(np.mean(self.operators.busy)) / self.shift,
+            "queue_delay": OrderedDict((step, float(np.mean(d)) if d else 0.) for step, d in self.queue_delays.items()),
+            # Samples per hour each step could process if never starved
+            "capacity": OrderedDict((step, len(self.robots[step].names) * self.batch_size * 3600 / float(np.mean(c)) if c else 0.)
+                                    for step, c in self.cycle_times.items()),
+            "operator_delay": float(np.mean(self.operator_delays)) if self.operator_delays else 0.,
+        }
+
+
+def simulate_line(config: dict, seed: Optional[int] = None) -> dict:
+    """Run one replication of the line simulation
+    :param config: keyword arguments for :py:class:`.LineSimulation`
+    :param seed: the random seed"""
+    return LineSimulation(seed=seed, **config).run()
+
+
+def _stats(values: List[float]) -> dict:
+    return dict(mean=float(np.mean(values)), **{"p{}".format(q): float(np.percentile(values, q)) for q in PERCENTILES})
+
+
+def replicate(config: dict, replications: int = 100, seed: int = 0, workers: Optional[int] = None) -> dict:
+    """Run Monte-Carlo replications of the line simulation in parallel processes and summarize them
+    :param config: keyword arguments for :py:class:`.LineSimulation`
+    :param replications: the number of replications
+    :param seed: the random seed of the first replication
+    :param workers: the number of processes. Defaults to the number of CPUs
+    :return: the statistics of the samples completed in the shift, of the utilisations, of the delays and of the capacities, and the bottleneck step"""
+    seeds = range(seed, seed + replications)
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and replications > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(simulate_line, [config] * replications, seeds,
+                                        chunksize=max(math.ceil(replications / (4 * workers)), 1)))
+    else:
+        results = [simulate_line(config, s) for s in seeds]
+    step_utilization = OrderedDict((step, _stats([r["step_utilization"][step] for r in results])) for step in config["profiles"])
+    capacity = OrderedDict((step, _stats([r["capacity"][step] for r in results])) for step in config["profiles"])
+    return {
+        "replications": replications,
+        "samples": _stats([r["samples"] for r in results]),
+        "throughput": float(np.mean([r["samples"] for r in results])) / (config.get("shift", 8 * 3600) / 3600),
+        "makespan": _stats([r["makespan"] for r in results]),
+        "utilization": OrderedDict((name, float(np.mean([r["utilization"][name] for r in results]))) for name in results[0]["utilization"]),
+        "step_utilization": step_utilization,
+        "operator_utilization": _stats([r["operator_utilization"] for r in results]),
+        "queue_delay": OrderedDict((step, _stats([r["queue_delay"][step] for r in results])) for step in config["profiles"]),
+        "operator_delay": _stats([r["operator_delay"] for r in results]),
+        "capacity": capacity,
+        "bottleneck": min(capacity, key=lambda step: capacity[step]["mean"]),
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        "samples in the shift: {mean:.0f} (p5 {p5:.0f}, p95 {p95:.0f})".format(**report["samples"]),
+        "throughput: {:.1f} samples/h".format(report["throughput"]),
+    ]
+    lines += ["{}: {:.0%} busy".format(name, u) for name, u in report["utilization"].items()]
+    lines.append("operators: {:.0%} busy, {:.1f} min mean wait".format(report["operator_utilization"]["mean"], report["operator_delay"]["mean"] / 60))
+    lines += ["{}: {:.1f} samples/h capacity, {:.1f} min mean queue".format(step, report["capacity"][step]["mean"], d["mean"] / 60)
+              for step, d in report["queue_delay"].items()]
+    lines.append("bottleneck: {}".format(report["bottleneck"]))
+    return "\n".join(lines)
+
+
+def _counts(items: List[str]) -> Dict[str, int]:
+    return {k: int(v) for k, v in (item.split("=") for item in items)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a line of A, B and C stations to size robots and operators")
+    parser.add_argument("-r", "--robots", nargs="*", default=[], help="number of robots of each step, e.g. A=1 B=2 C=1")
+    parser.add_argument("--operators", type=int, default=1, help="number of operators")
+    parser.add_argument("--shift", type=float, default=8, help="shift length in hours")
+    parser.add_argument("--batch", type=int, default=96, help="samples in each plate")
+    parser.add_argument("--batches", type=int, default=None, help="maximum number of plates (defaults to as many as the line can take)")
+    parser.add_argument("--arrival-interval", type=float, default=0, help="minutes between the arrivals of the plates (0 for always available)")
+    parser.add_argument("--operator-time", type=float, default=DEFAULT_OPERATOR_TIME / 60, help="minutes of an operator step at a robot")
+    parser.add_argument("--handoff-time", type=float, default=DEFAULT_HANDOFF_TIME / 60, help="minutes to move a plate to the next step")
+    parser.add_argument("--external-time", type=float, default=DEFAULT_EXTERNAL_TIME / 60, help="minutes of an external incubation")
+    parser.add_argument("--external-times", type=json.loads, default={}, help="JSON object of minutes of the external incubations, by stage")
+    parser.add_argument("--cv", type=float, default=0.1, help="coefficient of variation of the durations")
+    parser.add_argument("-s", "--stations", nargs="*", default=[], help="station class of each step, e.g. A=StationATechnogenetics48")
+    parser.add_argument("-p", "--profiles", default=None, help="JSON file with the profile of each step, instead of simulating the stations")
+    parser.add_argument("--save-profiles", default=None, help="the file path where to save the profiles JSON")
+    parser.add_argument("-n", "--replications", type=int, default=100, help="number of Monte-Carlo replications")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (defaults to the number of CPUs)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-o", "--output", default=None, help="the file path where to save the report JSON")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    if args.profiles:
+        with open(args.profiles) as f:
+            profiles = OrderedDict((step, [tuple(s) for s in p]) for step, p in json.load(f).items())
+    else:
+        stations = OrderedDict(DEFAULT_STATIONS)
+        stations.update(item.split("=", 1) for item in args.stations)
+        profiles = line_profiles(stations, args.batch)
+    if args.save_profiles:
+        with open(args.save_profiles, "w") as f:
+            json.dump(profiles, f, indent=2)
+    config = dict(
+        profiles=profiles,
+        robots=dict({step: 1 for step in STEPS}, **_counts(args.robots)),
+        operators=args.operators,
+        shift=args.shift * 3600,
+        batch_size=args.batch,
+        batches=args.batches,
+        arrival_interval=args.arrival_interval * 60,
+        operator_time=args.operator_time * 60,
+        handoff_time=args.handoff_time * 60,
+        external_times={stage: t * 60 for stage, t in args.external_times.items()},
+        external_time=args.external_time * 60,
+        cv=args.cv,
+    )
+    report = replicate(config, args.replications, args.seed, args.workers)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
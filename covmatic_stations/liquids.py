@@ -0,0 +1,91 @@
+"""Liquid classes.
+A liquid class collects the pipetting settings suited to a liquid: flow rates, air gap, delays
+and touch tip. Stations define the default classes of the liquids they handle from their
+keyword arguments and apply them with :py:meth:`Station.liquid`.
+Per-site tuning is read from the JSON file pointed by the OT_LIQUID_CLASSES_JSON environment
+variable, mapping liquid names to the settings to change, e.g.
+    {"lysis buffer": {"aspirate": 120}, "wash": {"aspirate": 150, "air_gap": 10}}"""
+from .profiles import Profile
+from typing import Dict, Optional
+import json
+import os
+
+
+_env_key = "OT_LIQUID_CLASSES_JSON"
+
+
+class LiquidClass:
+    _fields = ("aspirate", "dispense", "blow_out", "air_gap", "aspirate_delay", "dispense_delay", "touch_tip", "touch_tip_v_offset")
+    
+    def __init__(
+        self,
+        aspirate: Optional[float] = None,
+        dispense: Optional[float] = None,
+        blow_out: Optional[float] = None,
+        air_gap: float = 0,
+        aspirate_delay: float = 0,
+        dispense_delay: float = 0,
+        touch_tip: bool = False,
+        touch_tip_v_offset: float = -1,
+    ):
+        """ Build a :py:class:`.LiquidClass`. Flow rates left to None are not changed.
+        :param aspirate: aspiration flow rate in uL/s
+        :param dispense: dispensation flow rate in uL/s
+        :param blow_out: blowout flow rate in uL/s
+        :param air_gap: air gap volume after aspiration in uL
+        :param aspirate_delay: delay after aspiration in seconds
+        :param dispense_delay: delay after dispensation in seconds
+        :param touch_tip: whether to touch the tip after dispensation
+        :param touch_tip_v_offset: touch tip height from the top of the well in mm
+        """
+        self.aspirate = aspirate
+        self.dispense = dispense
+        self.blow_out = blow_out
+        self.air_gap = air_gap
+        self.aspirate_delay = aspirate_delay
+        self.dispense_delay = dispense_delay
+        self.touch_tip = touch_tip
+        self.touch_tip_v_offset = touch_tip_v_offset
+    
+    @property
+    def profile(self) -> Profile:
+        return Profile(aspirate=self.aspirate, dispense=self.dispense, blow_out=self.blow_out)
+    
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self._fields}
+    
+    def updated(self, **settings) -> 'LiquidClass':
+        """Copy of the liquid class with some settings changed"""
+        unknown = set(settings).difference(self._fields)
+        if unknown:
+            raise ValueError("unknown liquid class settings: {}".format(", ".join(sorted(unknown))))
+        return type(self)(**dict(self.to_dict(), **settings))
+    
+    def __repr__(self) -> str:
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(k, v) for k, v in self.to_dict().items()))
+
+
+def site_settings(fp: Optional[str] = None) -> Dict[str, dict]:
+    """Per-site liquid class settings, by liquid name
+    :param fp: JSON file path. Defaults to the one in the OT_LIQUID_CLASSES_JSON environment variable"""
+    fp = fp or os.environ.get(_env_key)
+    if not fp:
+        return {}
+    with open(fp, "r") as f:
+        return json.load(f)
+
+
+def registry(defaults: Dict[str, LiquidClass], *settings: Optional[Dict[str, dict]]) -> Dict[str, LiquidClass]:
+    """Merge the default liquid classes with the given settings, applied in order.
+    Settings for a liquid without a default class start from an empty class"""
+    classes = dict(defaults)
+    for s in settings:
+        for name, values in (s or {}).items():
+            classes[name] = classes.get(name, LiquidClass()).updated(**values)
+    return classes
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
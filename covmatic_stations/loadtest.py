@@ -0,0 +1,262 @@
+"""Load test of the station REST API.
+A station is simulated with its REST server on while N asyncio clients poll its endpoints
+(by default ``/log``, as the LocalWebServer does; ``/pause`` and ``/resume`` requests can be mixed in,
+but note that they actually pause the protocol until the next resume).
+Each run records the latency percentiles of the endpoints and the slowdown of the protocol command loop
+with respect to a run without clients. Short protocols can be simulated again and again for a fixed load duration, e.g.
+    python -m covmatic_stations.loadtest run StationBTechnogenetics -c 1 4 16 64 -o baseline.json
+    python -m covmatic_stations.loadtest compare baseline.json current.json
+The REST API has no streaming endpoints, so only request-response endpoints are exercised"""
+from .asynchttp import HTTPConnection
+from .benchmark import API_LEVEL
+from .multistation import StationThread, rest_kwargs
+from .worker import station_class
+from collections import defaultdict
+from itertools import cycle
+from typing import Dict, Iterable, List, Optional
+import argparse
+import asyncio
+import json
+import logging
+import numpy as np
+import sys
+import time
+
+
+DEFAULT_MIX = {"log": 1}
+PERCENTILES = (50, 90, 99)
+
+
+def schedule(mix: Dict[str, int]) -> List[str]:
+    """Sequence of endpoints with the specified proportions, with each pause followed by a resume.
+    The mix needs requests to at least one endpoint besides pause and resume, e.g.
+    >>> schedule({"log": 4, "pause": 1, "resume": 1})
+    ['pause', 'resume', 'log', 'log', 'log', 'log']
+    >>> schedule({"pause": 1, "resume": 1})
+    Traceback (most recent call last):
+    ...
+    ValueError: no requests besides pause and resume in the mix: {'pause': 1, 'resume': 1}"""
+    if not any(n > 0 for e, n in mix.items() if e not in ("pause", "resume")):
+        raise ValueError("no requests besides pause and resume in the mix: {}".format(mix))
+    mix = dict(mix)
+    pauses = min(mix.pop("pause", 0), mix.pop("resume", 0))
+    endpoints = [e for e, n in mix.items() for _ in range(n)]
+    step = max(len(endpoints) // max(pauses, 1), 1)
+    for i in range(pauses):
+        endpoints[i * step:i * step] = ["pause", "resume"]
+    return endpoints
+
+
+async def client(conn: HTTPConnection, endpoints: List[str], rate: float, stop: asyncio.Event,
+                 latencies: Dict[str, List[float]], errors: Dict[str, int], offset: float = 0):
+    """Send requests at the specified rate until stopped, recording their latency in milliseconds"""
+    await asyncio.sleep(offset)
+    loop = asyncio.get_event_loop()
+    t_next = loop.time()
+    for endpoint in cycle(endpoints):
+        if stop.is_set():
+            break
+        t = time.perf_counter()
+        try:
+            status, _ = await conn.get("/" + endpoint)
+        except Exception:
+            status = None
+        if stop.is_set():
+            break
+        if status == 200:
+            latencies[endpoint].append((time.perf_counter() - t) * 1000)
+        else:
+            errors[endpoint] += 1
+        t_next += 1 / rate
+        await asyncio.sleep(max(t_next - loop.time(), 0))
+    conn.close()
+
+
+async def _wait_server(host: str, port: int, thread: StationThread, timeout: float = 60):
+    t = time.perf_counter()
+    while thread.is_alive() and time.perf_counter() - t < timeout:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+    raise RuntimeError("the REST server on port {} did not start".format(port))
+
+
+async def _load(thread: StationThread, host: str, port: int, clients: int, rate: float, endpoints: List[str],
+                latencies: Dict[str, List[float]], errors: Dict[str, int]):
+    thread.start()
+    if clients:
+        await _wait_server(host, port, thread)
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(client(
+        HTTPConnection(host, port), endpoints[i % len(endpoints):] + endpoints[:i % len(endpoints)],
+        rate, stop, latencies, errors, offset=i / (rate * clients),
+    )) for i in range(clients)]
+    # Stop the clients as soon as the protocol finishes, before the server is shut down
+    while thread.is_alive() and thread.station.status not in ("finished", "aborted", "failed"):
+        await asyncio.sleep(0.05)
+    stop.set()
+    await asyncio.gather(*tasks)
+    while thread.is_alive():
+        await asyncio.sleep(0.05)
+
+
+def loop_stats(command_times: List[List[float]]) -> dict:
+    """Statistics of the intervals between the commands of the protocol runs, in milliseconds"""
+    intervals = np.concatenate([np.diff(t) * 1000 for t in command_times if len(t) > 1] or [np.zeros(1)])
+    return {"commands": sum(map(len, command_times)), "interval_mean": float(np.mean(intervals)), "interval_p99": float(np.percentile(intervals, 99))}
+
+
+def run_load(cls: type, clients: int, rate: float = 2, mix: Optional[Dict[str, int]] = None,
+             port: int = 8400, host: str = "127.0.0.1", duration: float = 0, **kwargs) -> dict:
+    """Simulate a station while polling its REST API
+    :param cls: the station class
+    :param clients: the number of concurrent clients (0 for a reference run)
+    :param rate: requests per second of each client
+    :param mix: proportions of the requests to each endpoint
+    :param port: the port of the REST server
+    :param host: the host of the REST server
+    :param duration: minimum load duration in seconds: the protocol is simulated again until it has elapsed
+    :param kwargs: keyword arguments for the station
+    :return: the latency percentiles by endpoint, the failed requests, the command loop statistics and the wall time"""
+    endpoints = schedule(mix or DEFAULT_MIX)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    command_times = []
+    wall_time = 0.
+    while not command_times or wall_time < duration:
+        station = cls(**dict(kwargs, metadata={'apiLevel': API_LEVEL}, tip_track=False, **rest_kwargs(port, host)))
+        thread = StationThread(station)
+        asyncio.get_event_loop().run_until_complete(_load(thread, host, port, clients, rate, endpoints, latencies, errors))
+        if thread.error is not None:
+            raise thread.error
+        command_times.append(thread.command_times)
+        wall_time += thread.wall_time
+    requests_count = sum(map(len, latencies.values()))
+    return {
+        "clients": clients,
+        "rate": rate,
+        "runs": len(command_times),
+        "requests": requests_count,
+        "throughput": requests_count / wall_time,
+        "latency": {e: {"p{}".format(q): float(np.percentile(v, q)) for q in PERCENTILES} for e, v in latencies.items()},
+        "errors": dict(errors),
+        "loop": loop_stats(command_times),
+        "wall_time": wall_time,
+    }
+
+
+def run(cls: type, clients: Iterable[int], rate: float = 2, mix: Optional[Dict[str, int]] = None, port: int = 8400,
+        duration: float = 0, logger: Optional[logging.Logger] = None, **kwargs) -> dict:
+    """Run the load test for each number of clients, after a reference run without clients"""
+    logger = logger or logging.getLogger(__name__)
+    logging.getLogger(cls.__name__).setLevel(logging.WARNING)
+    reference = run_load(cls, 0, rate, mix, port, duration=duration, **kwargs)
+    logger.info("no clients: {:.2f} s per run".format(reference["wall_time"] / reference["runs"]))
+    results = []
+    for n in clients:
+        r = run_load(cls, n, rate, mix, port, duration=duration, **kwargs)
+        # Compare the mean wall time of the runs, as the number of runs can differ
+        r["slowdown"] = (r["wall_time"] / r["runs"]) / (reference["wall_time"] / reference["runs"])
+        results.append(r)
+        logger.info("{} clients: {} requests ({:.1f}/s), /log p99 {:.1f} ms, slowdown {:.2f}x, {} errors".format(
+            n, r["requests"], r["throughput"], r["latency"].get("log", {}).get("p99", float("nan")),
+            r["slowdown"], sum(r["errors"].values())))
+    return {"station": cls.__name__, "kwargs": kwargs, "duration": duration, "reference": reference, "results": results}
+
+
+def error_rate(result: dict) -> float:
+    """Fraction of the requests of a load test result that failed"""
+    failed = sum(result["errors"].values())
+    return failed / max(failed + result["requests"], 1)
+
+
+def compare(baseline: dict, current: dict, latency_tolerance: Optional[float] = 0.5, slowdown_tolerance: float = 0.25,
+            error_tolerance: float = 0) -> List[str]:
+    """Compare two load test results with the same numbers of clients
+    :param baseline: the reference results
+    :param current: the results to check
+    :param latency_tolerance: relative increase allowed for the 99th percentile of the latencies.
+                              None to skip the latencies, which depend on the machine (e.g. for a baseline from another one)
+    :param slowdown_tolerance: increase allowed for the slowdown of the command loop
+    :param error_tolerance: increase allowed for the fraction of failed requests
+    :return: the regressions, as report lines"""
+    regressions = []
+    reference = {r["clients"]: r for r in baseline["results"]}
+    for r in current["results"]:
+        b = reference.get(r["clients"])
+        if b is None:
+            continue
+        label = "{} clients".format(r["clients"])
+        for endpoint, lat in (r["latency"] if latency_tolerance is not None else {}).items():
+            old = b["latency"].get(endpoint, {}).get("p99")
+            if old is not None and lat["p99"] > old * (1 + latency_tolerance):
+                regressions.append("{} /{} p99: {:.1f} ms -> {:.1f} ms".format(label, endpoint, old, lat["p99"]))
+        if r["slowdown"] > b["slowdown"] + slowdown_tolerance:
+            regressions.append("{} slowdown: {:.2f}x -> {:.2f}x".format(label, b["slowdown"], r["slowdown"]))
+        if error_rate(r) > error_rate(b) + error_tolerance:
+            regressions.append("{} errors: {:.2%} -> {:.2%}".format(label, error_rate(b), error_rate(r)))
+    return regressions
+
+
+def _mix(s: str) -> Dict[str, int]:
+    mix = {k: int(v) for k, v in (item.split("=") for item in s.split(","))}
+    schedule(mix)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the station REST API")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_run = subparsers.add_parser("run", help="run the load test")
+    parser_run.add_argument("station", nargs="?", default="StationBTechnogenetics", help="station class name or dotted path")
+    parser_run.add_argument("-c", "--clients", type=int, nargs="+", default=[1, 4, 16, 64], help="numbers of concurrent clients")
+    parser_run.add_argument("-r", "--rate", type=float, default=2, help="requests per second of each client")
+    parser_run.add_argument("-m", "--mix", type=_mix, default=DEFAULT_MIX, help="proportions of the requests, e.g. log=18,pause=1,resume=1")
+    parser_run.add_argument("-k", "--kwargs", type=json.loads, default={"num_samples": 32}, help="JSON object of keyword arguments for the station")
+    parser_run.add_argument("-d", "--duration", type=float, default=0, help="minimum load duration in seconds for each number of clients (the protocol is simulated again until it has elapsed)")
+    parser_run.add_argument("-p", "--port", type=int, default=8400, help="the port of the REST server")
+    parser_run.add_argument("-o", "--output", default=None, help="the file path where to save the results JSON")
+    parser_compare = subparsers.add_parser("compare", help="compare two results, exiting with an error on regressions")
+    parser_compare.add_argument("baseline", help="the reference results")
+    parser_compare.add_argument("current", help="the results to check")
+    parser_compare.add_argument("--latency-tolerance", type=float, default=0.5, help="relative increase allowed for the latency percentiles")
+    parser_compare.add_argument("--slowdown-tolerance", type=float, default=0.25, help="increase allowed for the slowdown of the command loop")
+    parser_compare.add_argument("--relative", action="store_true", help="compare only the slowdown and the errors, which do not depend on the machine")
+    parser_compare.add_argument("--error-tolerance", type=float, default=0, help="increase allowed for the fraction of failed requests")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger().setLevel(logging.WARNING)
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    
+    if args.command == "run":
+        results = run(station_class(args.station), args.clients, args.rate, args.mix, args.port, args.duration, logger=logger, **args.kwargs)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, None if args.relative else args.latency_tolerance, args.slowdown_tolerance, args.error_tolerance)
+        for line in regressions:
+            logger.warning(line)
+        logger.info("{} regressions".format(len(regressions)))
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,122 @@
+"""Simulation of many stations in the same process.
+Each station runs in its own thread, with its own event loop, logger (see the ``instance_name`` keyword argument
+of :py:class:`covmatic_stations.station.Station`) and optionally its own REST server, e.g. to simulate
+a line of A, B and C stations together or to load test the REST API with N copies of a station
+    python -m covmatic_stations.multistation StationA StationB StationC -n 2 --rest-port 8100"""
+from .benchmark import API_LEVEL
+from .station import Station
+from .worker import station_class
+from opentrons import simulate
+from opentrons.commands import types as command_types
+from threading import Thread
+from typing import Iterable, List, Optional
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import time
+
+
+class StationThread(Thread):
+    def __init__(self, station: Station, api_level: str = API_LEVEL):
+        """ Build a :py:class:`.StationThread`.
+        :param station: the station to simulate
+        :param api_level: the API level of the simulated protocol context
+        """
+        super(StationThread, self).__init__(daemon=True, name=station.logger_name)
+        self.station = station
+        self._api_level = api_level
+        self.error: Optional[Exception] = None
+        self.wall_time: Optional[float] = None
+        self.command_times: List[float] = []
+    
+    def _on_command(self, message):
+        if message['$'] == 'before':
+            self.command_times.append(time.perf_counter())
+    
+    def run(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        t = time.perf_counter()
+        try:
+            ctx = simulate.get_protocol_api(self._api_level)
+            ctx.broker.subscribe(command_types.COMMAND, self._on_command)
+            self.station.run(ctx)
+        except Exception as e:
+            self.error = e
+        self.wall_time = time.perf_counter() - t
+    
+    def result(self) -> dict:
+        estimator = self.station._estimator
+        return {
+            "station": self.station.logger_name,
+            "status": self.station.status,
+            "duration": None if estimator is None else estimator.elapsed / 60,
+            "pauses": None if estimator is None else estimator.pauses,
+            "overlapped": None if estimator is None else estimator.overlapped,
+            "wall_time": self.wall_time,
+            "error": None if self.error is None else "{}: {}".format(type(self.error).__name__, self.error),
+        }
+
+
+def rest_kwargs(port: int, host: str = "127.0.0.1") -> dict:
+    """Keyword arguments for a simulated station that serves the REST API on the specified port"""
+    from .request import DEFAULT_REST_KWARGS
+    rest_server_kwargs = copy.deepcopy(DEFAULT_REST_KWARGS)
+    rest_server_kwargs["config"]["global"].update({"server.socket_host": host, "server.socket_port": port})
+    return dict(rest_server_kwargs=rest_server_kwargs, sidecar_socket=None, simulation_log_lws=True)
+
+
+def station_copies(cls: type, n: int, rest_port: Optional[int] = None, **kwargs) -> List[Station]:
+    """Build N stations of the same class, each with its own instance name
+    :param cls: the station class
+    :param n: the number of stations
+    :param rest_port: if specified, the stations serve the REST API on consecutive ports from this one
+    :param kwargs: keyword arguments for the stations"""
+    return [cls(**dict(
+        kwargs,
+        instance_name=str(i + 1),
+        metadata={'apiLevel': API_LEVEL},
+        tip_track=False,
+        **({} if rest_port is None else rest_kwargs(rest_port + i)),
+    )) for i in range(n)]
+
+
+def simulate_stations(stations: Iterable[Station], api_level: str = API_LEVEL) -> List[StationThread]:
+    """Simulate the stations concurrently, each in its own thread, and wait for them to finish"""
+    threads = [StationThread(s, api_level) for s in stations]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many stations concurrently in the same process")
+    parser.add_argument("stations", nargs="+", help="station class names or dotted paths")
+    parser.add_argument("-n", "--copies", type=int, default=1, help="number of copies of each station")
+    parser.add_argument("-k", "--kwargs", type=json.loads, default={}, help="JSON object of keyword arguments for all the stations")
+    parser.add_argument("--rest-port", type=int, default=None, help="serve the REST API of the stations on consecutive ports from this one")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    stations = []
+    for name in args.stations:
+        port = None if args.rest_port is None else args.rest_port + len(stations)
+        stations += station_copies(station_class(name), args.copies, rest_port=port, **args.kwargs)
+    t = time.perf_counter()
+    threads = simulate_stations(stations)
+    for th in threads:
+        print(json.dumps(th.result()))
+    print("total wall time: {:.2f} s".format(time.perf_counter() - t))
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,366 @@
+"""Line orchestrator.
+Pipelines batches of plates through the A, B and C stations of a line. Each plate waits in the queue of its step;
+as soon as a robot of that step is free, the orchestrator starts the station on it through its REST sidecar
+(see :py:mod:`covmatic_stations.sidecar`), with the keyword arguments of the robot and the samples of the plate.
+When the run finishes, an operator moves the plate to the next step: the robot is busy until then.
+When a run fails, its plate is not moved on and the robot is held until it is checked: the plates waiting for a step
+whose robots are all held are blocked, and the orchestration ends when no plate can move on.
+The line is described by a JSON file
+    {
+        "robots": [
+            {"name": "A1", "url": "10.0.0.11", "step": "A", "station": "StationATechnogenetics48", "kwargs": {"language": "ITA"}},
+            {"name": "B1", "url": "10.0.0.12", "step": "B", "station": "StationBTechnogenetics"},
+            {"name": "C1", "url": "10.0.0.13", "step": "C", "station": "StationCTechnogenetics"}
+        ],
+        "operators": 1,
+        "handoff_time": 120
+    }
+and run with
+    python -m covmatic_stations.orchestrator line.json --plates 4
+With ``--stand-in``, the robots are replaced by local stand-in servers that play back the simulated stages
+of the stations, sped up by the time scale, so that the orchestration can be tested on a computer
+    python -m covmatic_stations.orchestrator line.json --plates 4 --stand-in --time-scale 0.005"""
+from .asynchttp import ConnectionPool
+from .fleet import robot_url
+from .line import DEFAULT_LINE, STEPS
+from .request import status_time
+from cheroot import wsgi
+from collections import deque
+from threading import Thread
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import cherrypy
+import json
+import logging
+import os
+import time
+
+
+class Plate:
+    def __init__(self, name: str, num_samples: int = 96):
+        """ Build a :py:class:`.Plate`.
+        :param name: the plate name
+        :param num_samples: the number of samples in the plate
+        """
+        self.name = name
+        self.num_samples = num_samples
+        self.step = STEPS[0]
+        self.state = "queued"
+        self.robot: Optional[str] = None
+        self.events: List[Tuple[float, str]] = []
+    
+    def event(self, t: float, what: str):
+        self.events.append((t, what))
+    
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "failed", "blocked")
+    
+    def to_dict(self) -> dict:
+        return {"name": self.name, "num_samples": self.num_samples, "step": self.step, "state": self.state, "robot": self.robot, "events": self.events}
+
+
+class Robot:
+    def __init__(self, name: str, url: str, step: str, station: str, kwargs: Optional[dict] = None):
+        """ Build a :py:class:`.Robot`.
+        :param name: the robot name
+        :param url: the base URL of its REST sidecar
+        :param step: the step of the line it performs (A, B or C)
+        :param station: the station class name or dotted path
+        :param kwargs: keyword arguments for the station
+        """
+        self.name = name
+        self.url = url
+        self.step = step
+        self.station = station
+        self.kwargs = kwargs or {}
+        self.plate: Optional[Plate] = None
+        self.status: dict = {}
+        self.busy_since = 0.
+        self.busy_time = 0.
+    
+    @property
+    def idle(self) -> bool:
+        """Whether the robot is reachable, with no plate and no run in progress.
+        A robot whose last run failed is held until it reports another status (e.g. after a run started by hand)"""
+        return self.plate is None and bool(self.status) and self.status.get("status") not in ("starting", "running", "pause", "failed")
+    
+    @property
+    def held(self) -> bool:
+        """Whether the last run of the robot failed and it has not been checked yet"""
+        return self.plate is None and self.status.get("status") == "failed"
+    
+    def release(self, t: float):
+        self.plate = None
+        self.busy_time += t - self.busy_since
+
+
+class Orchestrator:
+    def __init__(self, robots: List[Robot], plates: List[Plate], operators: int = 1, handoff_time: float = 120,
+                 interval: float = 2, timeout: float = 5, clock: Callable[[], float] = time.monotonic,
+                 token: Optional[str] = None, logger: Optional[logging.Logger] = None):
+        """ Build an :py:class:`.Orchestrator`.
+        :param robots: the robots of the line
+        :param plates: the plates to process, in order
+        :param operators: the number of operators moving the plates between the robots
+        :param handoff_time: time in seconds an operator takes to move a plate to the next step
+        :param interval: interval in seconds between polls of the robots
+        :param timeout: timeout in seconds for the requests to the robots
+        :param clock: current time in seconds
+        :param token: the token of the sidecars, needed to start the runs
+        :param logger: the logger
+        """
+        self.robots = robots
+        self.plates = plates
+        self.operators = operators
+        self._handoff_time = handoff_time
+        self._interval = interval
+        self._timeout = timeout
+        self._clock = clock
+        self._token = token
+        self.logger = logger or logging.getLogger(type(self).__name__)
+        self._pool: Optional[ConnectionPool] = None
+        self.queues: Dict[str, Deque[Plate]] = {step: deque() for step in STEPS}
+        self.queues[STEPS[0]].extend(plates)
+        self._handoffs: List[Tuple[float, Plate, Robot]] = []
+        self._start: Optional[float] = None
+    
+    def station_kwargs(self, robot: Robot, plate: Plate) -> dict:
+        return dict(robot.kwargs, num_samples=plate.num_samples)
+    
+    def _event(self, plate: Plate, what: str):
+        plate.event(self._clock() - self._start, what)
+        self.logger.info("{}: {}".format(plate.name, what))
+    
+    async def poll(self):
+        async def poll_robot(robot: Robot):
+            try:
+                status, body = await self._pool.get(robot.url + "/status")
+                robot.status = json.loads(body.decode()) if status == 200 else {}
+            except Exception as e:
+                self.logger.warning("{} unreachable: {}".format(robot.name, e))
+                robot.status = {}
+        await asyncio.gather(*map(poll_robot, self.robots))
+    
+    async def start(self, robot: Robot, plate: Plate) -> bool:
+        """Start the run of a plate on a robot"""
+        job = {"station": robot.station, "kwargs": self.station_kwargs(robot, plate)}
+        if self._token:
+            job["token"] = self._token
+        try:
+            status, body = await self._pool.post(robot.url + "/start", job)
+        except Exception as e:
+            status, body = None, str(e).encode()
+        if status != 200:
+            self.logger.warning("cannot start {} on {}: {}".format(plate.name, robot.name, body.decode()))
+            return False
+        robot.plate = plate
+        robot.busy_since = self._clock()
+        robot.status = {"status": "starting"}
+        plate.state = "running"
+        plate.robot = robot.name
+        self._event(plate, "started {} on {}".format(plate.step, robot.name))
+        return True
+    
+    def _update_runs(self):
+        for robot in self.robots:
+            plate = robot.plate
+            if plate is None or plate.state != "running":
+                continue
+            # The robots report "starting" as soon as a run is requested, so a finished status is never stale
+            status = robot.status.get("status")
+            if status == "finished":
+                plate.state = "waiting operator"
+                self._event(plate, "finished {} on {}".format(plate.step, robot.name))
+            elif status in ("aborted", "failed"):
+                # the plate is never moved on: it has to be checked by an operator
+                plate.state = "failed"
+                robot.release(self._clock())
+                self._event(plate, "{} on {}".format(status, robot.name))
+                if status == "failed":
+                    self.logger.error("{} failed on {}: {}, the robot is held until it is checked".format(
+                        plate.name, robot.name, robot.status.get("error") or robot.status.get("msg") or "unknown error"))
+    
+    def _update_handoffs(self, now: float):
+        for handoff in sorted(self._handoffs, key=lambda h: h[0]):
+            end, plate, robot = handoff
+            if end > now:
+                continue
+            self._handoffs.remove(handoff)
+            self.operators += 1
+            robot.release(now)
+            i = STEPS.index(plate.step) + 1
+            if i < len(STEPS):
+                plate.step = STEPS[i]
+                plate.state = "queued"
+                self.queues[plate.step].append(plate)
+                self._event(plate, "queued for {}".format(plate.step))
+            else:
+                plate.state = "done"
+                self._event(plate, "done")
+        waiting = [r for r in self.robots if r.plate is not None and r.plate.state == "waiting operator"]
+        for robot in sorted(waiting, key=lambda r: r.plate.events[-1][0]):
+            if not self.operators:
+                break
+            self.operators -= 1
+            robot.plate.state = "handoff"
+            self._handoffs.append((now + self._handoff_time, robot.plate, robot))
+            self._event(robot.plate, "moving from {}".format(robot.name))
+    
+    def _update_blocked(self):
+        for step, queue in self.queues.items():
+            robots = [r for r in self.robots if r.step == step]
+            if not queue or not all(r.held for r in robots):
+                continue
+            # No robot can take the plates of this step until an operator checks them
+            while queue:
+                plate = queue.popleft()
+                plate.state = "blocked"
+                self._event(plate, "blocked at {}: {} held".format(step, ", ".join(r.name for r in robots) or "no robots"))
+    
+    async def step(self):
+        """Poll the robots, move the finished plates on and start the runs that can start"""
+        now = self._clock()
+        await self.poll()
+        self._update_runs()
+        self._update_handoffs(now)
+        self._update_blocked()
+        for robot in self.robots:
+            queue = self.queues[robot.step]
+            if queue and robot.idle:
+                plate = queue.popleft()
+                if not await self.start(robot, plate):
+                    queue.appendleft(plate)
+    
+    async def run(self):
+        """Process all the plates"""
+        self._pool = ConnectionPool(self._timeout)
+        self._start = self._clock()
+        while not all(p.done for p in self.plates):
+            await self.step()
+            await asyncio.sleep(self._interval)
+        self._pool.close()
+    
+    def report(self) -> dict:
+        elapsed = self._clock() - self._start
+        return {
+            "elapsed": elapsed,
+            "plates": [p.to_dict() for p in self.plates],
+            "utilization": {r.name: r.busy_time / elapsed if elapsed else 0 for r in self.robots},
+            "held": [r.name for r in self.robots if r.held],
+        }
+
+
+class StandInRobot:
+    def __init__(self, port: int, time_scale: float = 0.01, host: str = "127.0.0.1"):
+        """ Build a :py:class:`.StandInRobot`: a local server with the API of the sidecar
+        that plays back the simulated stages of the stations instead of running them.
+        :param port: the HTTP port
+        :param time_scale: ratio between the playback time and the estimated robot time
+        :param host: the HTTP host
+        """
+        self._time_scale = time_scale
+        self._status = {"status": None, "station": None}
+        self._thread: Optional[Thread] = None
+        self._server = wsgi.Server((host, port), cherrypy.Application(self, "", config={}))
+        Thread(target=self._server.safe_start, daemon=True).start()
+    
+    def stop(self):
+        self._server.stop()
+    
+    def _play(self, station: str, kwargs: dict):
+        from .cache import SimulationCache
+        from .worker import station_class
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        try:
+            stages = SimulationCache().simulate(station_class(station), kwargs)["stages"]
+        except Exception as e:
+            self._status = {"status": "failed", "station": station, "error": str(e)}
+            return
+        for stage in stages:
+            self._status = {"status": "running", "station": station, "stage": stage["stage"], "time": status_time()}
+            time.sleep(stage["duration"] * self._time_scale)
+        self._status = dict(self._status, status="finished")
+    
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def status(self) -> dict:
+        return self._status
+    
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def start(self) -> dict:
+        if self._thread is not None and self._thread.is_alive():
+            cherrypy.response.status = 409
+            return {"error": "a run is in progress"}
+        job = cherrypy.request.json
+        self._status = {"status": "starting", "station": job.get("station")}
+        self._thread = Thread(target=self._play, args=(job.get("station", ""), job.get("kwargs") or {}), daemon=True)
+        self._thread.start()
+        return {"pid": None}
+
+
+def load_line(line: dict, robot_port: int = 8080) -> Tuple[List[Robot], int, float]:
+    """Robots, number of operators and handoff time of a line description"""
+    robots = [Robot(r["name"], robot_url(r["url"], robot_port), r["step"], r["station"], r.get("kwargs")) for r in line["robots"]]
+    return robots, line.get("operators", 1), line.get("handoff_time", 120)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline plates through the A, B and C stations of a line")
+    parser.add_argument("line", nargs="?", default=None, help="JSON file describing the line (defaults to one robot for each step)")
+    parser.add_argument("-n", "--plates", type=int, default=1, help="number of plates")
+    parser.add_argument("-s", "--samples", type=int, default=96, help="samples in each plate")
+    parser.add_argument("-i", "--interval", type=float, default=2, help="interval in seconds between polls of the robots")
+    parser.add_argument("--stand-in", action="store_true", help="replace the robots with local stand-in servers")
+    parser.add_argument("--stand-in-port", type=int, default=8600, help="first port of the stand-in servers")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="time scale of the stand-in servers (also applied to the handoff time)")
+    parser.add_argument("--token", default=os.environ.get("OT_SIDECAR_TOKEN"), help="the token of the sidecars (defaults to the environment variable OT_SIDECAR_TOKEN)")
+    parser.add_argument("-o", "--output", default=None, help="the file path where to save the report JSON")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    logger = logging.getLogger(Orchestrator.__name__)
+    logger.setLevel(logging.INFO)
+    
+    line = DEFAULT_LINE
+    if args.line:
+        with open(args.line) as f:
+            line = json.load(f)
+    robots, operators, handoff_time = load_line(line)
+    stand_ins = []
+    if args.stand_in:
+        cherrypy.config.update({"log.screen": False})
+        for i, robot in enumerate(robots):
+            stand_ins.append(StandInRobot(args.stand_in_port + i, args.time_scale))
+            robot.url = "http://127.0.0.1:{}".format(args.stand_in_port + i)
+        handoff_time *= args.time_scale
+    plates = [Plate("plate {}".format(i + 1), args.samples) for i in range(args.plates)]
+    orchestrator = Orchestrator(robots, plates, operators, handoff_time, interval=args.interval, token=args.token, logger=logger)
+    asyncio.get_event_loop().run_until_complete(orchestrator.run())
+    for s in stand_ins:
+        s.stop()
+    
+    report = orchestrator.report()
+    print("elapsed: {:.1f} s".format(report["elapsed"]))
+    for name, u in report["utilization"].items():
+        print("{}: {:.0%} busy".format(name, u))
+    for name in report["held"]:
+        print("{}: held after a failed run, to be checked".format(name))
+    blocked = [p["name"] for p in report["plates"] if p["state"] == "blocked"]
+    if blocked:
+        print("blocked: {}".format(", ".join(blocked)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,92 @@
+"""Plate passports.
+At the end of a run, each station writes a passport for each of its output plates: the number of samples,
+the positive control well, the map from the plate wells to the sample tubes, and the steps the plate went through,
+each with its station, start and end time, stage timestamps, reagent lots and tips used.
+A downstream station takes the passports of its input plates (keyword argument ``passport``: a passport,
+a list of passports, or the path or URL of one) as its configuration source: the number of samples
+and the fields listed in :py:attr:`Station._passport_fields` (e.g. the positive control well) are taken from them,
+and the steps are carried forward to its own passports.
+The REST sidecar serves the last passports of the robot on ``/passport``"""
+from typing import Dict, Iterable, List, Optional, Union
+import json
+import logging
+import requests
+
+
+PASSPORT_VERSION = 1
+DEFAULT_PASSPORT_FILEPATH = '/var/lib/jupyter/notebooks/outputs/passport_{}.json'
+
+
+def load_passport(source: Union[str, dict], timeout: float = 10) -> dict:
+    """Load a passport from a JSON file or from a URL. Dictionaries are returned as they are"""
+    if isinstance(source, dict):
+        return source
+    if source.startswith(("http://", "https://")):
+        response = requests.get(source, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    with open(source) as f:
+        return json.load(f)
+
+
+def load_passports(source: Union[None, str, dict, list]) -> List[dict]:
+    """Load the passports of the input plates, one for each plate"""
+    if source is None:
+        return []
+    if isinstance(source, list):
+        return [load_passport(s) for s in source]
+    return [load_passport(source)]
+
+
+def passport_kwargs(passports: List[dict], fields: Iterable[str], kwargs: Optional[dict] = None, logger: Optional[logging.Logger] = None) -> dict:
+    """Station keyword arguments from the passports of the input plates
+    :param passports: the passports of the input plates
+    :param fields: the passport fields that are station keyword arguments
+    :param kwargs: the keyword arguments specified by hand, which are overridden with a warning if they differ
+    :param logger: the logger for the warnings"""
+    logger = logger or logging.getLogger(__name__)
+    config = {"num_samples": sum(p["num_samples"] for p in passports)}
+    config.update((f, passports[0][f]) for f in fields if passports[0].get(f) is not None)
+    for k, v in config.items():
+        if k in (kwargs or {}) and kwargs[k] != v:
+            logger.warning("{} = {} replaced by {} from the plate passport".format(k, kwargs[k], v))
+    for p in passports:
+        steps = p.get("steps") or [{}]
+        status = steps[-1].get("status")
+        if status == "failed":
+            logger.warning("plate {} failed on {}: {}".format(p.get("plate"), steps[-1].get("station"), steps[-1].get("error")))
+        elif status != "finished":
+            logger.warning("plate {} was not finished by {} ({})".format(p.get("plate"), steps[-1].get("station"), status))
+    return config
+
+
+def plate_passport(upstream: Union[None, dict, List[dict]], plate: str, num_samples: int, step: dict,
+                   well_map: Optional[Dict[str, str]] = None, **fields) -> dict:
+    """Passport of an output plate
+    :param upstream: the passport of the input plate, if any, or the passports of the input plates
+    that went to the output plate (e.g. the source plates of station C), which are kept as its inputs
+    :param plate: the plate identifier, used unless there is exactly one input plate
+    :param num_samples: the number of samples on the plate
+    :param step: the run of the station on the plate
+    :param well_map: the map from the plate wells to the sample tubes, if set by the station
+    :param fields: further fields set by the station (e.g. the positive control well)"""
+    if isinstance(upstream, list):
+        if len(upstream) > 1:
+            passport = dict(version=PASSPORT_VERSION, plate=plate, num_samples=num_samples, inputs=upstream)
+            passport.update((k, v) for k, v in fields.items() if v is not None)
+            passport["well_map"] = well_map or {}
+            passport["steps"] = [step]
+            return passport
+        upstream = upstream[0] if upstream else None
+    upstream = upstream or {}
+    passport = dict(upstream, version=PASSPORT_VERSION, plate=upstream.get("plate", plate), num_samples=num_samples)
+    passport.update((k, v) for k, v in fields.items() if v is not None)
+    passport["well_map"] = well_map or upstream.get("well_map", {})
+    passport["steps"] = upstream.get("steps", []) + [step]
+    return passport
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,99 @@
+"""Motion and pipette settings profiles.
+A profile groups the flow rates and speeds suited to a kind of movement or liquid.
+Profiles are applied in ``with`` blocks that restore the previous settings on exit, so that
+settings changed for one step do not leak into the following ones. The stations run with the
+``travel`` profile (the fastest safe gantry speed, with no limit on the Z speed), so that gantry moves
+between locations keep the fastest speed, while the slow Z speed only applies within the
+:py:meth:`Station.near_liquid` blocks"""
+from contextlib import contextmanager
+from typing import Optional
+
+
+FLOW_RATES = ('aspirate', 'dispense', 'blow_out')
+
+
+class Profile:
+    def __init__(
+        self,
+        aspirate: Optional[float] = None,
+        dispense: Optional[float] = None,
+        blow_out: Optional[float] = None,
+        default_speed: Optional[float] = None,
+        z_speed: Optional[float] = None,
+        unlimited_z: bool = False,
+    ):
+        """ Build a :py:class:`.Profile`. Settings left to None are not changed.
+        :param aspirate: aspiration flow rate in uL/s
+        :param dispense: dispensation flow rate in uL/s
+        :param blow_out: blowout flow rate in uL/s
+        :param default_speed: pipette movement speed in mm/s
+        :param z_speed: maximum speed of the Z axis of the pipette mount in mm/s
+        :param unlimited_z: remove any maximum speed of the Z axis of the pipette mount
+        """
+        self.flow_rates = {k: v for k, v in zip(FLOW_RATES, (aspirate, dispense, blow_out)) if v is not None}
+        self.default_speed = default_speed
+        self.z_speed = z_speed
+        self.unlimited_z = unlimited_z
+
+
+PROFILES = {
+    "travel": Profile(default_speed=400, unlimited_z=True),
+    "near-liquid": Profile(z_speed=20),
+}
+
+
+def z_axis(pip) -> str:
+    """Gantry axis moving the pipette vertically"""
+    return 'A' if pip.mount == 'right' else 'Z'
+
+
+def set_max_speed(ctx, axis: str, value: Optional[float]):
+    """Set the maximum speed of a gantry axis (None for no limit)"""
+    if value is not None or ctx.max_speeds.get(axis) is not None:
+        ctx.max_speeds[axis] = value
+
+
+def recording(pip) -> bool:
+    """Whether the pipette is an :py:class:`covmatic_stations.ir.OperationRecorder`, buffering the speed limits too"""
+    return hasattr(type(pip), 'set_max_speed')
+
+
+@contextmanager
+def applied(pip, profile: Profile, ctx=None):
+    """Apply a profile in a block, restoring the previous settings on exit
+    :param pip: the pipette
+    :param profile: the profile
+    :param ctx: the ProtocolContext, needed for profiles limiting the Z speed"""
+    flow_rates = {k: getattr(pip.flow_rate, k) for k in profile.flow_rates}
+    default_speed = pip.default_speed
+    axis = z_axis(pip)
+    limit_z = ctx is not None and (profile.z_speed is not None or profile.unlimited_z)
+    recorder = recording(pip)
+    z_speed = (pip.max_speed(ctx, axis) if recorder else ctx.max_speeds.get(axis)) if limit_z else None
+    for k, v in profile.flow_rates.items():
+        setattr(pip.flow_rate, k, v)
+    if profile.default_speed is not None:
+        pip.default_speed = profile.default_speed
+    if limit_z:
+        if recorder:
+            pip.set_max_speed(ctx, axis, profile.z_speed)
+        else:
+            set_max_speed(ctx, axis, profile.z_speed)
+    try:
+        yield pip
+    finally:
+        for k, v in flow_rates.items():
+            setattr(pip.flow_rate, k, v)
+        if profile.default_speed is not None:
+            pip.default_speed = default_speed
+        if limit_z:
+            if recorder:
+                pip.set_max_speed(ctx, axis, z_speed)
+            else:
+                set_max_speed(ctx, axis, z_speed)
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
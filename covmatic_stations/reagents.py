@@ -0,0 +1,131 @@
+"""Reagent requirement planning.
+Given the volume each column (or sample) draws from a reagent, the planner computes the
+exact fill volume of every source well, including headroom and the labware dead volume,
+and assigns consecutive columns to the source wells so that they deplete evenly"""
+from itertools import accumulate
+from typing import Dict, Iterable, List, Optional, Sequence
+import math
+
+
+# Volume in uL that cannot be aspirated from one well, by labware load name
+DEAD_VOLUMES = {
+    'nest_12_reservoir_15ml': 1000,
+    'nest_1_reservoir_195ml': 10000,
+}
+
+
+class ReagentRequirement:
+    def __init__(
+        self,
+        name: str,
+        wells: Sequence,
+        demands: Sequence[float],
+        headroom: float = 1,
+        dead_volume: Optional[float] = None,
+        capacity: Optional[float] = None,
+        tubes: int = 1,
+    ):
+        """ Build a :py:class:`.ReagentRequirement`.
+        :param name: name of the reagent
+        :param wells: source wells that can be used, in order of use
+        :param demands: volume drawn from the source by each column (or sample) in uL
+        :param headroom: headroom for the reagent volume (as a multiplier)
+        :param dead_volume: volume that cannot be aspirated from a well in uL. If not specified, it is looked up by labware in DEAD_VOLUMES
+        :param capacity: capacity of a well in uL. If not specified, the maximum volume of the well is used
+        :param tubes: number of tubes that each well stands for (e.g. 8 for a PCR strip accessed by a multichannel pipette)
+        """
+        self.name = name
+        self.wells = list(wells)
+        self.demands = list(demands)
+        self.headroom = headroom
+        self.dead_volume = dead_volume
+        self.capacity = capacity
+        self.tubes = tubes
+
+
+class ReagentAllocation:
+    def __init__(self, requirement: ReagentRequirement, assignment: List[int], fills: List[float], capacity: Optional[float]):
+        self.requirement = requirement
+        self.assignment = assignment
+        self.fills = fills
+        self.capacity = capacity
+    
+    @property
+    def name(self) -> str:
+        return self.requirement.name
+    
+    @property
+    def wells(self) -> list:
+        """Source wells that have to be filled"""
+        return self.requirement.wells[:len(self.fills)]
+    
+    @property
+    def column_wells(self) -> list:
+        """Source well for each column (or sample)"""
+        return [self.requirement.wells[i] for i in self.assignment]
+    
+    @property
+    def overflow(self) -> bool:
+        return self.capacity is not None and any(f > self.capacity for f in self.fills)
+    
+    @property
+    def total(self) -> float:
+        return sum(self.fills) * self.requirement.tubes
+
+
+def balanced_assignment(demands: Sequence[float], num_wells: int) -> List[int]:
+    """Assign consecutive columns to wells, cutting where the cumulative demand is closest to an even share
+    :param demands: volume drawn by each column
+    :param num_wells: number of wells to use
+    :returns: the well index for each column"""
+    n = len(demands)
+    num_wells = min(num_wells, n)
+    if num_wells <= 0:
+        return []
+    cum = list(accumulate(demands))
+    ends = []
+    start = 0
+    for k in range(1, num_wells):
+        target = cum[-1] * k / num_wells
+        # leave at least one column for each of the remaining wells
+        start = min(range(start + 1, n - num_wells + k + 1), key=lambda e: abs(cum[e - 1] - target))
+        ends.append(start)
+    ends.append(n)
+    assignment = []
+    start = 0
+    for k, e in enumerate(ends):
+        assignment += [k] * (e - start)
+        start = e
+    return assignment
+
+
+def plan_reagent(req: ReagentRequirement, dead_volumes: Optional[Dict[str, float]] = None) -> ReagentAllocation:
+    """Use the least number of wells that can hold the reagent and balance the columns among them"""
+    dead_volumes = DEAD_VOLUMES if dead_volumes is None else dead_volumes
+    load_name = getattr(getattr(req.wells[0], "parent", None), "load_name", None) if req.wells else None
+    dead = req.dead_volume if req.dead_volume is not None else dead_volumes.get(load_name, 0)
+    capacity = req.capacity if req.capacity is not None else getattr(req.wells[0], "max_volume", None) if req.wells else None
+    max_wells = min(len(req.wells), len(req.demands))
+    
+    total = sum(req.demands) * req.headroom
+    if capacity is None or capacity <= dead:
+        num = max_wells
+    else:
+        num = min(max_wells, max(1, math.ceil(total / (capacity - dead))))
+    
+    while True:
+        assignment = balanced_assignment(req.demands, num)
+        fills = [dead + req.headroom * sum(d for d, a in zip(req.demands, assignment) if a == k) for k in range(num)]
+        if capacity is None or num >= max_wells or max(fills) <= capacity:
+            return ReagentAllocation(req, assignment, fills, capacity)
+        num += 1
+
+
+def plan_reagents(requirements: Iterable[ReagentRequirement], dead_volumes: Optional[Dict[str, float]] = None) -> Dict[str, ReagentAllocation]:
+    return {r.name: plan_reagent(r, dead_volumes) for r in requirements}
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
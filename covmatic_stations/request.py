@@ -1,6 +1,7 @@
 from opentrons.protocol_api import ProtocolContext
 from typing import Callable, Optional
 from threading import Thread
+from cheroot import wsgi
 import cherrypy
 import datetime
 import copy
@@ -27,15 +28,104 @@ DEFAULT_REST_KWARGS = dict(
 
 
 class KillerThread(Thread):
-    def __init__(self, delay: float = 1):
-        super(KillerThread, self).__init__()
+    def __init__(self, delay: float = 1, station: Optional['Station'] = None):
+        """ Build a :py:class:`.KillerThread`.
+        :param delay: time in seconds before killing the process
+        :param station: if specified, the process is not killed when the run of the station has ended by then
+        """
+        super(KillerThread, self).__init__(daemon=True)
         self._t = delay
+        self._station = station
     
     def run(self):
         time.sleep(self._t)
+        if self._station is not None and getattr(self._station, "status", None) in ("finished", "aborted", "failed"):
+            return
         os.kill(os.getpid(), 9)  # 9 -> SIGKILL
 
 
+def query_int(value: str, name: str) -> int:
+    """Integer value of a query parameter, answering with a 400 error if it is not valid"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise cherrypy.HTTPError(400, "invalid {}: {}".format(name, value))
+
+
+def query_float(value: str, name: str) -> float:
+    """Float value of a query parameter, answering with a 400 error if it is not valid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise cherrypy.HTTPError(400, "invalid {}: {}".format(name, value))
+
+
+def client_ip(ip: str) -> str:
+    """IP address of a client, with IPv4-mapped IPv6 addresses in IPv4 form"""
+    try:
+        ip = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    ipv4 = ip.ipv4_mapped if isinstance(ip, ipaddress.IPv6Address) else None
+    ip = str(ip) if ipv4 is None else str(ipv4)
+    return "127.0.0.1" if ip == "::1" else ip
+
+
+def set_runlog_ip(station: 'Station', ip: str):
+    """Send the run log of the station to the LocalWebServer at the specified address"""
+    lws_logger = getattr(station, "_lws_logger", None)
+    if lws_logger:
+        lws_logger.ip = ip
+        station.logger.debug("Set runlog URL to: {}".format(lws_logger.url))
+
+
+def station_status(station: 'Station', status: Optional[str] = None) -> dict:
+    """Status of the station as served by the REST API
+    :param station: the station
+    :param status: status that overrides the one of the station until the run ends (e.g. "pause")
+    """
+    station_status = getattr(station, "status", None)
+    # The tip lists hold the wells, and copying them would copy the whole labware
+    tip_log = {k: copy.deepcopy(v) for k, v in getattr(station, "_tip_log", {}).items() if k != "tips"}
+    return {
+        "station": type(station).__name__,
+        "status": station_status if station_status in ("finished", "aborted", "failed") or status is None else status,
+        "stage": getattr(station, "stage", None),
+        "msg": getattr(station, "msg", None),
+        "external": getattr(station, "external", False),
+        "temp": getattr(getattr(station, "_tempdeck", None), "temperature", None),
+        "tips": tip_log,
+        "refills": getattr(station, "pending_refills", {}),
+        "runlog": station._log_filepath,
+        "eta": getattr(station, "eta", None),
+        "overlapped": getattr(getattr(station, "_estimator", None), "overlapped", None),
+        "pause_reason": getattr(station, "pause_reason", None),
+        "pause_start": getattr(station, "pause_start", None),
+    }
+
+
+STATUS_TIME_FORMAT = "%m/%d/%Y, %H:%M:%S:%f"
+
+
+def status_time() -> str:
+    return datetime.datetime.now().strftime(STATUS_TIME_FORMAT)
+
+
+def served_status(status: dict) -> dict:
+    """Status with the time it is served at and how long the current pause has lasted, in seconds"""
+    now = datetime.datetime.now()
+    start = status.get("pause_start")
+    return dict(status, time=now.strftime(STATUS_TIME_FORMAT), pause_duration=None if start is None else round(
+        (now - datetime.datetime.strptime(start, STATUS_TIME_FORMAT)).total_seconds(), 1))
+
+
+def download_favicon(url: Optional[str], config: Optional[dict]):
+    """Download the favicon to the file served by the configuration, if it is not there yet"""
+    filename = (config or {}).get("/favicon.ico", {}).get("tools.staticfile.filename")
+    if url and filename and not os.path.exists(filename):
+        os.system("wget {} -O {}".format(url, filename))
+
+
 class StationRESTServer:
     def __init__(self, ctx: ProtocolContext, station: Optional['Station'] = None, config: Optional[dict] = None, favicon_url: Optional[str] = None):
         super(StationRESTServer, self).__init__()
@@ -47,39 +137,18 @@ class StationRESTServer:
     
     @cherrypy.expose
     def log(self) -> str:
-        lws_logger = getattr(self._station, "_lws_logger", None)
-        if lws_logger:
-            ip = cherrypy.request.remote.ip
-            try:
-                ip = ipaddress.ip_address(ip)
-            except ValueError:
-                pass
-            else:
-                ipv4 = ip.ipv4_mapped if isinstance(ip, ipaddress.IPv6Address) else None
-                ip = str(ip) if ipv4 is None else str(ipv4)
-                if ip == "::1":
-                    ip = "127.0.0.1"
-            lws_logger.ip = ip
-            self._station.logger.debug("Set runlog URL to: {}".format(lws_logger.url))
+        set_runlog_ip(self._station, client_ip(cherrypy.request.remote.ip))
         
         if self._station._wait_first_log and self._station._waiting_first_log:
             self._station._ctx.resume()
             return json.dumps({})
         
-        status = getattr(self._station, "status", None)
-        tip_log = copy.deepcopy(getattr(self._station, "_tip_log", {}))
-        if "tips" in tip_log:
-            del tip_log["tips"]
-        return json.dumps({
-            "status": status if status == "finished" or self._status is None else self._status,
-            "stage": getattr(self._station, "stage", None),
-            "msg": getattr(self._station, "msg", None),
-            "external": getattr(self._station, "external", False),
-            "time": datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S:%f"),
-            "temp": getattr(getattr(self._station, "_tempdeck", None), "temperature", None),
-            "tips": tip_log,
-            "runlog": self._station._log_filepath,
-        }, indent=2)
+        return json.dumps(served_status(station_status(self._station, self._status)), indent=2)
+    
+    @cherrypy.expose
+    def status(self) -> str:
+        """Same as log, for monitors: it does not redirect the run log to the client"""
+        return json.dumps(served_status(station_status(self._station, self._status)), indent=2)
     
     @cherrypy.expose
     def pause(self):
@@ -92,19 +161,39 @@ class StationRESTServer:
         self._ctx.resume()
     
     @cherrypy.expose
-    def kill(self, delay: str = '1'):
-        KillerThread(delay=float(delay)).start()
-
-    @staticmethod
-    def stop():
-        cherrypy.engine.exit()
+    def refill(self, buffer: str = '1') -> str:
+        source_refilled = getattr(self._station, "source_refilled", None)
+        return json.dumps({"refilled": source_refilled is not None and source_refilled(query_int(buffer, "buffer"))})
+    
+    @cherrypy.expose
+    def kill(self, delay: str = '30'):
+        """Abort the run at the next robot command, killing the process if it does not stop within the grace period"""
+        delay = query_float(delay, "delay")
+        self._station.abort()
+        KillerThread(delay=delay, station=self._station).start()
 
 
 class StationRESTServerThread(StationRESTServer, Thread):
+    """REST server of a station, running in its own thread.
+    Each instance has its own WSGI server (the global section of the configuration sets its host and port),
+    so that more stations can serve the API on distinct ports in the same process"""
+    def __init__(self, *args, **kwargs):
+        super(StationRESTServerThread, self).__init__(*args, **kwargs)
+        self.daemon = True
+        config = copy.deepcopy(self._config or {})
+        server_config = config.pop("global", {})
+        self._server = wsgi.Server(
+            (server_config.get("server.socket_host", "::"), server_config.get("server.socket_port", 8080)),
+            cherrypy.Application(self, "", config=config),
+        )
+    
     def run(self):
-        if self._icon_url and self._config and "tools.staticfile.filename" in self._config.get("/favicon.ico", {}):
-            os.system("wget {} -O {}".format(self._icon_url, self._config["/favicon.ico"]["tools.staticfile.filename"]))
-        cherrypy.quickstart(self, config=self._config)
+        download_favicon(self._icon_url, self._config)
+        self._server.prepare()
+        self._server.serve()
+    
+    def stop(self):
+        self._server.stop()
     
     def join(self, timeout=None, after: float = 0):
         if after:
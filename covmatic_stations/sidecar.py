@@ -0,0 +1,451 @@
+"""Long-lived REST sidecar.
+The sidecar is a service that runs on the robot independently of the protocols. It owns the HTTP port of the
+station REST API and talks to the running station over a Unix socket, so that the LocalWebServer can reach
+the robot between runs too (the last status is kept, also across restarts of the sidecar) and the protocols
+do not have to start a web server each time.
+Start it on the robot with
+    python -m covmatic_stations.sidecar
+Stations connect to it at the beginning of the run when its socket exists, otherwise they start their own
+in-process server as before.
+
+Messages on the socket are compact JSON objects, one per line:
+ - station to sidecar: ``{"t": "hello", "pid": ..., "station": ...}``, ``{"t": "status", "s": {...}, "w": ...}``
+   and ``{"t": "reply", "id": ..., "v": ...}``
+ - sidecar to station: ``{"t": "cmd", "cmd": ..., "id": ..., "args": {...}}``
+
+Runs can also be started over the REST API, posting the station and its keyword arguments as JSON to ``/start``
+(see :py:mod:`covmatic_stations.launch`). Only the keyword arguments in :py:data:`START_KWARGS` are accepted, and the
+request must carry the token of the sidecar (``"token"`` in the JSON body) or, if the sidecar has no token, come from
+the robot itself. The last plate passports of the robot are served on ``/passport?plate=1``
+(see :py:mod:`covmatic_stations.passport`).
+A ``kill`` request aborts the run at the next robot command, saving the tip log and the state as in a normal
+ending. The protocol process is killed only if it does not stop within the grace period"""
+from .passport import DEFAULT_PASSPORT_FILEPATH
+from .request import DEFAULT_REST_KWARGS, client_ip, download_favicon, query_float, query_int, served_status, set_runlog_ip, station_status
+from opentrons.protocol_api import ProtocolContext
+from threading import Event, Lock, Thread, Timer
+from typing import Iterable, List, Optional
+import argparse
+import cherrypy
+import copy
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+DEFAULT_SIDECAR_SOCKET = "/tmp/covmatic-sidecar.sock"
+DEFAULT_SIDECAR_STATE = "/var/lib/jupyter/notebooks/outputs/sidecar_status.json"
+FINAL_STATUSES = ("finished", "aborted", "failed")
+START_KWARGS = ("language", "num_samples", "passport", "plan_interventions", "reagent_lots", "samples_per_col", "skip_delay", "start_at", "wait_first_log")
+
+
+def send_message(sock: socket.socket, message: dict):
+    sock.sendall(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+
+class MessageReader:
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._buf = b""
+    
+    def read(self) -> List[dict]:
+        """Read the messages that are available on the socket.
+        Raise :py:class:`EOFError` when the connection is closed"""
+        data = self._sock.recv(4096)
+        if not data:
+            raise EOFError
+        *lines, self._buf = (self._buf + data).split(b"\n")
+        return [json.loads(line) for line in lines if line]
+
+
+class SidecarClient(Thread):
+    def __init__(self, ctx: ProtocolContext, station: 'Station', path: str = DEFAULT_SIDECAR_SOCKET, interval: float = 0.5):
+        """ Build a :py:class:`.SidecarClient` and connect it to the sidecar.
+        It can be used in place of :py:class:`covmatic_stations.request.StationRESTServerThread`.
+        :param ctx: the protocol context of the run
+        :param station: the running station
+        :param path: the sidecar socket
+        :param interval: interval in seconds between status updates
+        """
+        super(SidecarClient, self).__init__(daemon=True)
+        self._ctx = ctx
+        self._station = station
+        self._interval = interval
+        self._status = None
+        self._sent = None
+        self._stop_event = Event()
+        self._send_lock = Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.settimeout(interval)
+        self.send({"t": "hello", "pid": os.getpid(), "station": type(station).__name__})
+    
+    def send(self, message: dict):
+        with self._send_lock:
+            send_message(self._sock, message)
+    
+    def send_status(self, force: bool = False):
+        status = station_status(self._station, self._status)
+        waiting = bool(self._station._wait_first_log and self._station._waiting_first_log)
+        if force or (status, waiting) != self._sent:
+            self.send({"t": "status", "s": status, "w": waiting})
+            self._sent = (status, waiting)
+    
+    def handle(self, message: dict):
+        cmd = message.get("cmd")
+        args = message.get("args", {})
+        value = None
+        if cmd == "pause":
+            self._status = "pause"
+            self._ctx.pause()
+        elif cmd == "resume":
+            self._status = None
+            self._ctx.resume()
+        elif cmd == "refill":
+            source_refilled = getattr(self._station, "source_refilled", None)
+            value = source_refilled is not None and source_refilled(int(args.get("buffer", 1)))
+        elif cmd == "log":
+            set_runlog_ip(self._station, args.get("ip"))
+            if self._station._wait_first_log and self._station._waiting_first_log:
+                self._ctx.resume()
+        elif cmd == "kill":
+            self._station.abort()
+        else:
+            self._station.logger.warning("Unknown sidecar command: {}".format(cmd))
+        if "id" in message:
+            self.send({"t": "reply", "id": message["id"], "v": value})
+        self.send_status(force=True)
+    
+    def run(self):
+        reader = MessageReader(self._sock)
+        while not self._stop_event.is_set():
+            try:
+                self.send_status()
+                messages = reader.read()
+            except socket.timeout:
+                continue
+            except (EOFError, OSError, ValueError):
+                break
+            for m in messages:
+                self.handle(m)
+    
+    def join(self, timeout=None, after: float = 0):
+        if after:
+            time.sleep(after)
+        self._stop_event.set()
+        try:
+            self.send_status(force=True)
+        except OSError:
+            pass
+        super(SidecarClient, self).join(timeout=timeout)
+        self._sock.close()
+
+
+class Sidecar:
+    def __init__(self, path: str = DEFAULT_SIDECAR_SOCKET, state_filepath: Optional[str] = DEFAULT_SIDECAR_STATE, timeout: float = 5, simulate: bool = False,
+                 token: Optional[str] = None, start_kwargs: Iterable[str] = START_KWARGS, logger: Optional[logging.Logger] = None):
+        """ Build a :py:class:`.Sidecar`.
+        :param path: the socket the stations connect to
+        :param state_filepath: file where the last status is saved at the end of each run (None to disable)
+        :param timeout: time in seconds to wait for the station to reply to a command
+        :param simulate: simulate the runs started over the REST API (e.g. for testing on a computer)
+        :param token: the token the requests to start a run must carry (None to only accept them from the robot itself)
+        :param start_kwargs: the station keyword arguments accepted when starting a run
+        :param logger: the logger
+        """
+        self._path = path
+        self._state_filepath = state_filepath
+        self._timeout = timeout
+        self._simulate = simulate
+        self._token = token
+        self._start_kwargs = frozenset(start_kwargs)
+        self._process: Optional[subprocess.Popen] = None
+        self.logger = logger or logging.getLogger(type(self).__name__)
+        self._lock = Lock()
+        self._conn: Optional[socket.socket] = None
+        self._ids = itertools.count()
+        self._replies = {}
+        self._runlog_ip = None
+        self.pid: Optional[int] = None
+        self.waiting_first_log = False
+        self._kill_requested = False
+        self.status = self.load_state()
+    
+    def load_state(self) -> dict:
+        if self._state_filepath and os.path.exists(self._state_filepath):
+            with open(self._state_filepath) as f:
+                return dict(json.load(f), connected=False)
+        return {"status": None, "connected": False}
+    
+    def save_state(self):
+        if self._state_filepath:
+            os.makedirs(os.path.dirname(self._state_filepath), exist_ok=True)
+            tmp = self._state_filepath + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.status, f, indent=2)
+            os.replace(tmp, self._state_filepath)
+    
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+    
+    @property
+    def busy(self) -> bool:
+        """Whether a station is running (or starting)"""
+        if self.connected:
+            return True
+        if self._process is not None and self._process.poll() is not None:
+            if self.status.get("status") == "starting":
+                self.status = dict(self.status, status="failed", returncode=self._process.returncode)
+            self._process = None
+        return self._process is not None
+    
+    def authorized(self, ip: str, token: Optional[str] = None) -> bool:
+        """Whether a client may start a run: it must have the token of the sidecar or, without one, be the robot itself"""
+        if self._token:
+            return isinstance(token, str) and hmac.compare_digest(token, self._token)
+        try:
+            return ipaddress.ip_address(client_ip(ip)).is_loopback
+        except ValueError:
+            return False
+    
+    def start_run(self, station: str, kwargs: Optional[dict] = None) -> int:
+        """Start a run in a new process
+        :param station: the station class name or dotted path
+        :param kwargs: keyword arguments for the station
+        :return: the process id"""
+        from .worker import station_class
+        station_class(station)  # raises ValueError for the unknown stations, before starting a process
+        kwargs = dict(kwargs or {})
+        unknown = sorted(set(kwargs) - self._start_kwargs)
+        if unknown:
+            raise ValueError("keyword arguments not allowed: {}".format(", ".join(unknown)))
+        with self._lock:
+            if self.busy:
+                raise RuntimeError("a run is in progress")
+            kwargs["sidecar_socket"] = self._path
+            args = [sys.executable, "-m", __package__ + ".launch", station, json.dumps(kwargs)]
+            self._process = subprocess.Popen(args + (["--simulate"] if self._simulate else []))
+            self.status = {"status": "starting", "station": station, "connected": False}
+        self.logger.info("Started {} (pid {})".format(station, self._process.pid))
+        return self._process.pid
+    
+    def start(self):
+        """Listen for stations on the socket"""
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._path)
+        server.listen(1)
+        Thread(target=self._accept, args=(server,), daemon=True).start()
+        self.logger.info("Listening for stations on {}".format(self._path))
+    
+    def stop(self):
+        if self._conn is not None:
+            self._conn.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+    
+    def _accept(self, server: socket.socket):
+        while True:
+            conn, _ = server.accept()
+            Thread(target=self._serve, args=(conn,), daemon=True).start()
+    
+    def _serve(self, conn: socket.socket):
+        with self._lock:
+            if self._conn is not None:
+                self.logger.warning("A new station connected, dropping the previous one")
+                self._conn.close()
+            self._conn = conn
+            self._runlog_ip = None
+        reader = MessageReader(conn)
+        try:
+            while True:
+                for m in reader.read():
+                    self._handle(m)
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+                    self.pid = None
+                    self.waiting_first_log = False
+                    if self.status.get("status") not in FINAL_STATUSES:
+                        # The run ended without reporting it (e.g. killed or crashed)
+                        if self._kill_requested:
+                            self.status["status"] = "aborted"
+                        else:
+                            self.status.update(status="failed", error="the station disconnected during the run")
+                    self.status["connected"] = False
+                    self.save_state()
+            self.logger.info("Station {} disconnected".format(self.status.get("station")))
+    
+    def _handle(self, message: dict):
+        kind = message.get("t")
+        if kind == "hello":
+            self.pid = message.get("pid")
+            self._kill_requested = False
+            self.status = {"status": None, "station": message.get("station"), "connected": True}
+            self.logger.info("Station {} connected (pid {})".format(message.get("station"), self.pid))
+        elif kind == "status":
+            self.status = dict(message.get("s", {}), station=self.status.get("station"), connected=True)
+            self.waiting_first_log = bool(message.get("w"))
+        elif kind == "reply":
+            reply = self._replies.get(message.get("id"))
+            if reply is not None:
+                reply[1] = message.get("v")
+                reply[0].set()
+    
+    def command(self, cmd: str, wait: bool = False, **kwargs):
+        """Send a command to the running station
+        :param cmd: the command
+        :param wait: wait for the reply of the station and return its value
+        :param kwargs: arguments of the command
+        :return: the value of the reply, if waited for, otherwise None"""
+        conn = self._conn
+        if conn is None:
+            return None
+        message = {"t": "cmd", "cmd": cmd}
+        if kwargs:
+            message["args"] = kwargs
+        reply = None
+        if wait:
+            message["id"] = next(self._ids)
+            reply = self._replies[message["id"]] = [Event(), None]
+        try:
+            send_message(conn, message)
+            if reply is not None and reply[0].wait(self._timeout):
+                return reply[1]
+        except OSError:
+            pass
+        finally:
+            if reply is not None:
+                del self._replies[message["id"]]
+        return None
+    
+    def log(self, ip: str) -> dict:
+        """Status for a client polling from the specified address"""
+        self.busy  # refresh the status of the starting runs
+        if self.connected and (ip != self._runlog_ip or self.waiting_first_log):
+            self._runlog_ip = ip
+            self.command("log", ip=ip)
+            if self.waiting_first_log:
+                return {}
+        return served_status(self.status)
+    
+    def kill(self, grace: float):
+        """Abort the run, killing the protocol process if it does not stop within the grace period"""
+        pid = self.pid
+        self._kill_requested = True
+        self.command("kill")
+        if pid is not None:
+            Timer(grace, self._force_kill, args=(pid,)).start()
+    
+    def _force_kill(self, pid: int):
+        if self.pid == pid:
+            self.logger.warning("Station did not abort within the grace period, killing process {}".format(pid))
+            os.kill(pid, signal.SIGKILL)
+
+
+class SidecarREST:
+    def __init__(self, sidecar: Sidecar, passport_filepath: str = DEFAULT_PASSPORT_FILEPATH):
+        self._sidecar = sidecar
+        self._passport_filepath = passport_filepath
+    
+    @cherrypy.expose
+    def log(self) -> str:
+        return json.dumps(self._sidecar.log(client_ip(cherrypy.request.remote.ip)), indent=2)
+    
+    @cherrypy.expose
+    def status(self) -> str:
+        self._sidecar.busy  # refresh the status of the starting runs
+        return json.dumps(served_status(self._sidecar.status), indent=2)
+    
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def start(self) -> dict:
+        job = cherrypy.request.json
+        if not isinstance(job, dict) or not isinstance(job.get("station", ""), str) or not isinstance(job.get("kwargs") or {}, dict):
+            raise cherrypy.HTTPError(400, "the job must be a JSON object with a station and its keyword arguments")
+        if not self._sidecar.authorized(client_ip(cherrypy.request.remote.ip), job.get("token")):
+            raise cherrypy.HTTPError(403, "not allowed to start a run")
+        try:
+            return {"pid": self._sidecar.start_run(job.get("station", ""), job.get("kwargs"))}
+        except ValueError as e:
+            cherrypy.response.status = 400
+            return {"error": str(e)}
+        except RuntimeError as e:
+            cherrypy.response.status = 409
+            return {"error": str(e)}
+    
+    @cherrypy.expose
+    def passport(self, plate: str = '1') -> str:
+        filepath = self._passport_filepath.format(query_int(plate, "plate"))
+        if not os.path.exists(filepath):
+            raise cherrypy.HTTPError(404, "no passport for plate {}".format(plate))
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        with open(filepath) as f:
+            return f.read()
+    
+    @cherrypy.expose
+    def pause(self):
+        self._sidecar.command("pause")
+    
+    @cherrypy.expose
+    def resume(self):
+        self._sidecar.command("resume")
+    
+    @cherrypy.expose
+    def refill(self, buffer: str = '1') -> str:
+        return json.dumps({"refilled": bool(self._sidecar.command("refill", wait=True, buffer=query_int(buffer, "buffer")))})
+    
+    @cherrypy.expose
+    def kill(self, delay: str = '30'):
+        self._sidecar.kill(query_float(delay, "delay"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the station REST API across protocol runs")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_REST_KWARGS["config"]["global"]["server.socket_port"], help="the HTTP port")
+    parser.add_argument("--host", default=DEFAULT_REST_KWARGS["config"]["global"]["server.socket_host"], help="the HTTP host")
+    parser.add_argument("-s", "--socket", default=DEFAULT_SIDECAR_SOCKET, help="the socket the stations connect to")
+    parser.add_argument("--state", default=DEFAULT_SIDECAR_STATE, help="the file where the last status is saved")
+    parser.add_argument("--passport", default=DEFAULT_PASSPORT_FILEPATH, help="the plate passport files, with a placeholder for the plate number")
+    parser.add_argument("--simulate", action="store_true", help="simulate the runs started over the REST API")
+    parser.add_argument("--token", default=os.environ.get("OT_SIDECAR_TOKEN"), help="the token needed to start the runs over the REST API (defaults to the environment variable OT_SIDECAR_TOKEN; without it, only the robot itself can start them)")
+    parser.add_argument("--allow-kwarg", action="append", default=[], help="another station keyword argument accepted when starting a run")
+    args = parser.parse_args()
+    
+    config = copy.deepcopy(DEFAULT_REST_KWARGS["config"])
+    config["global"].update({"server.socket_host": args.host, "server.socket_port": args.port})
+    download_favicon(DEFAULT_REST_KWARGS["favicon_url"], config)
+    
+    sidecar = Sidecar(args.socket, state_filepath=args.state or None, simulate=args.simulate, token=args.token, start_kwargs=START_KWARGS + tuple(args.allow_kwarg))
+    sidecar.start()
+    cherrypy.engine.subscribe("stop", sidecar.stop)
+    cherrypy.quickstart(SidecarREST(sidecar, passport_filepath=args.passport), config=config)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
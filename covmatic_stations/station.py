@@ -1,19 +1,37 @@
 from . import __version__, __file__ as module_path
-from .request import StationRESTServerThread, DEFAULT_REST_KWARGS
+from .request import StationRESTServerThread, DEFAULT_REST_KWARGS, STATUS_TIME_FORMAT, status_time
+from .sidecar import DEFAULT_SIDECAR_SOCKET, SidecarClient
 from .utils import ProtocolContextLoggingHandler, LocalWebServerLogger
 from .lights import Button, BlinkingLightHTTP, BlinkingLight
+from .reagents import DEAD_VOLUMES, ReagentAllocation, ReagentRequirement, plan_reagents
+from .interventions import Intervention, InterventionPlanner, InterventionTrace
+from .estimate import DurationEstimator
+from .profiles import PROFILES, Profile, applied
+from .liquids import LiquidClass, registry, site_settings
+from .ir import OperationPass, OperationRecorder, TipReuseCheckPass, default_passes
+from .passport import DEFAULT_PASSPORT_FILEPATH, load_passports, passport_kwargs, plate_passport
+from .ledger import DEFAULT_LEDGER_FILEPATH, SampleLedger
+from .history import DEFAULT_HISTORY_FILEPATH, RunHistory, stage_durations
+from .cache import SimulationCache
 from opentrons.protocol_api import ProtocolContext
 from opentrons.types import Point
-from opentrons import commands
+from opentrons.commands import types as command_types
+from opentrons import config as ot_config
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
 from functools import wraps, partialmethod
 from itertools import chain
+from threading import Thread, current_thread
 from opentrons.types import Location
-from typing import Optional, Callable, Tuple
+from typing import Optional, Callable, Dict, Hashable, Iterable, List, Set, Tuple, Union
+import datetime
 import json
 import math
 import os
 import logging
+import re
+import sqlite3
 import time
 
 
@@ -46,6 +64,14 @@ def first_row(rack):
     return rack.rows()[0]
 
 
+# Progress counters in the stage names (e.g. 'transfer sample 3/95')
+_stage_counter = re.compile(r" \d+/\d+")
+
+
+class StationAborted(Exception):
+    pass
+
+
 class StationMeta(ABCMeta):
     def __new__(meta, name, bases, classdict):
         c = super(StationMeta, meta).__new__(meta, name, bases, classdict)
@@ -56,6 +82,17 @@ class StationMeta(ABCMeta):
             c._messages = {}
         return c
     
+    def __call__(cls, *args, **kwargs):
+        # The configuration from the passports of the input plates is applied before the constructor
+        passports = load_passports(kwargs.get("passport"))
+        if passports:
+            kwargs = dict(kwargs, passport=passports, **passport_kwargs(passports, cls._passport_fields, kwargs, logging.getLogger(cls.__name__)))
+        obj = super(StationMeta, cls).__call__(*args, **kwargs)
+        # Keep the arguments for building a copy of the station (e.g. for simulating ahead)
+        obj._init_args = args
+        obj._init_kwargs = kwargs
+        return obj
+    
     def get_message(cls, key: str, lan: str = 'ENG'):
         for c in cls.__mro__:
             d = getattr(c, '_messages', {})
@@ -68,23 +105,40 @@ class StationMeta(ABCMeta):
 
 class Station(metaclass=StationMeta):
     _protocol_description = "[BRIEFLY DESCRIBE YOUR PROTOCOL]"
+    # Whether samples exceeding a plate are processed on further plates in the same run
+    _multi_plate: bool = False
+    _plate_capacity: int = 96
+    # Keyword arguments written to the plate passports and taken from the passports of the input plates
+    _passport_fields: Tuple[str, ...] = ()
     
     def __init__(self,
+        dead_volumes: Optional[Dict[str, float]] = None,
         drop_loc_l: float = 0,
         drop_loc_r: float = 0,
         drop_loc_y: float = 0,
         drop_threshold: int = 296,
         dummy_lights: bool = True,
+        fast_simulation: bool = False,
+        history_filepath: Optional[str] = DEFAULT_HISTORY_FILEPATH,
+        instance_name: Optional[str] = None,
         jupyter: bool = True,
         log_filepath: Optional[str] = '/var/lib/jupyter/notebooks/outputs/run_{}.log',
         log_lws_ip: Optional[str] = None,
         log_lws_endpoint: str = ":5002/log",
         logger: Optional[logging.getLoggerClass()] = None,
         language: str = "ENG",
+        ledger_filepath: Optional[str] = DEFAULT_LEDGER_FILEPATH,
+        liquid_classes: Optional[Dict[str, dict]] = None,
         metadata: Optional[dict] = None,
         num_samples: int = 96,
+        optimize_operations: bool = False,
+        passport: Union[None, str, dict, List[dict]] = None,
+        passport_filepath: Optional[str] = DEFAULT_PASSPORT_FILEPATH,
+        plan_interventions: bool = False,
+        reagent_lots: Optional[Dict[str, str]] = None,
         rest_server_kwargs: dict = DEFAULT_REST_KWARGS,
         samples_per_col: int = 8,
+        sidecar_socket: Optional[str] = DEFAULT_SIDECAR_SOCKET,
         skip_delay: bool = False,
         start_at: Optional[str] = None,
         simulation_log_file: bool = False,
@@ -95,33 +149,78 @@ class Station(metaclass=StationMeta):
         wait_first_log: bool = False,
         **kwargs,
     ):
+        self._dead_volumes = dict(DEAD_VOLUMES, **(dead_volumes or {}))
         self._drop_loc_l = drop_loc_l
         self._drop_loc_r = drop_loc_r
         self._drop_loc_y = drop_loc_y
         self._drop_threshold = drop_threshold
         self._dummy_lights = dummy_lights
+        self._fast_simulation = fast_simulation
+        self._history_filepath = history_filepath
+        self._instance_name = instance_name
         self.jupyter = jupyter
         self._language = language
+        self._ledger_filepath = ledger_filepath
+        self._liquid_classes = liquid_classes
+        self._liquids: Optional[Dict[str, LiquidClass]] = None
         self._log_filepath = log_filepath.format(time.strftime("%Y_%m_%d__%H_%M_%S"))
         self._log_lws_ip = log_lws_ip
         self._log_lws_endpoint = log_lws_endpoint
         self._logger = logger
         self.metadata = metadata
         self._num_samples = num_samples
+        self._optimize_operations = optimize_operations
+        self._passport: List[dict] = load_passports(passport)
+        self._passport_filepath = passport_filepath
+        self._plan_interventions = plan_interventions
+        self._reagent_lots = reagent_lots or {}
         self._rest_server_kwargs = rest_server_kwargs
         self._samples_per_col = samples_per_col
+        self._sidecar_socket = sidecar_socket
         self._start_at = start_at
         self._skip_delay = skip_delay
         self._tip_log_filename = tip_log_filename
         self._tip_log_folder_path = tip_log_folder_path
         self._tip_track = tip_track
         self._ctx: Optional[ProtocolContext] = None
+        self._comment_handler: Optional[ProtocolContextLoggingHandler] = None
+        self._log_file_handler: Optional[logging.FileHandler] = None
         self._drop_count = 0
+        self._plate_idx = 0
+        self._load_sheet_plates = set()
+        self._reagent_plan: Optional[Tuple[Hashable, Dict[str, ReagentAllocation]]] = None
+        self._run_id: Optional[str] = None
+        self._run_start: Optional[str] = None
+        self._stage_times: Dict[int, Dict[str, str]] = {}
+        self._tips_used: Dict[int, Dict[str, int]] = {}
+        self._well_maps: Dict[int, Dict[str, str]] = {}
+        self._stage_log: List[Tuple[int, str, float]] = []
+        # Durations of the stages tracked apart from the stage log, e.g. by the lanes of pipelined runs
+        self._stage_durations: List[Tuple[int, str, float, float]] = []
+        self._pause_log: List[dict] = []
+        self._run_error: Optional[str] = None
+        self._stage_name = ""
+        self.pause_start: Optional[str] = None
+        self.pause_reason: Optional[str] = None
+        self.passports: List[dict] = []
+        self.ledger = SampleLedger()
+        self._run_epoch = 0.
+        self._estimator: Optional[DurationEstimator] = None
+        self._recorders: List[OperationRecorder] = []
+        self._operation_passes: List[OperationPass] = []
+        self._planner: Optional[InterventionPlanner] = None
+        self._trace: Optional[InterventionTrace] = None
+        self._estimated_duration: Optional[float] = None
+        self._slot = 0
         self._side_switch = True
         self._simulation_log_file = simulation_log_file
         self._simulation_log_lws = simulation_log_lws
         self._wait_first_log = wait_first_log
         self._waiting_first_log = False
+        self._abort_requested = False
+        self._abort_pending = False
+        self._run_threads: Set[Thread] = set()
+        self._request = None
         self.status = "initializing"
         self.stage = None
         self._msg = ""
@@ -153,32 +252,80 @@ class Station(metaclass=StationMeta):
         return self.msg
     
     def run_stage(self, stage: str) -> bool:
-        self.stage = stage
+        self.stage = stage if self.num_plates == 1 else "plate {}/{} {}".format(self._plate_idx + 1, self.num_plates, stage)
         if self._start_at == self.stage:
             self._run_stage = True
         self.logger.info("[{}] Stage: {}".format("x" if self._run_stage else " ", self.stage))
+        name = _stage_counter.sub("", stage)
+        self._stage_name = name
+        if self._run_stage:
+            self._stage_times.setdefault(self._plate_idx, OrderedDict()).setdefault(name, status_time())
+            if not self._stage_log or self._stage_log[-1][:2] != (self._plate_idx, name):
+                self._stage_log.append((self._plate_idx, name, self.timestamp()))
         return self._run_stage
     
+    @property
+    def fast_simulation(self) -> bool:
+        """Whether the run is a simulation without side effects: no REST server, lights, log comments, log files and tip log"""
+        return self._fast_simulation and self._ctx is not None and self._ctx.is_simulating()
+    
+    @property
+    def remaining_time(self) -> Optional[float]:
+        """Estimated robot time to the end of the run in seconds, excluding the pauses.
+        It is known when the interventions are planned, as they simulate the whole run beforehand"""
+        if self._estimated_duration is None or self._estimator is None:
+            return None
+        return max(self._estimated_duration - self._estimator.elapsed, 0)
+    
+    @property
+    def eta(self) -> Optional[str]:
+        """Estimated end time of the run, excluding the pauses"""
+        remaining = self.remaining_time
+        if remaining is None or self.status in ("finished", "aborted", "failed"):
+            return None
+        return (datetime.datetime.now() + datetime.timedelta(seconds=remaining)).strftime(STATUS_TIME_FORMAT)
+    
     @property
     def logger(self) -> logging.getLoggerClass():
         if ((not hasattr(self, "_logger")) or self._logger is None) and self._ctx is not None:
             self._logger = logging.getLogger(self.logger_name)
-            self._logger.addHandler(ProtocolContextLoggingHandler(self._ctx))
+            if not self.fast_simulation:
+                self._comment_handler = ProtocolContextLoggingHandler(self._ctx)
+                self._logger.addHandler(self._comment_handler)
         return self._logger
     
+    def remove_log_handlers(self):
+        """Stop forwarding the logs to the ProtocolContext and to the log file.
+        The loggers are shared by the stations with the same logger name, so that the handlers are removed after each run"""
+        if self._comment_handler is not None:
+            self._logger.removeHandler(self._comment_handler)
+            self._comment_handler = None
+            self._logger = None
+        if self._log_file_handler is not None:
+            logging.getLogger('opentrons').removeHandler(self._log_file_handler)
+            self._log_file_handler.close()
+            self._log_file_handler = None
+    
     def setup_opentrons_logger(self):
         stack_logger = logging.getLogger('opentrons')
         stack_logger.setLevel(self.logger.getEffectiveLevel())
+        self._lws_logger = LocalWebServerLogger(self._log_lws_ip, self._log_lws_endpoint)
+        if self.fast_simulation:
+            return
         if self._log_filepath and (self._simulation_log_file or not self._ctx.is_simulating()):
             os.makedirs(os.path.dirname(self._log_filepath), exist_ok=True)
-            stack_logger.addHandler(logging.FileHandler(self._log_filepath))
-        self._lws_logger = LocalWebServerLogger(self._log_lws_ip, self._log_lws_endpoint)
+            self._log_file_handler = logging.FileHandler(self._log_filepath)
+            stack_logger.addHandler(self._log_file_handler)
         if self._simulation_log_lws or not self._ctx.is_simulating():
-            self._ctx.broker.subscribe(commands.command_types.COMMAND, self._lws_logger)
+            self._ctx.broker.subscribe(command_types.COMMAND, self._lws_logger)
     
     @property
     def logger_name(self) -> str:
-        return self.__class__.__name__
+        """Name of the station logger: the class name, followed by the instance name if specified
+        (e.g. 'StationB.2'), so that more stations of the same class can run in the same process"""
+        if self._instance_name is None:
+            return self.__class__.__name__
+        return "{}.{}".format(self.__class__.__name__, self._instance_name)
     
     @classmethod
     def loaders(cls, key: str) -> map:
@@ -213,9 +360,20 @@ class Station(metaclass=StationMeta):
     def instruments(self) -> dict:
         return self.equipment(self.instrument_loaders())
     
+    @property
+    def num_plates(self) -> int:
+        return math.ceil(self._num_samples/self._plate_capacity) if self._multi_plate else 1
+    
+    @property
+    def plate_samples(self) -> int:
+        """Number of samples on the current plate"""
+        if self.num_plates == 1:
+            return self._num_samples
+        return min(self._num_samples - self._plate_idx * self._plate_capacity, self._plate_capacity)
+    
     @property
     def num_cols(self) -> int:
-        return math.ceil(self._num_samples/self._samples_per_col)
+        return math.ceil(self.plate_samples/self._samples_per_col)
     
     @property
     def _tip_log_filepath(self) -> str:
@@ -232,26 +390,63 @@ class Station(metaclass=StationMeta):
             self.logger.info(self.msg_format("tip info log", self._tip_log_filepath))
             if os.path.isfile(self._tip_log_filepath):
                 with open(self._tip_log_filepath) as json_file:
-                    data: dict = json.load(json_file).get("count", {})
+                    data: dict = json.load(json_file)
         else:
             self.logger.debug("not using tip log file")
         
+        rack_tips = {t: list(map(first_row if getattr(self, p).channels > 1 else wells, getattr(self, t))) for t, p in self._tipracks().items()}
+        self._rack_sizes = {t: list(map(len, r)) for t, r in rack_tips.items()}
         self._tip_log = {
-            'count': {t: data.get(t, 0) for t in self._tipracks().keys()},
-            'tips': {t: list(chain.from_iterable(map(first_row if getattr(self, p).channels > 1 else wells, getattr(self, t)))) for t, p in self._tipracks().items()},
+            'count': {t: data.get("count", {}).get(t, 0) for t in self._tipracks().keys()},
+            'tips': {t: list(chain.from_iterable(r)) for t, r in rack_tips.items()},
         }
         self._tip_log['max'] = {t: len(p) for t, p in self._tip_log['tips'].items()}
+        self._tip_log['available'] = {t: data.get("available", {}).get(t, m - self._tip_log['count'][t]) for t, m in self._tip_log['max'].items()}
     
     def track_tip(self):
+        if self.fast_simulation:
+            return
         if self._tip_track and not self._ctx.is_simulating():
             self.logger.debug(self.get_msg_format("tip log dump", self._tip_log_filepath))
             os.makedirs(self._tip_log_folder_path, exist_ok=True)
             with open(self._tip_log_filepath, 'w') as outfile:
                 json.dump({
                     "count": self._tip_log['count'],
+                    "available": self._tip_log['available'],
                     "next": {k: str(self._tip_log['tips'][k][v % self._tip_log['max'][k]]) for k, v in self._tip_log['count'].items()},
                 }, outfile, indent=2)
     
+    def reagent_requirements(self) -> List[ReagentRequirement]:
+        """Reagents drawn by the protocol, used for planning the load sheet"""
+        return []
+    
+    @property
+    def _reagent_plan_key(self) -> Hashable:
+        """What the reagent requirements depend on: the plan is made again only when it changes"""
+        return self.plate_samples
+    
+    @property
+    def reagent_plan(self) -> Dict[str, ReagentAllocation]:
+        """Reagent allocation, planned once per run and again only when the reagent requirements change"""
+        key = self._reagent_plan_key
+        if self._reagent_plan is None or self._reagent_plan[0] != key:
+            self._reagent_plan = (key, plan_reagents(self.reagent_requirements(), self._dead_volumes))
+        return self._reagent_plan[1]
+    
+    def log_load_sheet(self):
+        if self._plate_idx in self._load_sheet_plates:
+            return
+        self._load_sheet_plates.add(self._plate_idx)
+        plan = self.reagent_plan
+        if not plan:
+            return
+        self.logger.info(self.get_msg("load sheet"))
+        for a in plan.values():
+            for w, f in zip(a.wells, a.fills):
+                self.logger.info(self.get_msg_format("load sheet row", w, f, a.name) + (self.get_msg_format("load sheet tubes", a.requirement.tubes) if a.requirement.tubes > 1 else ""))
+            if a.overflow:
+                self.logger.warning(self.get_msg_format("load sheet overflow", a.name, a.capacity))
+    
     def pick_up(self, pip, loc: Optional[Location] = None, tiprack: Optional[str] = None):
         if loc is None:
             if tiprack is None:
@@ -262,13 +457,19 @@ class Station(metaclass=StationMeta):
             if tiprack is None:
                 raise RuntimeError("no tiprack associated to pipette")
             
-            if self._tip_log['count'][tiprack] == self._tip_log['max'][tiprack]:
+            if self._tip_log['available'][tiprack] == 0:
                 # If empty, wait for refill
-                self._tip_log['count'][tiprack] = 0
+                self._tip_log['available'][tiprack] = self._tip_log['max'][tiprack]
                 self.track_tip()
-                self.pause(self.get_msg_format("refill tips", "\n".join(map(str, getattr(self, tiprack)))))
-            self._tip_log['count'][tiprack] += 1
+                self.pause(self.get_msg_format("refill tips", "\n".join(map(str, getattr(self, tiprack)))), interventions=False, reason="refill tips", planned=False)
+            # Racks replaced at a scheduled pause are used again after the last one
+            self._tip_log['count'][tiprack] = self._tip_log['count'][tiprack] % self._tip_log['max'][tiprack] + 1
+            self._tip_log['available'][tiprack] -= 1
             self.track_tip()
+            tips = self._tips_used.setdefault(self._plate_idx, {})
+            tips[tiprack] = tips.get(tiprack, 0) + 1
+            if self._trace is not None:
+                self._trace.pick(tiprack)
             pip.pick_up_tip(self._tip_log['tips'][tiprack][self._tip_log['count'][tiprack] - 1])
         else:
             pip.pick_up_tip(loc)
@@ -279,10 +480,178 @@ class Station(metaclass=StationMeta):
         self._side_switch = not self._side_switch
         pip.drop_tip(drop_loc)
         self._drop_count += pip.channels
+        if self._trace is not None:
+            self._trace.drop(pip.channels)
         if self._drop_count >= self._drop_threshold:
-            self.pause('empty tips')
+            self.pause('empty tips', interventions=False, planned=False)
             self._drop_count = 0
     
+    def profiles(self) -> Dict[str, Profile]:
+        """Motion and pipette settings profiles, by name"""
+        return dict(PROFILES)
+    
+    def liquid_classes(self) -> Dict[str, LiquidClass]:
+        """Default liquid classes, by liquid name"""
+        return {}
+    
+    @property
+    def liquids(self) -> Dict[str, LiquidClass]:
+        """Liquid classes, updated with the per-site settings and then with the liquid_classes argument"""
+        if self._liquids is None:
+            self._liquids = registry(self.liquid_classes(), site_settings(), self._liquid_classes)
+        return self._liquids
+    
+    @contextmanager
+    def liquid(self, pip, name: str):
+        """Apply the flow rates of a liquid class to the pipette in the block, restoring the previous settings on exit.
+        The liquid class is yielded for the other settings"""
+        liquid = self.liquids[name]
+        with applied(pip, liquid.profile, self._ctx):
+            yield liquid
+    
+    def liquid_delay(self, seconds: float):
+        """Let the liquid settle in the tip. Buffered operations are executed first"""
+        if seconds:
+            self.flush_operations()
+            self._ctx.delay(seconds)
+    
+    @contextmanager
+    def profile(self, pip, name: str):
+        """Apply a profile to the pipette in the block, restoring the previous settings on exit"""
+        with applied(pip, self.profiles()[name], self._ctx):
+            yield pip
+    
+    @contextmanager
+    def travel(self):
+        """Run the block with the travel profile applied to all the pipettes: the profiles of the steps within it
+        are applied on top of it, and the settings left over (e.g. by a previous run on the same robot) are reset"""
+        with ExitStack() as stack:
+            for pip in self._ctx.loaded_instruments.values():
+                if pip is not None:
+                    stack.enter_context(self.profile(pip, "travel"))
+            yield
+    
+    @contextmanager
+    def near_liquid(self, pip, well, height: float = 0, profile: str = "near-liquid"):
+        """Move above the well, then run the block with a profile for the movements near the liquid.
+        The pipette goes back above the well before the previous settings are restored
+        :param pip: the pipette
+        :param well: the well
+        :param height: height from the top of the well in mm
+        :param profile: name of the profile"""
+        pip.move_to(well.top(height))
+        with self.profile(pip, profile):
+            yield pip
+            pip.move_to(well.top(height))
+    
+    @contextmanager
+    def operations(self, *pipettes: str):
+        """Buffer the operations of the pipettes (by attribute name) in the block,
+        then rewrite them with the optimization passes and execute them"""
+        if not self._optimize_operations:
+            yield
+            return
+        recorders = [OperationRecorder(getattr(self, p)) for p in pipettes]
+        for p, r in zip(pipettes, recorders):
+            setattr(self, p, r)
+        self._recorders += recorders
+        try:
+            yield
+        finally:
+            for p, r in zip(pipettes, recorders):
+                setattr(self, p, r.pipette)
+                self._recorders.remove(r)
+        for r in recorders:
+            self.execute_operations(r)
+    
+    def flush_operations(self):
+        for r in self._recorders:
+            self.execute_operations(r)
+    
+    def execute_operations(self, recorder: OperationRecorder):
+        buffer = recorder.take()
+        for p in self._operation_passes:
+            p(buffer)
+        buffer.execute()
+    
+    def log_operation_passes(self):
+        for p in self._operation_passes:
+            if isinstance(p, TipReuseCheckPass):
+                self.logger.info(self.msg_format("tip reuse check", p.violations))
+            else:
+                self.logger.info(self.msg_format("operation pass", p.name, p.operations, p.seconds))
+    
+    def trace_interventions(self) -> InterventionTrace:
+        """Predict the tip pick-ups and drops of the run. The simulation is cached (see :py:mod:`covmatic_stations.cache`),
+        so that it runs only the first time a station is started with the same arguments"""
+        if self._init_args:
+            result = self.simulate_interventions()
+        else:
+            kwargs = {k: v for k, v in self._init_kwargs.items() if k != "logger"}
+            result = SimulationCache().simulate(type(self), kwargs, run=lambda cls, kw: self.simulate_interventions(), kind="interventions")
+        self._estimated_duration = result["elapsed"]
+        return InterventionTrace.from_dict(result)
+    
+    def simulate_interventions(self) -> dict:
+        """Simulate a copy of the station to trace its tip pick-ups and drops
+        :return: the trace, with the estimated duration of the run as elapsed"""
+        from opentrons import simulate
+        logger = logging.getLogger("{}.interventions".format(self.logger_name))
+        logger.propagate = False
+        if not logger.handlers:
+            logger.addHandler(logging.NullHandler())
+        station = type(self)(*self._init_args, **dict(
+            self._init_kwargs,
+            dummy_lights=True,
+            fast_simulation=True,
+            logger=logger,
+            plan_interventions=False,
+            simulation_log_file=False,
+            simulation_log_lws=False,
+            tip_track=False,
+            wait_first_log=False,
+        ))
+        station._trace = InterventionTrace()
+        station.run(simulate.get_protocol_api(self._ctx.api_version))
+        return dict(station._trace.to_dict(), elapsed=station._estimator.elapsed)
+    
+    def plan_interventions(self):
+        try:
+            trace = self.trace_interventions()
+        except Exception as e:
+            self.logger.warning(self.get_msg_format("interventions failed", e))
+            return
+        self._planner = InterventionPlanner(trace, self._rack_sizes, self._drop_threshold)
+        plan, unplanned = self._planner.replay(self._tip_log, self._drop_count)
+        _, unplanned_before = self._planner.replay(self._tip_log, self._drop_count, planned=False)
+        if unplanned_before:
+            self.logger.info(self.get_msg_format("interventions plan", unplanned_before, unplanned))
+        for slot, intervention in plan:
+            self.logger.info(self.get_msg_format("interventions plan row", slot + 1, trace.segments[slot + 1].stage, " ".join(self.intervention_msgs(intervention))))
+    
+    def intervention_msgs(self, intervention: Intervention) -> List[str]:
+        msgs = [self.get_msg_format("refill tips", "\n".join(str(getattr(self, t)[k]) for k in racks)) for t, racks in intervention.racks.items()]
+        if intervention.empty_trash:
+            msgs.append(self.get_msg("empty tips"))
+        return msgs
+    
+    def intervene(self) -> List[str]:
+        """Ask for the planned interventions at a scheduled pause
+        :returns: the messages for the operator"""
+        slot = self._slot
+        self._slot += 1
+        if self._trace is not None:
+            self._trace.slot(self.stage)
+        if self._planner is None:
+            return []
+        intervention = self._planner.intervention(slot, self._tip_log, self._drop_count)
+        if intervention.racks:
+            self._planner.apply(intervention, self._tip_log)
+            self.track_tip()
+        if intervention.empty_trash:
+            self._drop_count = 0
+        return self.intervention_msgs(intervention)
+    
     def pause(self,
         msg: str = "",
         blink: bool = True,
@@ -292,12 +661,32 @@ class Station(metaclass=StationMeta):
         home: bool = True,
         level: int = logging.INFO,
         pause: bool = True,
+        interventions: bool = True,
+        reason: Optional[str] = None,
+        phase: Optional[str] = None,
+        planned: bool = True,
+        resume_if: Optional[Callable[[], bool]] = None,
+        operator: bool = True,
     ):
+        """Pause the robot
+        :param interventions: whether the operator is expected at the robot, so that planned tip refills and tip waste emptying can be asked for
+        :param reason: the reason of the pause for the wait-time analytics. Defaults to the message key or, for formatted messages, to the stage
+        :param phase: the phase of a pause in more steps (e.g. 'stop blink' and 'continue' for dual pauses)
+        :param planned: whether the pause is part of the protocol, or a reaction to the state of the robot (e.g. tips to refill)
+        :param resume_if: condition checked once the robot is paused, to resume at once. A resume requested
+        before the robot pauses is lost, so the events that resume the pause have to be latched and checked here
+        :param operator: whether the robot waits for the operator. Internal pauses (e.g. waiting for the first log) are not logged as operator wait
+        """
+        self.flush_operations()
         self.status = "pause"
         old_color = self._button.color
         self._button.color = color
         if msg:
             self.msg = msg
+        notes = self.intervene() if interventions else []
+        if notes:
+            self._msg = "\n".join(([self._msg] if msg else []) + notes)
+        if msg or notes:
             self.logger.log(level, self.msg)
         if home:
             self._ctx.home()
@@ -307,22 +696,62 @@ class Station(metaclass=StationMeta):
         if delay_time > 0:
             self._ctx.delay(delay_time)
         if pause:
+            self.pause_reason = reason or self.default_pause_reason(msg)
+            # The served start is on the clock of the served status time, the logged one on the clock of the stages
+            self.pause_start = status_time()
+            start = self.timestamp()
             self._ctx.pause()
+            if resume_if is not None and resume_if():
+                self._ctx.resume()
             self._ctx.delay(0.1)  # pad to avoid pause leaking
+            resume = self.timestamp()
+            if operator:
+                self._pause_log.append({
+                    "stage": self.stage,
+                    "msg": self.msg,
+                    "reason": self.pause_reason,
+                    "phase": phase,
+                    "planned": planned,
+                    "interventions": len(notes),
+                    "start": start,
+                    "resume": resume,
+                    "duration": resume - start,
+                })
+            self.pause_start = None
+            self.pause_reason = None
         if blink and not self._ctx.is_simulating():
             lt.stop()
         self._button.color = old_color
         self.status = "running"
         self.msg = ""
     
+    def default_pause_reason(self, msg: str) -> str:
+        """Reason of a pause: the message key or, for formatted messages, the stage without progress counters"""
+        if any(msg in getattr(c, '_messages', {}) for c in type(self).__mro__):
+            return msg
+        return self._stage_name
+    
     def dual_pause(self, msg: str, cols: Tuple[str, str] = ('red', 'yellow'), between: Optional[Callable] = None, home: Tuple[bool, bool] = (True, False)):
+        reason = self.default_pause_reason(msg)
         msg = self.get_msg(msg)
         self._msg = "{}.\n{}".format(msg, self.get_msg("stop blink"))
-        self.pause(self.msg, color=cols[0], home=home[0])
+        self.pause(self.msg, color=cols[0], home=home[0], reason=reason, phase="stop blink")
         if between is not None:
             between()
         self._msg = "{}.\n{}".format(msg, self.get_msg("continue"))
-        self.pause(self.msg, blink=False, color=cols[1], home=home[1])
+        self.pause(self.msg, blink=False, color=cols[1], home=home[1], interventions=False, reason=reason, phase="continue")
+    
+    def pause_intervals(self) -> List[Tuple[float, float]]:
+        """Start and resume time of the pauses of the run"""
+        return [(p["start"], p["resume"]) for p in self._pause_log]
+    
+    def log_operator_wait(self):
+        """Log the time the robot waited for the operators in the run"""
+        if not self._pause_log:
+            return
+        total = sum(p["duration"] for p in self._pause_log)
+        reactive = sum(p["duration"] for p in self._pause_log if not p["planned"])
+        self.logger.info(self.msg_format("operator wait", total / 60, len(self._pause_log), reactive / 60))
     
     def delay(self,
         mins: float,
@@ -339,48 +768,272 @@ class Station(metaclass=StationMeta):
             home=home,
             level=level,
             pause=self._skip_delay,
+            interventions=False,
         )
         
     def body(self):
         pass
     
+    def swap_plate(self):
+        """Wait for the operator to replace the plates and refill the reagents for the next plate"""
+        self.log_load_sheet()
+        self.dual_pause(self.msg_format("swap plate", self._plate_idx + 1, self.num_plates, self.plate_samples))
+    
+    def input_passports(self, plate: int) -> List[dict]:
+        """Passports of the input plates that went to an output plate: one each, the last output plate takes the remaining ones
+        (e.g. the source plates of station C, which go to one PCR plate)"""
+        return self._passport[plate:plate + 1] if plate + 1 < self.num_plates else self._passport[plate:]
+    
+    def build_passports(self) -> List[dict]:
+        """Passports of the output plates of the run"""
+        passports = []
+        for i in range(self.num_plates):
+            step = {
+                "station": type(self).__name__,
+                "instance": self._instance_name,
+                "version": __version__,
+                "status": self.status,
+                "error": self._run_error,
+                "start": self._run_start,
+                "end": status_time(),
+                "stages": self._stage_times.get(i, {}),
+                "reagent_lots": self._reagent_lots,
+                "tips": self._tips_used.get(i, {}),
+            }
+            num_samples = self._num_samples if self.num_plates == 1 else min(self._num_samples - i * self._plate_capacity, self._plate_capacity)
+            passports.append(plate_passport(
+                self.input_passports(i),
+                "{}-{}-{}".format(self.logger_name, self._run_id, i + 1),
+                num_samples, step, self._well_maps.get(i),
+                **{f: getattr(self, "_" + f) for f in self._passport_fields}
+            ))
+        return passports
+    
+    def timestamp(self) -> float:
+        """The current time as a POSIX timestamp: the clock during runs, the start time plus the estimated duration so far in simulation"""
+        if self._ctx.is_simulating():
+            return self._run_epoch + (self._estimator.elapsed if self._estimator is not None else 0)
+        return time.time()
+    
+    def record(self, op: str, wells: Iterable[str], plate: Optional[int] = None):
+        """Record an operation on the samples in the output plate wells to the sample ledger
+        :param op: the operation name
+        :param wells: the well names
+        :param plate: the plate index in the run, defaults to the current plate"""
+        self.ledger.record(op, wells, self._plate_idx if plate is None else plate, self.timestamp())
+    
+    @staticmethod
+    def column_wells(well) -> List[str]:
+        """Names of the wells in the same column as the well, as reached by multichannel pipettes"""
+        return [w.well_name for w in well.parent.columns_by_name()[well.well_name[1:]]]
+    
+    def ledger_plates(self) -> List[str]:
+        """Identifiers of the plates of the ledger records, by plate index: the output plates of the run"""
+        return [p["plate"] for p in self.passports]
+    
+    def save_ledger(self):
+        self.ledger.meta = {
+            "station": type(self).__name__,
+            "instance": self._instance_name,
+            "run": self._run_id,
+            "start": self._run_start,
+            "plates": self.ledger_plates(),
+        }
+        if self.fast_simulation or self._ctx.is_simulating() or not self._ledger_filepath:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._ledger_filepath), exist_ok=True)
+            self.ledger.save(self._ledger_filepath.format(self._run_id))
+            self.logger.info(self.msg_format("ledger saved", self._ledger_filepath.format(self._run_id), len(self.ledger)))
+        except OSError as e:
+            self.logger.warning(self.get_msg_format("ledger failed", e))
+    
+    def history_run(self) -> dict:
+        """The record of the run for the run history"""
+        tips = {}
+        for plate_tips in self._tips_used.values():
+            for k, v in plate_tips.items():
+                tips[k] = tips.get(k, 0) + v
+        return {
+            "run": self._run_id,
+            "station": type(self).__name__,
+            "instance": self._instance_name,
+            "robot": ot_config.name(),
+            "version": __version__,
+            "kwargs": {k: v for k, v in self._init_kwargs.items() if k not in ("logger", "metadata", "passport")},
+            "num_samples": self._num_samples,
+            "start_time": self._run_epoch,
+            "end_time": self.timestamp(),
+            "status": self.status,
+            "error": self._run_error,
+            "tips": tips,
+        }
+    
+    def save_history(self):
+        if self.fast_simulation or self._ctx.is_simulating() or not self._history_filepath:
+            return
+        run = self.history_run()
+        try:
+            os.makedirs(os.path.dirname(self._history_filepath), exist_ok=True)
+            with RunHistory(self._history_filepath) as history:
+                history.append(run, self._stage_durations + stage_durations(self._stage_log, run["end_time"], self.pause_intervals()), self._pause_log)
+            self.logger.info(self.msg_format("history saved", self._history_filepath))
+        except (OSError, sqlite3.Error) as e:
+            self.logger.warning(self.get_msg_format("history failed", e))
+    
+    def save_passports(self):
+        if self.fast_simulation or self._ctx.is_simulating() or not self._passport_filepath:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._passport_filepath), exist_ok=True)
+            for i, passport in enumerate(self.passports):
+                with open(self._passport_filepath.format(i + 1), "w") as f:
+                    json.dump(passport, f, indent=2)
+                self.logger.info(self.msg_format("passport saved", self._passport_filepath.format(i + 1)))
+        except OSError as e:
+            self.logger.warning(self.get_msg_format("passport failed", e))
+    
+    def run_plates(self):
+        for i in range(self.num_plates):
+            self._plate_idx = i
+            if i and self.run_stage("swap plate"):
+                self.swap_plate()
+            self.body()
+    
+    def rest_server(self):
+        """The REST interface for the run: the connection to the sidecar, if it is running, otherwise an in-process server"""
+        if self._sidecar_socket and os.path.exists(self._sidecar_socket):
+            try:
+                return SidecarClient(self._ctx, station=self, path=self._sidecar_socket)
+            except OSError as e:
+                self.logger.warning("Cannot connect to the sidecar at {}: {}".format(self._sidecar_socket, e))
+        return StationRESTServerThread(self._ctx, station=self, **self._rest_server_kwargs)
+    
+    def abort(self):
+        """Abort the run at the next robot command. The tip log is saved as at the end of the run"""
+        self.logger.warning("Aborting the run")
+        self._abort_requested = True
+        self._abort_pending = True
+        self._ctx.resume()
+    
+    @contextmanager
+    def abortable(self, threads: Iterable[Thread]):
+        """Threads running the protocol on behalf of the run (e.g. the lanes of a pipeline), where an abort is raised"""
+        threads = set(threads)
+        self._run_threads |= threads
+        try:
+            yield
+        finally:
+            self._run_threads -= threads
+    
+    def _check_abort(self, message):
+        # comments are skipped, as the exceptions raised while logging are not propagated
+        if self._abort_pending and message['$'] == 'before' and message['name'] != command_types.COMMENT and current_thread() in self._run_threads:
+            self._abort_pending = False
+            raise StationAborted("run aborted at stage: {}".format(self.stage))
+    
     def run(self, ctx: ProtocolContext):
         self.status = "running"
         self._ctx = ctx
-        self._button = (Button.dummy if self._dummy_lights else Button)(self._ctx, 'blue')
-        if self._simulation_log_lws or not self._ctx.is_simulating():
-            self._request = StationRESTServerThread(ctx, station=self, **self._rest_server_kwargs)
+        self._abort_requested = False
+        self._abort_pending = False
+        self._run_threads = {current_thread()}
+        self._run_id = time.strftime("%Y%m%d-%H%M%S")
+        self._run_start = status_time()
+        self._stage_times = {}
+        self._tips_used = {}
+        self._well_maps = {}
+        self._reagent_plan = None
+        self._planner = None
+        # The copies tracing the interventions (see simulate_interventions) start each run with an empty trace
+        self._trace = None if self._trace is None else InterventionTrace()
+        self._estimated_duration = None
+        self._slot = 0
+        self._stage_log = []
+        self._stage_durations = []
+        self._pause_log = []
+        self._run_error = None
+        self.ledger = SampleLedger()
+        self._run_epoch = time.time()
+        self._button = (Button.dummy if self._dummy_lights or self.fast_simulation else Button)(self._ctx, 'blue')
+        if not self.fast_simulation and (self._simulation_log_lws or not self._ctx.is_simulating()):
+            self._request = self.rest_server()
             self._request.start()
         
         self.setup_opentrons_logger()
+        self._estimator = DurationEstimator(stage=lambda: self.stage)
+        self._ctx.broker.subscribe(command_types.COMMAND, self._estimator)
+        self._ctx.broker.subscribe(command_types.COMMAND, self._check_abort)
         if self._wait_first_log:
             self._waiting_first_log = True
-            self.pause("wait log", blink=False, home=False, color='yellow')
+            self.pause("wait log", blink=False, home=False, color='yellow', interventions=False, operator=False)
             self._waiting_first_log = False
         
         self.logger.info(self.msg_format("protocol description"))
+        if self._passport:
+            self.logger.info(self.msg_format("passport loaded", ", ".join(str(p.get("plate")) for p in self._passport)))
         self.logger.info(self.msg_format("num samples", self._num_samples))
+        if self.num_plates > 1:
+            self.logger.info(self.msg_format("num plates", self.num_plates))
         self.logger.info(self.msg_format("version", __version__))
         
         self.load_labware()
         self.load_instruments()
         self.setup_tip_log()
+        if self._optimize_operations:
+            self._operation_passes = default_passes(self.logger)
+        if self._plan_interventions and not self._ctx.is_simulating():
+            self.plan_interventions()
         self._button.color = 'white'
         self.msg = ""
         
         try:
-            self.body()
+            with self.travel():
+                self.run_plates()
+            self.log_operation_passes()
+        except Exception as e:
+            self._run_error = "{}: {}".format(type(e).__name__, e)
+            raise
         finally:
-            self.status = "finished"
-            if not self._ctx.is_simulating():
+            self.status = "aborted" if self._abort_requested else "failed" if self._run_error is not None else "finished"
+            if self._request is not None:
                 self._request.join(2, 0.5)
+                self._request = None
             self.track_tip()
+            self.passports = self.build_passports()
+            self.save_passports()
+            self.save_ledger()
+            self.save_history()
+            if not self._ctx.is_simulating():
+                self.log_operator_wait()
             self._button.color = 'blue'
+            if self._ctx.is_simulating():
+                self.logger.info(self.msg_format("estimated duration", self._estimator.elapsed / 60, self._estimator.pauses))
+            self.remove_log_handlers()
         self._ctx.home()
     
     def simulate(self):
         from opentrons import simulate
         self.run(simulate.get_protocol_api(self.metadata["apiLevel"]))
+    
+    def simulate_cached(self, cache: Optional[SimulationCache] = None) -> dict:
+        """Simulate the run through the simulation cache (see :py:mod:`covmatic_stations.cache`): when the same station
+        was already simulated with the same arguments, its log is replayed instead of running it again, so the station
+        state (e.g. the tip log and the stage log) is only filled on a miss. Simulations logging to the LWS always run
+        :param cache: the cache, defaults to the one in the OT_SIMULATION_CACHE directory
+        :return: the simulation result (see :py:func:`covmatic_stations.worker.simulate_station`),
+        with a cached field telling whether it comes from the cache"""
+        from .worker import simulate_station
+        if self._init_args or self._simulation_log_lws:
+            return dict(simulate_station(self), cached=False)
+        kwargs = {k: v for k, v in self._init_kwargs.items() if k != "logger"}
+        result = (cache or SimulationCache()).simulate(type(self), kwargs, run=lambda cls, kw: simulate_station(self), kind="station")
+        if result["cached"]:
+            logger = logging.getLogger(self.logger_name)
+            for record in result["log"]:
+                level, msg = record.split(": ", 1)
+                logger.log(logging.getLevelName(level), msg)
+        return result
 
 
 # Copyright (c) 2020 Covmatic.
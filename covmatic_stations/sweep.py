@@ -0,0 +1,147 @@
+"""Parallel parameter sweeps.
+Simulates a station class over a grid or a random sample of keyword arguments, fanning the runs
+out over a process pool whose workers import opentrons once. Each run yields a table row with the
+arguments, the estimated duration, the throughput, the tips used and the pauses.
+The Pareto front picks the rows for which no other row has both a higher throughput and fewer tips, e.g.
+    python -m covmatic_stations.sweep covmatic_stations.b.b.StationB -g wash_mix_vol=150,180 bind_mix_times=5,10"""
+from .benchmark import import_station
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+import json
+import logging
+import random
+import sys
+
+
+# Values of a random search space: a sequence to choose from or a function of the random generator
+Distribution = Union[Sequence, Callable[[random.Random], Any]]
+COLUMNS = ("duration", "throughput", "tips", "pauses", "wall_time")
+
+
+def grid(space: Dict[str, Sequence]) -> Iterator[dict]:
+    """All the combinations of the values"""
+    keys = list(space)
+    for values in product(*(space[k] for k in keys)):
+        yield dict(zip(keys, values))
+
+
+def random_search(space: Dict[str, Distribution], n: int, seed: Optional[int] = None) -> Iterator[dict]:
+    """n random combinations of the values"""
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield {k: v(rng) if callable(v) else rng.choice(v) for k, v in space.items()}
+
+
+def _init_worker():
+    # Import opentrons once per worker
+    from opentrons import simulate  # noqa: F401
+
+
+def simulate_point(station: str, kwargs: dict) -> dict:
+    """Simulate a station and summarize the run as a table row
+    :param station: dotted path of the station class
+    :param kwargs: keyword arguments for the station"""
+    from .benchmark import measure
+    cls = import_station(station)
+    logging.getLogger(cls.__name__).setLevel(logging.WARNING)
+    row = {"kwargs": kwargs}
+    try:
+        r = measure(cls, **dict(kwargs, fast_simulation=True))
+    except Exception as e:
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+        return row
+    row.update(
+        duration=r["estimated_time"] / 60,
+        throughput=r["num_samples"] * 3600 / r["estimated_time"] if r["estimated_time"] else 0,
+        tips=sum(r["tips"].values()),
+        pauses=r["pauses"],
+        wall_time=r["wall_time"],
+    )
+    return row
+
+
+def sweep(station: str, points: Iterable[dict], base_kwargs: Optional[dict] = None, workers: Optional[int] = None) -> List[dict]:
+    """Simulate a station for each point of the search space in a process pool
+    :param station: dotted path of the station class
+    :param points: keyword arguments to sweep, e.g. from :py:func:`grid` or :py:func:`random_search`
+    :param base_kwargs: keyword arguments shared by all the points
+    :param workers: number of worker processes. Defaults to the number of CPUs
+    :return: a table row for each point, in order. Rows of failed runs have an error field instead of the metrics"""
+    kwargs = [dict(base_kwargs or {}, **p) for p in points]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        return list(pool.map(simulate_point, [station] * len(kwargs), kwargs))
+
+
+def pareto_front(rows: Iterable[dict], maximize: Sequence[str] = ("throughput",), minimize: Sequence[str] = ("tips",)) -> List[dict]:
+    """Rows that are not dominated by any other row. Failed runs are skipped
+    :param rows: the sweep table
+    :param maximize: columns to maximize
+    :param minimize: columns to minimize"""
+    rows = [r for r in rows if "error" not in r]
+    key = lambda r: tuple(r[c] for c in maximize) + tuple(-r[c] for c in minimize)
+    
+    def dominates(a, b) -> bool:
+        return all(x >= y for x, y in zip(a, b)) and a != b
+    
+    keys = list(map(key, rows))
+    return [r for r, k in zip(rows, keys) if not any(dominates(o, k) for o in keys)]
+
+
+def _value(s: str):
+    try:
+        return json.loads(s)
+    except ValueError:
+        return s
+
+
+def _space(items: List[str]) -> Dict[str, list]:
+    space = {}
+    for item in items:
+        k, v = item.split("=", 1)
+        space[k] = list(map(_value, v.split(",")))
+    return space
+
+
+def format_table(rows: List[dict], front: Optional[List[dict]] = None) -> str:
+    """Tab-separated table of the sweep, with the Pareto front rows marked"""
+    keys = sorted(set(k for r in rows for k in r["kwargs"]))
+    front_ids = set(map(id, front or []))
+    lines = ["\t".join(["front"] + keys + list(COLUMNS))]
+    for r in rows:
+        metrics = [r["error"]] if "error" in r else ["{:.4g}".format(r[c]) for c in COLUMNS]
+        lines.append("\t".join(["*" if id(r) in front_ids else ""] + [json.dumps(r["kwargs"].get(k)) for k in keys] + metrics))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("station", type=str, help="dotted path of the station class")
+    parser.add_argument("-g", "--grid", type=str, nargs="+", default=[], metavar="KEY=V1,V2", help="values to sweep for each keyword argument (JSON values)")
+    parser.add_argument("-r", "--random", type=int, default=0, metavar="N", help="sample N random points of the grid instead of all of them")
+    parser.add_argument("-s", "--seed", type=int, default=None, help="seed for the random search")
+    parser.add_argument("-k", "--kwargs", type=json.loads, default={}, help="JSON object of keyword arguments shared by all the points")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("-o", "--output", type=str, default=None, help="the file path where to save the sweep table JSON")
+    args = parser.parse_args(argv)
+    
+    space = _space(args.grid)
+    points = random_search(space, args.random, args.seed) if args.random else grid(space)
+    rows = sweep(args.station, points, args.kwargs, args.workers)
+    front = pareto_front(rows)
+    print(format_table(rows, front))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rows": rows, "front": [rows.index(r) for r in front]}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
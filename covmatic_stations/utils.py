@@ -1,8 +1,10 @@
+from .profiles import Profile, applied
 from opentrons.protocol_api import ProtocolContext
 from opentrons.types import Location
 import logging
 import math
 import requests
+from contextlib import ExitStack
 from itertools import tee, cycle, islice, chain, repeat
 from typing import Tuple, Union, Iterable, Callable, Optional, Dict, Any
 
@@ -45,7 +47,7 @@ class LocalWebServerLogger:
     def __call__(self, record: Dict[str, Any]):
         s = self.format(record)
         url = self.url
-        if url and s:
+        if self.ip and s:
             try:
                 requests.post(url, s.encode('utf-8'), headers={'Content-type': 'text/plain; charset=utf-8'})
             except Exception:
@@ -91,20 +93,20 @@ def mix_walk(
     
     old_speed = pip.default_speed
     
-    for b, a, d in islice(zip(chain([True], repeat(False)), cycle(aspirate_locs), cycle(dispense_locs)), reps):
-        if b and speed is not None:
-            pip.move_to(a)
-            pip.default_speed = speed
+    with ExitStack() as stack:
+        for b, a, d in islice(zip(chain([True], repeat(False)), cycle(aspirate_locs), cycle(dispense_locs)), reps):
+            if b and speed is not None:
+                pip.move_to(a)
+                stack.enter_context(applied(pip, Profile(default_speed=speed)))
+                if logger is not None:
+                    logger.debug('set speed to %s', speed)
             if logger is not None:
-                logger.debug('set speed to {}'.format(speed))
-        if logger is not None:
-            logger.debug('mixing at {} and {}'.format(a, d))
-        pip.aspirate(vol, a)
-        pip.dispense(vol, d)
+                logger.debug('mixing at %s and %s', a, d)
+            pip.aspirate(vol, a)
+            pip.dispense(vol, d)
     
     if logger is not None and speed is not None:
-        logger.debug('set speed to {}'.format(old_speed))
-    pip.default_speed = old_speed
+        logger.debug('set speed to %s', old_speed)
 
 
 def uniform_divide(total: float, mpp: float) -> Tuple[int, float]:
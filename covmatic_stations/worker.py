@@ -0,0 +1,192 @@
+"""Warm simulation worker.
+A long-lived process that keeps opentrons and the station modules imported and serves simulations
+over local HTTP, so that parameters can be validated without paying the start-up cost each time.
+Start it with
+    python -m covmatic_stations.worker --port 8090
+and post jobs as JSON objects with the station (class name or dotted path) and its keyword arguments
+    curl -X POST -H "Content-Type: application/json" -d '{"station": "StationB", "kwargs": {"num_samples": 24}}' http://127.0.0.1:8090/simulate
+The response holds the command log, the stages with their estimated duration, the pauses for the operator
+with their estimated time, the overall estimate and the station log.
+Results are cached on disk (see :py:mod:`covmatic_stations.cache`).
+Jobs are queued and run one at a time"""
+from .benchmark import API_LEVEL, STATIONS, import_station
+from .cache import SimulationCache
+from .station import Station
+from opentrons import simulate
+from opentrons.commands import types as command_types
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import asyncio
+import cherrypy
+import logging
+import requests
+import sys
+import time
+
+
+DEFAULT_WORKER_CONFIG = {
+    "global": {
+        "server.socket_host": "127.0.0.1",
+        "server.socket_port": 8090,
+        "engine.autoreload.on": False,
+    },
+}
+
+
+class _RecordHandler(logging.Handler):
+    def __init__(self, level: int = logging.INFO):
+        super(_RecordHandler, self).__init__(level=level)
+        self.records: List[str] = []
+    
+    def emit(self, record: logging.LogRecord):
+        self.records.append("{}: {}".format(record.levelname, record.getMessage()))
+
+
+def station_class(name: str) -> type:
+    """Station class from its name or dotted path. Only classes in this package are served"""
+    by_name = {s.rsplit(".", 1)[-1]: s for s in STATIONS}
+    name = by_name.get(name, name)
+    if not name.startswith(__package__ + "."):
+        raise ValueError("unknown station: {}".format(name))
+    try:
+        cls = import_station(name)
+    except (ImportError, AttributeError):
+        raise ValueError("unknown station: {}".format(name))
+    if not (isinstance(cls, type) and issubclass(cls, Station)):
+        raise ValueError("not a station: {}".format(name))
+    return cls
+
+
+def simulate_job(cls: type, kwargs: Optional[dict] = None) -> dict:
+    """Simulate a station and collect the command log, the stages, the pauses and the estimates
+    :param cls: the station class
+    :param kwargs: keyword arguments for the station"""
+    return simulate_station(cls(**dict(kwargs or {}, metadata={'apiLevel': API_LEVEL}, fast_simulation=True, tip_track=False)))
+
+
+def simulate_station(station: Station) -> dict:
+    """Simulate a station instance and collect the command log, the stages, the pauses and the estimates
+    (see :py:func:`simulate_job`)"""
+    ctx = simulate.get_protocol_api((station.metadata or {}).get("apiLevel", API_LEVEL))
+    commands = []
+    ctx.broker.subscribe(command_types.COMMAND, lambda m: m['$'] == 'before' and commands.append(m['payload']['text']))
+    pauses = []
+    ctx.broker.subscribe(command_types.COMMAND, lambda m: m['$'] == 'before' and m['name'] == command_types.PAUSE and pauses.append(
+        {"time": station._estimator.elapsed, "stage": station.stage, "external": station.external}))
+    logger = logging.getLogger(station.logger_name)
+    handler = _RecordHandler()
+    logger.addHandler(handler)
+    t = time.perf_counter()
+    try:
+        station.run(ctx)
+    finally:
+        logger.removeHandler(handler)
+    return {
+        "station": type(station).__name__,
+        "num_samples": station._num_samples,
+        "commands": commands,
+        "stages": [{"stage": s, "duration": d} for s, d in station._estimator.stages.items()],
+        "pauses": pauses,
+        "estimate": {"duration": station._estimator.elapsed, "pauses": station._estimator.pauses,
+                     "requested": station._estimator.requested, "overlapped": station._estimator.overlapped},
+        "log": handler.records,
+        "wall_time": time.perf_counter() - t,
+    }
+
+
+class SimulationWorker:
+    def __init__(self, warm_up: bool = True, config: Optional[dict] = None, cache: Optional[SimulationCache] = None):
+        """ Build a :py:class:`.SimulationWorker`.
+        :param warm_up: import the station classes and run a short simulation of each before serving
+        :param config: cherrypy configuration. Defaults to DEFAULT_WORKER_CONFIG
+        :param cache: cache for the simulation results
+        """
+        self._config = DEFAULT_WORKER_CONFIG if config is None else config
+        self._cache = cache
+        # Simulations need an event loop: they all run in one thread that owns it
+        self._executor = ThreadPoolExecutor(max_workers=1, initializer=lambda: asyncio.set_event_loop(asyncio.new_event_loop()))
+        self._jobs = 0
+        self._ready = False
+        if warm_up:
+            self.warm_up()
+    
+    def warm_up(self):
+        self._executor.submit(self._warm_up).result()
+    
+    def _warm_up(self):
+        for name in STATIONS:
+            cls = import_station(name)
+            logging.getLogger(cls.__name__).setLevel(logging.WARNING)
+            try:
+                simulate_job(cls, {"num_samples": 8})
+            except Exception as e:
+                logging.getLogger(__name__).warning("warm up of {} failed: {}".format(name, e))
+        self._ready = True
+    
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def health(self) -> dict:
+        health = {"status": "ready" if self._ready else "cold", "jobs": self._jobs}
+        if self._cache is not None:
+            health.update(cache_hits=self._cache.hits, cache_misses=self._cache.misses)
+        return health
+    
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def simulate(self) -> dict:
+        job = cherrypy.request.json
+        try:
+            cls = station_class(job.get("station", ""))
+        except ValueError as e:
+            cherrypy.response.status = 404
+            return {"error": str(e)}
+        self._jobs += 1
+        try:
+            if self._cache is not None:
+                return self._cache.simulate(cls, job.get("kwargs"), run=self._run)
+            return self._run(cls, job.get("kwargs"))
+        except Exception as e:
+            cherrypy.response.status = 422
+            return {"error": "{}: {}".format(type(e).__name__, e)}
+    
+    def _run(self, cls: type, kwargs: Optional[dict] = None) -> dict:
+        return self._executor.submit(simulate_job, cls, kwargs).result()
+    
+    def serve(self):
+        cherrypy.quickstart(self, config=self._config)
+
+
+def simulate_remote(station: str, kwargs: Optional[dict] = None, url: str = "http://127.0.0.1:8090", timeout: float = 60) -> dict:
+    """Post a simulation job to a worker
+    :param station: class name or dotted path of the station
+    :param kwargs: keyword arguments for the station
+    :param url: base URL of the worker
+    :param timeout: request timeout in seconds"""
+    r = requests.post("{}/simulate".format(url), json={"station": station, "kwargs": kwargs or {}}, timeout=timeout)
+    return r.json()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_WORKER_CONFIG["global"]["server.socket_port"], help="port to listen on")
+    parser.add_argument("--host", type=str, default=DEFAULT_WORKER_CONFIG["global"]["server.socket_host"], help="address to listen on")
+    parser.add_argument("--no-warm-up", action="store_true", help="serve without warming up the station classes")
+    parser.add_argument("--cache-dir", type=str, default=None, help="directory of the simulation cache")
+    parser.add_argument("--no-cache", action="store_true", help="always simulate, without caching the results")
+    args = parser.parse_args(argv)
+    config = {"global": dict(DEFAULT_WORKER_CONFIG["global"], **{"server.socket_host": args.host, "server.socket_port": args.port})}
+    cache = None if args.no_cache else SimulationCache(args.cache_dir)
+    SimulationWorker(warm_up=not args.no_warm_up, config=config, cache=cache).serve()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
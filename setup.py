@@ -41,6 +41,7 @@ setuptools.setup(
     ],
     install_requires=[
         'opentrons',
+        'numpy',
         'cherrypy',
         'requests',
         'ipaddress',